@@ -1,38 +1,19 @@
-import io
-import json
+import csv
 
-import pandas as pd
 from bson import ObjectId
 from django.http import JsonResponse
 from rdkit import Chem
 
+from askcos_site.askcos_celery.buyables.ingest import ingest_buyables, iter_buyables
 from askcos_site.globals import buyables_db
 from askcos_site.main.views.users import can_modify_buyables
 
 
-def add_buyable_list_to_db(buyable_list, allow_overwrite=True):
-    result = {
-        'error': None,
-        'count': 0,
-        'added': [],
-        'updated': [],
-        'added_count': 0,
-        'updated_count': 0,
-        'duplicate_count': 0,
-        'total': len(buyable_list)
-    }
-    for buyable in buyable_list:
-        res = add_buyable_to_db(buyable, allow_overwrite=allow_overwrite)
-        if not res['error']:
-            if res.get('duplicate'):
-                result['duplicate_count'] += 1
-            if res.get('inserted'):
-                result['added'].append(res['inserted'])
-                result['added_count'] += 1
-            if res.get('updated'):
-                result['updated'].append(res['updated'])
-                result['updated_count'] += 1
-            result['count'] += 1
+def add_buyable_list_to_db(buyable_list, allow_overwrite=True, return_limit=None):
+    result = ingest_buyables(buyables_db, buyable_list, allow_overwrite=allow_overwrite,
+                             return_limit=return_limit or len(buyable_list), require_price=True)
+    result['added'] = result.pop('inserted')
+    result['added_count'] = result.pop('inserted_count')
     return result
 
 def add_buyable_to_db(buyable, allow_overwrite=True):
@@ -128,32 +109,21 @@ def upload_buyable(request):
     upload_file = request.FILES.get('file')
     return_limit = int(request.POST.get('returnLimit', 1000))
     allow_overwrite = request.POST.get('allowOverwrite', 'True') in ['True', 'true']
-    try:
-        content = upload_file.read()
-    except:
-        resp['error'] = 'Cannot read file!'
-        return JsonResponse(resp)
-    if file_format == 'json':
-        try:
-            upload_json = json.loads(content.decode('utf-8'))
-        except json.JSONDecodeError:
-            resp['error'] = 'Cannot parse json!'
-            return JsonResponse(resp)
-    elif file_format == 'csv':
-        try:
-            df = pd.read_csv(io.StringIO(content.decode('utf-8')))
-            upload_json = df.to_dict(orient='records')
-        except Exception as e:
-            print(e)
-            resp['error'] = 'Cannot parse csv!'
-            return JsonResponse(resp)
-    else:
+    if file_format not in ('json', 'csv'):
         resp['error'] = 'File format not supported!'
         return JsonResponse(resp)
-    if not isinstance(upload_json, list) or len(upload_json) == 0 or not isinstance(upload_json[0], dict):
-        resp['error'] = 'Improperly formatted json!'
+    try:
+        result = ingest_buyables(buyables_db, iter_buyables(upload_file, file_format),
+                                 allow_overwrite=allow_overwrite, return_limit=return_limit, require_price=True)
+    except (ValueError, csv.Error) as e:
+        print(e)
+        resp['error'] = 'Cannot parse {}!'.format(file_format)
+        return JsonResponse(resp)
+    if result['total'] == 0:
+        resp['error'] = 'Improperly formatted {}!'.format(file_format)
         return JsonResponse(resp)
-    result = add_buyable_list_to_db(upload_json, allow_overwrite=allow_overwrite)
+    result['added'] = result.pop('inserted')
+    result['added_count'] = result.pop('inserted_count')
     if result.get('error'):
         resp['error'] = result['error']
     resp['added'] = result['added'][:return_limit]
@@ -1,6 +1,7 @@
 from django.http import JsonResponse
 from rdkit import Chem
 
+from askcos_site.askcos_celery.scheduling import get_lane_options
 from askcos_site.askcos_celery.treebuilder.tb_c_worker import fast_filter_check
 
 TIMEOUT = 30
@@ -30,7 +31,7 @@ def fast_filter(request):
         resp['error'] = 'Cannot parse products smiles with rdkit'
         return JsonResponse(resp, status=400)
 
-    res = fast_filter_check.delay(reactants, products)
+    res = fast_filter_check.apply_async(args=(reactants, products), **get_lane_options('interactive'))
     try:
         outcome = res.get(TIMEOUT)
     except TimeoutError:
@@ -1,11 +1,10 @@
 from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
 
-from askcos_site.globals import db_client
+from askcos_site.askcos_celery.treebuilder.result_store import delete_result, load_result
+from askcos_site.globals import results_collection
 from askcos_site.main.models import SavedResults
 
-results_collection = db_client['results']['results']
-
 
 @login_required
 def poll_result(request):
@@ -33,8 +32,8 @@ def get_result(request):
         resp['error'] = 'No result found!'
         result = None
     if result and result.result_state == 'completed':
-        result_doc = results_collection.find_one({'_id': id_})
-        resp['result'] = result_doc
+        stored = load_result(results_collection, id_)
+        resp['result'] = stored.to_doc() if stored is not None else None
     return JsonResponse(resp)
 
 @login_required
@@ -63,7 +62,7 @@ def remove_result(request):
     try:
         if result:
             result.delete()
-            results_collection.delete_one({'_id': id_})
+            delete_result(results_collection, id_)
     except:
         resp['status'] = 0
     resp['status'] = 1
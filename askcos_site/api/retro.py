@@ -2,6 +2,7 @@ from celery.exceptions import TimeoutError
 from django.http import JsonResponse
 from rdkit import Chem
 
+from askcos_site.askcos_celery.scheduling import get_lane_options
 from askcos_site.askcos_celery.treebuilder.tb_c_worker import get_top_precursors
 from askcos_site.main.utils import is_banned
 
@@ -42,20 +43,23 @@ def singlestep(request):
 
     selec_check = request.GET.get('allow_selec', 'True') in ['True', 'true']
 
-    res = get_top_precursors.delay(
-        target,
-        template_set=template_set,
-        template_prioritizer=template_prioritizer,
-        fast_filter_threshold=fast_filter_threshold,
-        max_cum_prob=max_cum_prob,
-        max_num_templates=max_num_templates,
-        cluster=cluster,
-        cluster_method=cluster_method,
-        cluster_feature=cluster_feature,
-        cluster_fp_type=cluster_fp_type,
-        cluster_fp_length=cluster_fp_length,
-        cluster_fp_radius=cluster_fp_radius,
-        selec_check=selec_check,
+    res = get_top_precursors.apply_async(
+        args=(target,),
+        kwargs={
+            'template_set': template_set,
+            'template_prioritizer': template_prioritizer,
+            'fast_filter_threshold': fast_filter_threshold,
+            'max_cum_prob': max_cum_prob,
+            'max_num_templates': max_num_templates,
+            'cluster': cluster,
+            'cluster_method': cluster_method,
+            'cluster_feature': cluster_feature,
+            'cluster_fp_type': cluster_fp_type,
+            'cluster_fp_length': cluster_fp_length,
+            'cluster_fp_radius': cluster_fp_radius,
+            'selec_check': selec_check,
+        },
+        **get_lane_options('interactive')
     )
 
     if run_async:
@@ -1,40 +1,22 @@
+import time
+
 from celery.result import AsyncResult
 from django.http import JsonResponse
 
+from askcos_site.askcos_celery.cache import get_cache_stats
+from askcos_site.askcos_celery.scheduling import get_queue_wait_stats
+from askcos_site.askcos_celery.worker_status import get_worker_status, summarize_queues
 from askcos_site.celery import app, READABLE_NAMES
 
 
 def celery_status(request):
     resp = {}
-    status = {}
-    stats = app.control.inspect().stats()
-    active = app.control.inspect().active()
-    if not stats or not active:
-        return JsonResponse(resp)
-    worker_names = stats.keys()
-    for worker in worker_names:
-        name, server = worker.split('@')
-        if not status.get(name):
-            status[name] = {'available': 0, 'busy': 0}
-        status[name]['busy'] += len(active[worker])
-        status[name]['available'] += stats[worker]['pool']['max-concurrency'] - status[name]['busy']
-    status_list = []
-    for key in status:
-        status_list.append({
-            'name': READABLE_NAMES.get(key, key),
-            'queue': key,
-            'busy': status[key]['busy'],
-            'available': status[key]['available']
-        })
-    for key, val in READABLE_NAMES.items():
-        if key not in status:
-            status_list.append({
-                'name': READABLE_NAMES.get(key),
-                'queue': key,
-                'busy': 0,
-                'available': 0
-            })
-    resp['queues'] = sorted(status_list, key=lambda x: x['name'])
+    snapshot = get_worker_status(app)
+    resp['queues'] = summarize_queues(snapshot, READABLE_NAMES)
+    resp['caches'] = get_cache_stats()
+    resp['queue_wait'] = get_queue_wait_stats()
+    resp['updated'] = snapshot['updated']
+    resp['age'] = max(time.time() - snapshot['updated'], 0)
     return JsonResponse(resp)
 
 
@@ -4,6 +4,7 @@ from celery.exceptions import TimeoutError
 from django.http import JsonResponse
 from rdkit import Chem
 
+from askcos_site.askcos_celery.scheduling import get_fair_share_user
 from askcos_site.askcos_celery.treebuilder.tb_coordinator_mcts import get_buyable_paths as get_buyable_paths_mcts
 from askcos_site.main.utils import is_banned
 
@@ -81,7 +82,8 @@ def tree_builder(request):
                                   max_natom_dict=max_natom_dict, min_chemical_history_dict=min_chemical_history_dict,
                                   apply_fast_filter=apply_fast_filter, filter_threshold=filter_threshold,
                                   template_prioritizer=template_prioritizer, template_set=template_set,
-                                  hashed=historian_hashed, return_first=return_first)
+                                  hashed=historian_hashed, return_first=return_first,
+                                  user=get_fair_share_user(request))
     
     if run_async:
         resp['id'] = res.id
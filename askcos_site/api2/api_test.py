@@ -38,17 +38,15 @@ class TestAPI(unittest.TestCase):
 
     def get_result(self, task_id):
         """Retrieve celery task output"""
-        # Try to get result 10 times in 2 sec intervals
-        for _ in range(10):
-            response = self.get('/celery/task/{0}/'.format(task_id))
+        # Wait up to 20 sec for the result, server waits for task updates
+        deadline = time.time() + 20
+        while time.time() < deadline:
+            response = self.get('/celery/task/{0}/'.format(task_id), params={'wait': deadline - time.time()})
             result = response.json()
             if result.get('complete'):
                 return result
-            else:
-                if result.get('failed'):
-                    self.fail('Celery task failed.')
-                else:
-                    time.sleep(2)
+            elif result.get('failed'):
+                self.fail('Celery task failed.')
 
     def authenticate(self):
         """Get authentication token, returns formatted header dict"""
@@ -270,6 +268,17 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(result['duplicate_count'], 2)
         self.assertEqual(result['total'], 2)
 
+        # Upload the same buyables in a celery task
+        data = {'format': 'json', 'allowOverwrite': False, 'run_async': True}
+        response = self.post('/buyables/upload/', data=data, files=files)
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertTrue(result['success'])
+        result = self.get_result(result['task_id'])
+        self.assertTrue(result['complete'])
+        self.assertEqual(result['output']['duplicate_count'], 2)
+        self.assertEqual(result['output']['total'], 2)
+
         # Get request with query
         response = self.get('/buyables/?q=C1CCC1')
         self.assertEqual(response.status_code, 200)
@@ -277,6 +286,15 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(len(result['result']), 1)
         self.assertEqual(result['result'][0]['smiles'], 'C1CCC1')
 
+        # Get request with similarity and substructure queries
+        for search_type in ['similarity', 'substructure']:
+            response = self.get('/buyables/?q=C1CCC1&search_type={0}&returnLimit=5'.format(search_type))
+            if response.status_code == 503:
+                continue  # search index is still being built
+            self.assertEqual(response.status_code, 200)
+            result = response.json()
+            self.assertLessEqual(len(result['result']), 5)
+
         # Get request for specific buyable
         response = self.get('/buyables/{0}/'.format(_id))
         self.assertEqual(response.status_code, 200)
@@ -297,6 +315,17 @@ class TestAPI(unittest.TestCase):
 
         result = response.json()
         self.assertIsInstance(result['queues'], list)
+        self.assertIsInstance(result['caches'], list)
+        self.assertIsInstance(result['queue_wait'], list)
+        self.assertGreaterEqual(result['age'], 0)
+        self.assertIn('pricer', result['load_profile']['globals'])
+
+        # Status is served from a snapshot, so repeated requests are fast
+        start = time.time()
+        response = self.get('/celery/')
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertGreaterEqual(response.json()['updated'], result['updated'])
 
     def test_celery_task_status(self):
         """Test /celery/task endpoint"""
@@ -304,6 +333,24 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {'complete': False})
 
+        # Long poll returns after the wait time if the task does not change
+        start = time.time()
+        response = self.get('/celery/task/abc/', params={'wait': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'complete': False})
+        self.assertGreaterEqual(time.time() - start, 1)
+
+        # Server-sent events start with the current status
+        response = self.get('/celery/task/abc/', params={'stream': 'true'}, stream=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/event-stream'))
+        lines = response.iter_lines(decode_unicode=True)
+        self.assertEqual(next(lines), 'retry: 1000')
+        self.assertEqual(next(lines), '')
+        self.assertEqual(next(lines), 'event: status')
+        self.assertEqual(next(lines), 'data: {"complete": false}')
+        response.close()
+
     def test_cluster(self):
         """Test /cluster endpoint"""
         data = {
@@ -443,6 +490,27 @@ class TestAPI(unittest.TestCase):
             response2 = self.post('/draw/', data=data)
             self.assertEqual(response2.status_code, 200)
             self.assertEqual(response1.content, response2.content)
+            self.assertEqual(response1.headers['ETag'], response2.headers['ETag'])
+            self.assertIn('max-age', response1.headers['Cache-Control'])
+
+            # Conditional requests for cached drawings are not redrawn
+            response3 = self.get('/draw/', params=data, headers={'If-None-Match': response1.headers['ETag']})
+            self.assertEqual(response3.status_code, 304)
+
+        # Test batch drawing, with a structure which cannot be drawn
+        structures = tests + [{'smiles': 'X', 'input_type': 'chemical'}]
+        response = self.post('/draw/batch/', json={'structures': structures})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual(len(results), len(structures))
+        for result in results[:-1]:
+            self.assertIsNone(result['error'])
+            self.assertTrue(result['image'].startswith('data:image/'))
+        self.assertIsNone(results[-1]['image'])
+        self.assertEqual(results[-1]['error'], 'Could not draw requested structure.')
+
+        response = self.post('/draw/batch/', json={'structures': []})
+        self.assertEqual(response.status_code, 400)
 
     def test_fast_filter(self):
         """Test /fast-filter endpoint"""
@@ -565,6 +633,17 @@ class TestAPI(unittest.TestCase):
 
         result = response.json()
         self.assertEqual(result['reactions'], [])
+        self.assertIsNone(result['next_cursor'])
+
+        # Test projection and pagination parameters
+        data = {'ids': ['1'], 'fields': ['reaction_id'], 'limit': 10}
+        response = self.post('/reactions/', json=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'reactions': [], 'next_cursor': None})
+
+        response = self.post('/reactions/', json={'ids': ['1'], 'cursor': 'X'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cursor', response.json())
 
         # Test insufficient data
         response = self.post('/reactions/', data={})
@@ -722,6 +801,17 @@ M  END
         result = self.get_result(result['task_id'])
         self.assertTrue(result['complete'])
         self.assertIsInstance(result['output'], list)
+        output = result['output']
+
+        # Repeated request should be answered from the cache
+        response = self.post('/retro/', data=data)
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertTrue(result['cached'])
+        self.assertEqual(result['output'], output)
+        result = self.get_result(result['task_id'])
+        self.assertTrue(result['complete'])
+        self.assertEqual(result['output'], output)
 
         # Test insufficient data
         response = self.post('/retro/', data={})
@@ -779,6 +869,30 @@ M  END
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json(), {'smiles': ['Cannot parse smiles with rdkit.']})
 
+    def test_scscore_batch(self):
+        """Test /scscore endpoint with a list of smiles"""
+        smiles = ['CN(C)CCOC(c1ccccc1)c1ccccc1', 'X', 'CCO'] * 1000
+        response = self.post('/scscore/', json={'smiles': smiles})
+        self.assertEqual(response.status_code, 200)
+
+        # Confirm that request was interpreted correctly
+        result = response.json()
+        self.assertEqual(result['request']['smiles'], smiles)
+
+        # Results are in request order with per-item errors
+        results = result['results']
+        self.assertEqual(len(results), len(smiles))
+        self.assertEqual([r['smiles'] for r in results], smiles)
+        self.assertAlmostEqual(results[0]['score'], 2.159, places=3)
+        self.assertIsNone(results[0]['error'])
+        self.assertIsNone(results[1]['score'])
+        self.assertEqual(results[1]['error'], 'Cannot parse smiles with rdkit.')
+
+        # Test empty list
+        response = self.post('/scscore/', json={'smiles': []})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'smiles': ['At least one smiles is required.']})
+
     def test_selectivity(self):
         """Test /selectivity endpoint"""
         data = {
@@ -1,7 +1,5 @@
-import io
-import json
+import csv
 
-import pandas as pd
 from bson import ObjectId
 from rdkit import Chem
 from rest_framework import serializers
@@ -11,9 +9,15 @@ from rest_framework.response import Response
 from rest_framework.viewsets import ViewSet
 from rest_framework_jwt.authentication import JSONWebTokenAuthentication
 
+from askcos_site.askcos_celery.buyables.buyables_worker import ingest_buyables_file, schedule_index_rebuild, store_upload
+from askcos_site.askcos_celery.buyables.fingerprint_index import check_index_path, get_index
+from askcos_site.askcos_celery.buyables.ingest import ingest_buyables, iter_buyables
 from askcos_site.globals import buyables_db
 from askcos_site.main.views.users import can_modify_buyables
 
+# Fail at startup instead of answering every search with 503 if the index directory is not shared
+check_index_path()
+
 
 class BuyableSerializer(serializers.Serializer):
     """Serializer for buyable attributes"""
@@ -36,6 +40,7 @@ class BuyableUploadSerializer(serializers.Serializer):
     format = serializers.CharField()
     returnLimit = serializers.IntegerField(default=1000)
     allowOverwrite = serializers.BooleanField(default=True)
+    run_async = serializers.BooleanField(default=False)
 
 
 class BuyableQuerySerializer(serializers.Serializer):
@@ -43,8 +48,10 @@ class BuyableQuerySerializer(serializers.Serializer):
     q = serializers.CharField(default='')
     source = serializers.CharField(default='')
     regex = serializers.BooleanField(default=False)
-    returnLimit = serializers.IntegerField(default=100)
+    returnLimit = serializers.IntegerField(default=100, min_value=1)
     canonicalize = serializers.BooleanField(default=True)
+    search_type = serializers.ChoiceField(choices=['exact', 'similarity', 'substructure'], default='exact')
+    min_similarity = serializers.FloatField(default=0.0, min_value=0.0, max_value=1.0)
 
 
 class BuyablesViewSet(ViewSet):
@@ -60,11 +67,17 @@ class BuyablesViewSet(ViewSet):
     - `regex` (bool): whether or not to treat `q` as regex pattern
     - `returnLimit` (int): maximum number of results to return
     - `canonicalize` (bool): whether or not to canonicalize `q`
+    - `search_type` (str): `exact` (default) to match the SMILES string,
+      `similarity` to find the most similar buyables by Tanimoto similarity
+      of Morgan fingerprints, or `substructure` to find buyables containing
+      `q` as a substructure (SMILES or SMARTS)
+    - `min_similarity` (float): minimum similarity for `similarity` searches
 
     Returns:
 
     - `search`: query pattern used for search
-    - `result`: list of buyables matching search query
+    - `result`: list of buyables matching search query, including
+      `similarity` for `similarity` searches
 
     Method: POST
 
@@ -116,6 +129,9 @@ class BuyablesViewSet(ViewSet):
         limit = data['returnLimit']
         canon = data['canonicalize']
 
+        if search and data['search_type'] != 'exact':
+            return self.fingerprint_search(search, data['search_type'], source, limit, data['min_similarity'])
+
         query = {}
         if search:
             if regex:
@@ -142,6 +158,42 @@ class BuyablesViewSet(ViewSet):
 
         return Response(resp)
 
+    def fingerprint_search(self, search, search_type, source, limit, min_similarity):
+        """Search buyables using the fingerprint index"""
+        resp = {'search': search, 'result': []}
+
+        if search_type == 'similarity':
+            mol = Chem.MolFromSmiles(search)
+        else:
+            mol = Chem.MolFromSmiles(search) or Chem.MolFromSmarts(search)
+        if not mol:
+            resp['error'] = 'Cannot parse query with rdkit'
+            return Response(resp, status=400)
+
+        index = get_index(request_rebuild=schedule_index_rebuild)
+        if index is None:
+            resp['error'] = 'The buyables search index is being built. Please try again later.'
+            return Response(resp, status=503)
+
+        if search_type == 'similarity':
+            hits = index.similarity_search(mol, limit=limit, min_similarity=min_similarity, source=source)
+        else:
+            hits = [(row, None) for row in index.substructure_search(mol, limit=limit, source=source)]
+
+        # Read current entries, since the index may not include recent changes
+        ids = index.get_ids([row for row, _ in hits])
+        docs = {doc['_id']: doc for doc in buyables_db.find({'_id': {'$in': ids}}, {'smiles': 1, 'ppg': 1, 'source': 1})}
+        for _id, (row, similarity) in zip(ids, hits):
+            doc = docs.get(_id)
+            if doc is None:
+                continue
+            doc['_id'] = str(doc['_id'])
+            if similarity is not None:
+                doc['similarity'] = similarity
+            resp['result'].append(doc)
+
+        return Response(resp)
+
     def retrieve(self, request, pk=None):
         """Return single buyables entry by mongo _id"""
         resp = {'error': None, 'result': None}
@@ -168,6 +220,7 @@ class BuyablesViewSet(ViewSet):
         if delete_result.deleted_count != 1:
             resp['error'] = 'Could not find buyable'
         else:
+            schedule_index_rebuild()
             resp['success'] = True
 
         return Response(resp)
@@ -221,16 +274,24 @@ class BuyablesViewSet(ViewSet):
         - `format` (str): file format, either json or csv
         - `returnLimit` (int): maximum number of results to return
         - `allowOverwrite` (bool): whether or not to overwrite existing duplicates
+        - `run_async` (bool): whether to import the file in a celery task
+
+        Entries are read incrementally and written to the database in bulk.
+        Large files should be imported with `run_async`, in which case only
+        `success` and `task_id` are returned, and the remaining fields are
+        the output of the celery task.
 
         Returns:
 
         - `success`: true if buyable was created successfully
+        - `task_id`: celery task ID if `run_async = True`
         - `error`: error message if not successful
         - `inserted`: list of new buyable entries, up to `returnLimit`
         - `updated`: list of updated buyable entries, up to `returnLimit`
         - `inserted_count`: total number of inserted entries
         - `updated_count`: total number of updated entries
         - `duplicate_count`: total number of duplicate entries if `allowOverwrite = False`
+        - `error_count`: total number of entries which could not be added
         - `count`: total number of successfully uploaded entries
         - `total`: total number of uploaded entries, including errors
         """
@@ -249,82 +310,58 @@ class BuyablesViewSet(ViewSet):
         return_limit = data['returnLimit']
         allow_overwrite = data['allowOverwrite']
 
-        try:
-            content = upload_file.read()
-        except Exception as e:
-            resp['error'] = 'Cannot read file: {0!s}'.format(e)
+        if file_format not in ('json', 'csv'):
+            resp['error'] = 'File format not supported!'
             return Response(resp)
 
-        if file_format == 'json':
-            try:
-                upload_json = json.loads(content.decode('utf-8'))
-            except json.JSONDecodeError:
-                resp['error'] = 'Cannot parse json!'
-                return Response(resp)
-        elif file_format == 'csv':
-            try:
-                df = pd.read_csv(io.StringIO(content.decode('utf-8')))
-                upload_json = df.to_dict(orient='records')
-            except Exception as e:
-                resp['error'] = 'Cannot parse csv: {0!s}'.format(e)
-                return Response(resp)
-        else:
-            resp['error'] = 'File format not supported!'
+        if data['run_async']:
+            file_id = store_upload(buyables_db.database, upload_file, filename=upload_file.name)
+            result = ingest_buyables_file.delay(
+                file_id, file_format, allow_overwrite=allow_overwrite, return_limit=return_limit
+            )
+            resp['success'] = True
+            resp['task_id'] = result.id
             return Response(resp)
 
-        if not isinstance(upload_json, list) or len(upload_json) == 0 or not isinstance(upload_json[0], dict):
-            resp['error'] = 'Improperly formatted json!'
+        try:
+            result = ingest_buyables(
+                buyables_db,
+                iter_buyables(upload_file, file_format),
+                allow_overwrite=allow_overwrite,
+                return_limit=return_limit,
+            )
+        except (ValueError, csv.Error) as e:
+            # Entries before the error may have been added
+            schedule_index_rebuild()
+            resp['error'] = 'Cannot parse {0}: {1!s}'.format(file_format, e)
             return Response(resp)
 
-        data_serializer = BuyableSerializer(data=upload_json, many=True)
-        data_serializer.is_valid(raise_exception=True)
-        buyables_data = data_serializer.validated_data
+        if result['inserted_count'] or result['updated_count']:
+            schedule_index_rebuild()
 
-        result = self.add_buyable_list_to_db(buyables_data, allow_overwrite=allow_overwrite)
+        if result['total'] == 0:
+            resp['error'] = 'No buyables found in file!'
+            return Response(resp)
 
         if result.get('error'):
             resp['error'] = result['error']
 
         resp['success'] = True
-        resp['inserted'] = result['inserted'][:return_limit]
-        resp['updated'] = result['updated'][:return_limit]
+        resp['inserted'] = result['inserted']
+        resp['updated'] = result['updated']
         resp['inserted_count'] = result['inserted_count']
         resp['updated_count'] = result['updated_count']
         resp['duplicate_count'] = result['duplicate_count']
+        resp['error_count'] = result['error_count']
         resp['count'] = result['count']
         resp['total'] = result['total']
 
         return Response(resp)
 
     def add_buyable_list_to_db(self, buyable_list, allow_overwrite=True):
-        """Add list of buyable compounds to the database"""
-        result = {
-            'error': None,
-            'count': 0,
-            'inserted': [],
-            'updated': [],
-            'inserted_count': 0,
-            'updated_count': 0,
-            'duplicate_count': 0,
-            'total': len(buyable_list)
-        }
-
-        for buyable in buyable_list:
-            res = self.add_buyable_to_db(buyable, allow_overwrite=allow_overwrite)
-            if not res['error']:
-                if res.get('duplicate'):
-                    result['duplicate_count'] += 1
-                if res.get('inserted'):
-                    result['inserted'].append(res['inserted'])
-                    result['inserted_count'] += 1
-                if res.get('updated'):
-                    result['updated'].append(res['updated'])
-                    result['updated_count'] += 1
-                result['count'] += 1
-            else:
-                result['error'] = res['error']
-
-        return result
+        """Add list of buyable compounds to the database using bulk writes"""
+        return ingest_buyables(buyables_db, buyable_list, allow_overwrite=allow_overwrite,
+                               return_limit=len(buyable_list))
 
     def add_buyable_to_db(self, buyable, allow_overwrite=True):
         """Add a single buyable compound to the database"""
@@ -348,6 +385,7 @@ class BuyablesViewSet(ViewSet):
             )
             new_doc['_id'] = str(existing_doc['_id'])
             result['updated'] = new_doc
+            schedule_index_rebuild()
         elif existing_doc and not allow_overwrite:
             result['duplicate'] = True
         else:
@@ -357,5 +395,6 @@ class BuyablesViewSet(ViewSet):
                 return result
             new_doc['_id'] = str(new_doc['_id'])
             result['inserted'] = new_doc
+            schedule_index_rebuild()
 
         return result
@@ -1,10 +1,146 @@
-from celery.result import AsyncResult
+import json
+import os
+import time
+
+from celery.result import AsyncResult, EagerResult
+from django.http import StreamingHttpResponse
 from rest_framework.exceptions import APIException
 from rest_framework.generics import GenericAPIView
+from rest_framework.renderers import BaseRenderer
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.viewsets import GenericViewSet
 
+from askcos_site.askcos_celery.cache import get_cache_stats
+from askcos_site.askcos_celery.scheduling import get_queue_wait_stats
+from askcos_site.askcos_celery.worker_status import get_worker_status, summarize_queues
 from askcos_site.celery import app, READABLE_NAMES
+from askcos_site.globals import get_load_profile
+
+TASK_MAX_WAIT = float(os.environ.get('TASK_MAX_WAIT', 10))
+TASK_POLL_INTERVAL = float(os.environ.get('TASK_POLL_INTERVAL', 0.5))
+TASK_STREAM_DURATION = float(os.environ.get('TASK_STREAM_DURATION', 60))
+TASK_STREAM_KEEPALIVE = float(os.environ.get('TASK_STREAM_KEEPALIVE', 15))
+
+
+class TaskWatcher(object):
+    """
+    Waits for state and progress updates of a celery task.
+
+    The redis result backend publishes every update of a task on the channel
+    of the task result key, so the watcher subscribes to that channel and
+    wakes up as soon as the task is updated. For other result backends, or
+    if subscribing fails, the watcher falls back to polling every
+    ``TASK_POLL_INTERVAL`` seconds.
+    """
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.pubsub = None
+        client = getattr(app.backend, 'client', None)
+        if client is not None:
+            try:
+                self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+                self.pubsub.subscribe(app.backend.get_key_for_task(task_id))
+            except Exception as e:
+                print('Could not subscribe to updates of task {}: {}'.format(task_id, e))
+                self.close()
+
+    def wait(self, timeout):
+        """
+        Waits until the task may have been updated, or for ``timeout`` seconds.
+
+        Returns:
+            bool: False if the timeout expired without an update
+        """
+        if self.pubsub is None:
+            time.sleep(min(timeout, TASK_POLL_INTERVAL))
+            return True
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                if self.pubsub.get_message(timeout=remaining) is not None:
+                    return True
+            except Exception as e:
+                print('Lost subscription to updates of task {}: {}'.format(self.task_id, e))
+                self.close()
+                return True
+
+    def close(self):
+        if self.pubsub is not None:
+            try:
+                self.pubsub.close()
+            except Exception:
+                pass
+            self.pubsub = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def get_task_status(result):
+    """
+    Returns the status of a celery task, with its output if it is complete.
+
+    Returns:
+        dict: task status, see ``CeleryTaskViewSet``
+        int: HTTP status code
+    """
+    resp = {}
+    state = result.state
+
+    try:
+        info = result.info
+        resp['percent'] = info.get('percent')
+        resp['message'] = info.get('message')
+    except AttributeError:
+        # info is weird, unsure how to handle it
+        pass
+
+    if state == 'running' or state == 'PENDING':
+        resp['complete'] = False
+    elif state == 'failed' or state == 'FAILURE':
+        resp['complete'] = False
+        resp['failed'] = True
+    else:
+        resp['state'] = state
+        resp['complete'] = True
+        resp['percent'] = 1
+        resp['message'] = 'Task complete!'
+        try:
+            output = result.get(10)  # should not take very long to get results of a completed task
+        except Exception as e:
+            resp['error'] = str(e)
+            result.revoke()
+            return resp, 400
+
+        resp['output'] = output
+
+    return resp, 200
+
+
+def is_finished(resp):
+    return resp.get('complete') or resp.get('failed') or 'error' in resp
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Renders error responses of the task event stream as a single server-sent event."""
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return format_event('status', data).encode('utf-8')
+
+
+def format_event(event, data):
+    """Formats a server-sent event with JSON data."""
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data, cls=JSONEncoder))
 
 
 class CeleryTaskViewSet(GenericViewSet):
@@ -15,6 +151,27 @@ class CeleryTaskViewSet(GenericViewSet):
 
     Method: GET
 
+    Parameters:
+
+    - `wait` (float, optional): if the task is not finished, wait up to this
+      many seconds (at most ``TASK_MAX_WAIT``, 10 by default) for its state
+      or progress to change before responding
+    - `stream` (bool, optional): respond with a stream of server-sent
+      `status` events, one for every change of state or progress, which ends
+      when the task is finished or after ``TASK_STREAM_DURATION`` seconds.
+      Also used if the request accepts `text/event-stream`, e.g. from
+      `EventSource`.
+
+    The site is served by synchronous uWSGI workers, so a waiting request
+    holds a worker thread for up to `wait` seconds, and a stream holds one
+    for its whole duration. The web UI waits 5 seconds per request and sends
+    the next request as soon as one is answered, so it sees a finished task
+    right away, and each client polling a running task holds a worker almost
+    all the time. It only backs off, up to 8 seconds between requests, if
+    requests are answered early without a change. Workers (processes times
+    threads) should be sized for the number of clients waiting at the same
+    time, in addition to other requests.
+
     Returns:
 
     - `complete`: boolean indicating whether job is complete
@@ -30,6 +187,8 @@ class CeleryTaskViewSet(GenericViewSet):
         """Default behavior for GET request. Not supported."""
         return Response({'detail': 'Celery task list view not supported.'}, status=405)
 
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [EventStreamRenderer]
+
     def retrieve(self, request, pk):
         """
         Get the status and result of a single celery task by task_id.
@@ -41,36 +200,58 @@ class CeleryTaskViewSet(GenericViewSet):
             resp['error'] = 'Cannot find task with task_id: {}'.format(pk)
             return Response(resp, status=400)
 
-        state = result.state
+        stream = request.query_params.get('stream') in ['True', 'true', '1']
+        if stream or request.accepted_renderer.media_type == EventStreamRenderer.media_type:
+            response = StreamingHttpResponse(self.stream_status(result), content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'  # Send events through nginx without buffering
+            return response
 
         try:
-            info = result.info
-            resp['percent'] = info.get('percent')
-            resp['message'] = info.get('message')
-        except AttributeError:
-            # info is weird, unsure how to handle it
-            pass
-
-        if state == 'running' or state == 'PENDING':
-            resp['complete'] = False
-        elif state == 'failed' or state == 'FAILURE':
-            resp['complete'] = False
-            resp['failed'] = True
-        else:
-            resp['state'] = state
-            resp['complete'] = True
-            resp['percent'] = 1
-            resp['message'] = 'Task complete!'
-            try:
-                output = result.get(10)  # should not take very long to get results of a completed task
-            except Exception as e:
-                resp['error'] = str(e)
-                result.revoke()
-                return Response(resp, status=400)
-
-            resp['output'] = output
+            wait = min(float(request.query_params.get('wait', 0)), TASK_MAX_WAIT)
+        except ValueError:
+            return Response({'error': 'wait should be a number of seconds.'}, status=400)
+
+        resp, status = get_task_status(result)
+        if wait > 0 and not is_finished(resp):
+            deadline = time.time() + wait
+            with TaskWatcher(pk) as watcher:
+                while time.time() < deadline:
+                    if not watcher.wait(deadline - time.time()):
+                        break
+                    new_resp, status = get_task_status(result)
+                    if new_resp != resp:
+                        resp = new_resp
+                        break
+
+        return Response(resp, status=status)
+
+    @staticmethod
+    def stream_status(result):
+        """
+        Yields server-sent events with the status of a task whenever it changes.
 
-        return Response(resp)
+        The stream ends when the task is finished, or after
+        ``TASK_STREAM_DURATION`` seconds, after which ``EventSource`` clients
+        reconnect automatically.
+        """
+        deadline = time.time() + TASK_STREAM_DURATION
+        yield 'retry: 1000\n\n'
+        with TaskWatcher(result.id) as watcher:
+            resp, _ = get_task_status(result)
+            yield format_event('status', resp)
+            last_sent = time.time()
+            while not is_finished(resp) and time.time() < deadline:
+                watcher.wait(min(TASK_STREAM_KEEPALIVE, deadline - time.time()))
+                new_resp, _ = get_task_status(result)
+                if new_resp != resp:
+                    resp = new_resp
+                    yield format_event('status', resp)
+                    last_sent = time.time()
+                elif time.time() - last_sent >= TASK_STREAM_KEEPALIVE:
+                    # Comment line to keep the connection open through proxies
+                    yield ': keepalive\n\n'
+                    last_sent = time.time()
 
 
 class CeleryTaskAPIView(GenericAPIView):
@@ -84,6 +265,8 @@ class CeleryTaskAPIView(GenericAPIView):
     Returns:
 
     - `task_id`: celery task ID
+    - `cached`: true if the result was available without running a task
+    - `output`: task output, only included if `cached` is true
     """
 
     def post(self, request):
@@ -101,12 +284,18 @@ class CeleryTaskAPIView(GenericAPIView):
             return Response(resp, status=e.status_code)
 
         resp = {'request': data, 'task_id': result.id}
+        if isinstance(result, EagerResult):
+            resp['cached'] = True
+            resp['output'] = result.result
 
         return Response(resp)
 
     def execute(self, request, data):
         """
         Execute the celery task and return a celery result object.
+
+        Child classes may instead return a ``celery.result.EagerResult``
+        if the output is already known, e.g. from a cache.
         """
         raise NotImplementedError('Should be implemented by child class.')
 
@@ -115,51 +304,35 @@ class CeleryStatusAPIView(GenericAPIView):
     """
     API endpoint for retrieving celery worker status.
 
+    Worker status is read from a snapshot which is kept up to date by
+    ``askcos_site.askcos_celery.worker_status``.
+
     Method: GET
 
     Returns:
 
     - `queues`: list of worker information for each celery queue
+    - `caches`: hit/miss statistics for worker caches
+    - `queue_wait`: recent queue wait times in seconds for each scheduling lane
+    - `updated`: time when worker information was last updated, as a unix timestamp
+    - `age`: age of worker information in seconds
+    - `load_profile`: uptime, peak memory and load time of each global of
+      the web process serving the request, see ``globals.get_load_profile``
     """
 
     def get(self, request, *args, **kwargs):
         """
-        Handle GET requests for scscore prediction.
+        Handle GET requests for celery worker status.
         """
         resp = {}
-        status = {}
-        stats = app.control.inspect().stats()
-        active = app.control.inspect().active()
-
-        if not stats or not active:
-            return Response(resp)
-
-        for worker in stats:
-            name, server = worker.split('@')
-            if not status.get(name):
-                status[name] = {'total': 0, 'busy': 0}
-            status[name]['busy'] += len(active[worker])
-            status[name]['total'] += stats[worker]['pool']['max-concurrency']
-
-        status_list = []
-        for key, value in status.items():
-            status_list.append({
-                'name': READABLE_NAMES.get(key, key),
-                'queue': key,
-                'busy': value['busy'],
-                'available': max(value['total'] - value['busy'], 0)
-            })
-
-        for key, value in READABLE_NAMES.items():
-            if key not in status:
-                status_list.append({
-                    'name': value,
-                    'queue': key,
-                    'busy': 0,
-                    'available': 0
-                })
-
-        resp['queues'] = sorted(status_list, key=lambda x: x['name'])
+        snapshot = get_worker_status(app)
+
+        resp['queues'] = summarize_queues(snapshot, READABLE_NAMES)
+        resp['caches'] = get_cache_stats()
+        resp['queue_wait'] = get_queue_wait_stats()
+        resp['updated'] = snapshot['updated']
+        resp['age'] = max(time.time() - snapshot['updated'], 0)
+        resp['load_profile'] = get_load_profile()
 
         return Response(resp)
 
@@ -1,3 +1,5 @@
+import base64
+import os
 import re
 
 from django.http import HttpResponse
@@ -10,6 +12,19 @@ from askcos.utilities.io.draw import TransformStringToImage
 from askcos.utilities.io.draw import ReactionStringToImage
 from askcos.utilities.io.draw import MappedReactionToHightlightImage
 from askcos.utilities.io.draw import MolsSmilesToImageHighlight
+from askcos_site.main.draw_cache import cached_drawing, get_cached_drawing, get_drawing_key, set_cached_drawing
+from askcos_site.process_pool import LazyProcessPool
+
+DRAW_BATCH_MAX = int(os.environ.get('DRAW_BATCH_MAX', 1000))
+DRAW_PROCESSES = int(os.environ.get('DRAW_PROCESSES', 2))  # per web server process
+DRAW_POOL_MIN_BATCH = 8  # smaller batches are drawn in the request thread
+
+_pool = LazyProcessPool(DRAW_PROCESSES, 'draw')
+
+
+def get_pool():
+    """Returns the process pool used to draw batches, or None if it cannot be used."""
+    return _pool.get()
 
 
 class DrawerSerializer(serializers.Serializer):
@@ -25,6 +40,20 @@ class DrawerSerializer(serializers.Serializer):
         """Check that input type is accepted value."""
         if value not in ['chemical', 'reaction', 'template']:
             raise serializers.ValidationError("Valid input types: ['chemical', 'reaction', 'template']")
+        return value
+
+
+class DrawerBatchSerializer(serializers.Serializer):
+    """Serializer for batch drawing parameters."""
+    structures = DrawerSerializer(many=True)
+
+    def validate_structures(self, value):
+        """Check the number of structures."""
+        if not value:
+            raise serializers.ValidationError('At least one structure is required.')
+        if len(value) > DRAW_BATCH_MAX:
+            raise serializers.ValidationError('At most {} structures can be drawn per request.'.format(DRAW_BATCH_MAX))
+        return value
 
 
 class DrawerAPIView(GenericAPIView):
@@ -37,6 +66,8 @@ class DrawerAPIView(GenericAPIView):
       for simple linking, while POST requests are better for complex data.
     - If `input_type` is not specified, will attempt to determine type.
       Specifying `input_type` can provide faster results.
+    - Drawings are cached, and responses have a strong ETag and a long
+      Cache-Control max-age, see `askcos_site.main.draw_cache`.
 
     Method: GET, POST
 
@@ -61,7 +92,7 @@ class DrawerAPIView(GenericAPIView):
         serializer = self.get_serializer(data=request.query_params)
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
-        return draw(data)
+        return cached_draw(request, data)
 
     def post(self, request):
         """
@@ -70,7 +101,95 @@ class DrawerAPIView(GenericAPIView):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
-        return draw(data)
+        return cached_draw(request, data)
+
+
+class DrawerBatchAPIView(GenericAPIView):
+    """
+    API endpoint for drawing many molecules, reactions, and templates at once.
+
+    Notes:
+
+    - Structures which are not cached are drawn in a process pool.
+    - Results are in the same order as the requested structures.
+
+    Method: POST
+
+    Parameters:
+
+    - `structures` (list): drawing parameters of each structure, as
+      accepted by the drawing endpoint
+
+    Returns:
+
+    - `results`: list of `image` (data URI of the PNG or SVG image) and
+      `error` for each structure. Structures which cannot be drawn have a
+      null image and an error message.
+    """
+
+    serializer_class = DrawerBatchSerializer
+
+    def post(self, request):
+        """
+        Handle POST request for batch drawing.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        structures = serializer.validated_data['structures']
+
+        keys = [get_drawing_key_for(data) for data in structures]
+        drawings = [get_cached_drawing(key) for key in keys]
+        missing = [i for i, drawing in enumerate(drawings) if drawing is None]
+
+        pool = get_pool() if len(missing) >= DRAW_POOL_MIN_BATCH else None
+        map_func = pool.map if pool is not None else map
+        for i, (content_type, content) in zip(missing, map_func(render_drawing, [structures[i] for i in missing])):
+            if content is not None:
+                set_cached_drawing(keys[i], content_type, content)
+                drawings[i] = (content_type, content)
+
+        results = []
+        for drawing in drawings:
+            if drawing is None:
+                results.append({'image': None, 'error': 'Could not draw requested structure.'})
+            else:
+                content_type, content = drawing
+                image = 'data:{};base64,{}'.format(content_type, base64.b64encode(content).decode('ascii'))
+                results.append({'image': image, 'error': None})
+
+        return Response({'request': {'count': len(structures)}, 'results': results})
+
+
+def get_drawing_key_for(data):
+    """
+    Return drawing cache key for validated drawing parameters.
+    """
+    return get_drawing_key(
+        'api2',
+        data.get('smiles'),
+        data.get('input_type'),
+        data.get('transparent'),
+        data.get('draw_map'),
+        data.get('highlight'),
+        data.get('reacting_atoms'),
+    )
+
+
+def cached_draw(request, data):
+    """
+    Return HttpResponse with cached PNG of requested structure, drawing it if necessary.
+    """
+    return cached_drawing(request, get_drawing_key_for(data), lambda: draw(data))
+
+
+def render_drawing(data):
+    """
+    Return content type and image data of requested structure, or None and None if it cannot be drawn.
+    """
+    response = draw(data)
+    if response.status_code != 200:
+        return None, None
+    return response['Content-Type'], response.content
 
 
 def draw(data):
@@ -133,7 +252,7 @@ def draw_template(data):
     Returns HttpResponse containing PNG of reaction SMARTS.
     """
     template = data.get('smiles')
-    response = HttpResponse(content_type='image/jpeg')
+    response = HttpResponse(content_type='image/png')
     TransformStringToImage(template).save(response, 'png', quality=70)
     return response
 
@@ -145,7 +264,7 @@ def draw_reaction(data):
     smiles = data.get('smiles')
     strip = not data.get('draw_map')
     highlight = data.get('highlight')
-    response = HttpResponse(content_type='image/jpeg')
+    response = HttpResponse(content_type='image/png')
     if highlight:
         MappedReactionToHightlightImage(smiles, highlightByReactant=True).save(response, 'png', quality=70)
     else:
@@ -154,3 +273,4 @@ def draw_reaction(data):
 
 
 drawer = DrawerAPIView.as_view()
+batch_drawer = DrawerBatchAPIView.as_view()
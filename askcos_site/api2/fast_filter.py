@@ -1,6 +1,7 @@
 from rdkit import Chem
 from rest_framework import serializers
 
+from askcos_site.askcos_celery.scheduling import get_lane_options
 from askcos_site.askcos_celery.treebuilder.tb_c_worker import fast_filter_check
 from .celery import CeleryTaskAPIView
 
@@ -45,7 +46,9 @@ class FastFilterAPIView(CeleryTaskAPIView):
         """
         Execute fast filter task and return celery result object.
         """
-        result = fast_filter_check.delay(data['reactants'], data['products'])
+        result = fast_filter_check.apply_async(
+            args=(data['reactants'], data['products']), **get_lane_options('interactive')
+        )
         return result
 
 
@@ -1,30 +1,85 @@
+import base64
+import itertools
+import json
+import os
+
+from django.http import StreamingHttpResponse
+from pymongo.errors import PyMongoError
 from rest_framework import serializers
 from rest_framework.generics import GenericAPIView
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 
 from askcos_site.globals import reaction_db
 
+REACTIONS_BATCH_SIZE = int(os.environ.get('REACTIONS_BATCH_SIZE', 100))
+REACTIONS_MAX_LIMIT = int(os.environ.get('REACTIONS_MAX_LIMIT', 1000))
+
+
+def encode_cursor(offset):
+    """Encodes the offset of the next page in the sorted ids as an opaque cursor."""
+    return base64.urlsafe_b64encode(str(offset).encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor from ``encode_cursor``.
+
+    Raises:
+        ValueError: if the cursor is invalid
+    """
+    try:
+        offset = int(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii'))
+    except (TypeError, UnicodeError, ValueError) as e:
+        raise ValueError('Invalid cursor: {}'.format(e))
+    if offset < 0:
+        raise ValueError('Invalid cursor: negative offset')
+    return offset
+
 
 class ReactionsSerializer(serializers.Serializer):
     """Serializer for reaction lookup parameters."""
     ids = serializers.ListField(child=serializers.CharField())
     template_set = serializers.CharField(required=False)
+    fields = serializers.ListField(child=serializers.CharField(), required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=REACTIONS_MAX_LIMIT, required=False)
+    cursor = serializers.CharField(required=False)
+
+    def validate_cursor(self, value):
+        """Verify that the cursor can be decoded."""
+        try:
+            return decode_cursor(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
 
 
 class ReactionsAPIView(GenericAPIView):
     """
     API endpoint for reaction lookup task.
 
+    Notes:
+
+    - Reactions are streamed as they are read from the database.
+    - If `limit` is specified, reactions are returned for at most `limit` of
+      the ids, in the sorted order of the unique ids, and `next_cursor` can be
+      passed as `cursor` with the same ids to retrieve the next page.
+    - If reading from the database fails after the response started, `error`
+      describes the failure and the page should be requested again.
+
     Method: POST
 
     Parameters:
 
     - `ids` (list): list of reaction ids to retrieve
     - `template_set` (str, optional): template set to search within
+    - `fields` (list, optional): fields of each reaction to return, `_id` is always returned
+    - `limit` (int, optional): maximum number of ids to look up
+    - `cursor` (str, optional): `next_cursor` from the previous page
 
     Returns:
 
     - `reactions`: list of reactions
+    - `next_cursor`: cursor of the next page, or null if there are no more ids
+    - `error`: error message if not all reactions could be read, otherwise null
     """
 
     serializer_class = ReactionsSerializer
@@ -37,14 +92,46 @@ class ReactionsAPIView(GenericAPIView):
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
 
-        query = {'reaction_id': {'$in': data['ids']}}
+        # Pages are taken from the sorted ids, so the database does not sort the reactions
+        ids = sorted(set(data['ids']))
+        start = data.get('cursor', 0)
+        end = start + data['limit'] if data.get('limit') else len(ids)
+        next_cursor = encode_cursor(end) if end < len(ids) else None
+
+        query = {'reaction_id': {'$in': ids[start:end]}}
         if 'template_set' in data:
             query['template_set'] = data['template_set']
-
-        reactions_by_ids = list(reaction_db.find(query))
-        resp = {'reactions': reactions_by_ids}
-
-        return Response(resp)
+        projection = {field: 1 for field in data['fields']} if data.get('fields') else None
+
+        cursor = reaction_db.find(query, projection).batch_size(REACTIONS_BATCH_SIZE)
+        try:
+            # Read the first batch before streaming, so query errors get an error status
+            first = list(itertools.islice(cursor, 1))
+        except PyMongoError as e:
+            cursor.close()
+            return Response({'error': 'Could not look up reactions: {}'.format(e)}, status=500)
+
+        return StreamingHttpResponse(self.stream_reactions(cursor, first, next_cursor), content_type='application/json')
+
+    @staticmethod
+    def stream_reactions(cursor, first, next_cursor=None):
+        """Yields a JSON response with the reactions read from a database cursor, one batch at a time."""
+        encoder = JSONEncoder()
+        yield '{"reactions": ['
+        buffer = []
+        error = None
+        try:
+            for count, doc in enumerate(itertools.chain(first, cursor)):
+                buffer.append(('' if count == 0 else ', ') + encoder.encode(doc))
+                if len(buffer) >= REACTIONS_BATCH_SIZE:
+                    yield ''.join(buffer)
+                    buffer = []
+        except PyMongoError as e:
+            # The response status was already sent, so the error is reported in the response
+            error = 'Could not look up reactions: {}'.format(e)
+        finally:
+            cursor.close()
+        yield ''.join(buffer) + '], "next_cursor": {}, "error": {}}}'.format(json.dumps(next_cursor), json.dumps(error))
 
 
 reactions = ReactionsAPIView.as_view()
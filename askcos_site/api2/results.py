@@ -1,12 +1,30 @@
+from django.utils.decorators import method_decorator
+from django.views.decorators.gzip import gzip_page
+from rest_framework import serializers
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.viewsets import ViewSet
 
-from askcos_site.globals import db_client
+from askcos_site.askcos_celery.treebuilder.result_store import PATH_SORT_KEYS, delete_result, load_result
+from askcos_site.globals import results_collection
 from askcos_site.main.models import SavedResults
 
-results_collection = db_client['results']['results']
+
+SORT_CHOICES = list(PATH_SORT_KEYS) + ['-' + key for key in PATH_SORT_KEYS]
+
+
+class ResultQuerySerializer(serializers.Serializer):
+    """Serializer for partial result retrieval parameters."""
+    start = serializers.IntegerField(min_value=0, required=False)
+    count = serializers.IntegerField(min_value=0, required=False)
+    sort = serializers.ChoiceField(choices=SORT_CHOICES, required=False)
+    root = serializers.CharField(required=False)
+    depth = serializers.IntegerField(min_value=0, default=1)
+
+    def is_partial(self):
+        """Whether only part of the result was requested."""
+        return any(field in self.validated_data for field in ['start', 'count', 'sort', 'root'])
 
 
 class ResultsViewSet(ViewSet):
@@ -24,10 +42,24 @@ class ResultsViewSet(ViewSet):
 
     Method: GET
 
+    Parameters (optional, the entire result is returned if none are given):
+
+    - `start` (int): index of the first path to return, in sorted order
+    - `count` (int): number of paths to return, all remaining paths by default
+    - `sort` (str): one of `index`, `depth`, `num_reactions`, `plausibility`
+      or `price`, prefixed with `-` for descending order
+    - `root` (str): SMILES of a chemical to return the neighborhood of in the graph
+    - `depth` (int): number of reaction steps from `root` to include, default 1
+
     Returns:
 
     - `id`: the requested result id
-    - `result`: the requested result
+    - `result`: the requested result, or if any parameters are given:
+        - `result.status`: tree status of the search
+        - `result.num_paths`: total number of paths
+        - `result.paths`: requested paths
+        - `result.path_indices`: original indices of the requested paths
+        - `result.graph`: subgraph around `root`, if specified
     - `error`: error message if encountered
 
     Method: DELETE
@@ -66,10 +98,14 @@ class ResultsViewSet(ViewSet):
 
         return Response(resp)
 
+    @method_decorator(gzip_page)
     def retrieve(self, request, pk):
         """Get a particular result instance."""
         resp = {'id': pk, 'result': None, 'error': None}
 
+        query = ResultQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+
         try:
             result = SavedResults.objects.get(user=request.user, result_id=pk)
         except SavedResults.DoesNotExist:
@@ -77,13 +113,39 @@ class ResultsViewSet(ViewSet):
             return Response(resp, status=404)
         else:
             if result.result_state == 'completed':
-                result_doc = results_collection.find_one({'_id': pk})
-                resp['result'] = result_doc
+                stored = load_result(results_collection, pk)
+                if stored is None:
+                    pass
+                elif query.is_partial():
+                    try:
+                        resp['result'] = self.get_partial_result(stored, query.validated_data)
+                    except KeyError:
+                        resp['error'] = 'Chemical not found in graph.'
+                        return Response(resp, status=400)
+                else:
+                    resp['result'] = stored.to_doc()
             else:
                 resp['error'] = 'Job not yet complete.'
 
         return Response(resp)
 
+    @staticmethod
+    def get_partial_result(stored, params):
+        """Returns the requested range of paths and part of the graph of a stored result."""
+        indices = stored.get_sorted_indices(params.get('sort', 'index'))
+        start = params.get('start', 0)
+        count = params.get('count')
+        indices = indices[start:] if count is None else indices[start:start + count]
+        partial = {
+            'status': stored.status,
+            'num_paths': stored.num_paths,
+            'paths': stored.get_paths(indices),
+            'path_indices': indices,
+        }
+        if 'root' in params:
+            partial['graph'] = stored.get_subgraph(params['root'], params['depth'])
+        return {'_id': stored.id, 'result': partial, 'settings': stored.settings}
+
     @action(detail=True, methods=['GET'])
     def check(self, request, pk):
         """Get status of a particular result instance."""
@@ -111,7 +173,7 @@ class ResultsViewSet(ViewSet):
         else:
             try:
                 result.delete()
-                results_collection.delete_one({'_id': pk})
+                delete_result(results_collection, pk)
             except:
                 resp['error'] = 'Could not delete result.'
 
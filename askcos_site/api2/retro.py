@@ -1,10 +1,19 @@
+from uuid import uuid4
+
 import requests
+from celery import states
+from celery.result import EagerResult
 from rdkit import Chem
 from rest_framework import serializers
 from rest_framework.generics import GenericAPIView
 from rest_framework.response import Response
 
-from askcos_site.askcos_celery.treebuilder.tb_c_worker import get_top_precursors
+from askcos_site.askcos_celery.cache import make_key
+from askcos_site.askcos_celery.scheduling import get_lane_options
+from askcos_site.askcos_celery.treebuilder.tb_c_worker import (
+    get_template_relevance_model, get_top_precursors, retro_result_cache,
+)
+from askcos_site.celery import app
 from askcos_site.main.utils import is_banned
 from .celery import CeleryTaskAPIView
 
@@ -26,6 +35,7 @@ class RetroSerializer(serializers.Serializer):
     cluster_fp_radius = serializers.IntegerField(default=1)
 
     selec_check = serializers.BooleanField(default=True)
+    use_cache = serializers.BooleanField(default=True)
 
     def validate_target(self, value):
         """Verify that the requested target is valid."""
@@ -62,10 +72,13 @@ class RetroAPIView(CeleryTaskAPIView):
     - `cluster_fp_length` (int, optional): fingerprint length for clustering
     - `cluster_fp_radius` (int, optional): fingerprint radius for clustering
     - `selec_check` (bool, optional): whether or not to check for potential selectivity issues
+    - `use_cache` (bool, optional): whether or not to return a cached result for an identical request
 
     Returns:
 
     - `task_id`: celery task ID
+    - `cached`: true if the result was retrieved from the cache
+    - `output`: cached result, only included if `cached` is true
     """
 
     serializer_class = RetroSerializer
@@ -90,26 +103,70 @@ class RetroAPIView(CeleryTaskAPIView):
 
         selec_check = data['selec_check']
 
-        result = get_top_precursors.delay(
-            target,
-            template_set=template_set,
-            template_prioritizer_version=template_prioritizer_version,
-            fast_filter_threshold=fast_filter_threshold,
-            max_cum_prob=max_cum_prob,
-            max_num_templates=max_num_templates,
-            cluster=cluster,
-            cluster_method=cluster_method,
-            cluster_feature=cluster_feature,
-            cluster_fp_type=cluster_fp_type,
-            cluster_fp_length=cluster_fp_length,
-            cluster_fp_radius=cluster_fp_radius,
-            selec_check=selec_check,
-            postprocess=True,
+        cache_key = get_cache_key(data)
+        if data['use_cache'] and cache_key is not None:
+            output = retro_result_cache.get((cache_key,))
+            if output is not None:
+                # Store as a finished task so the result is also available from the celery task endpoint
+                task_id = str(uuid4())
+                app.backend.store_result(task_id, output, states.SUCCESS)
+                return EagerResult(task_id, output, states.SUCCESS)
+
+        result = get_top_precursors.apply_async(
+            args=(target,),
+            kwargs={
+                'template_set': template_set,
+                'template_prioritizer_version': template_prioritizer_version,
+                'fast_filter_threshold': fast_filter_threshold,
+                'max_cum_prob': max_cum_prob,
+                'max_num_templates': max_num_templates,
+                'cluster': cluster,
+                'cluster_method': cluster_method,
+                'cluster_feature': cluster_feature,
+                'cluster_fp_type': cluster_fp_type,
+                'cluster_fp_length': cluster_fp_length,
+                'cluster_fp_radius': cluster_fp_radius,
+                'selec_check': selec_check,
+                'postprocess': True,
+                'cache_key': cache_key,
+            },
+            **get_lane_options('interactive')
         )
 
         return result
 
 
+def get_cache_key(data):
+    """
+    Return a hash of the canonical target and all task parameters for caching results.
+
+    If the latest template relevance model is requested, the key includes the
+    version served by tensorflow serving, so results of a previous model are
+    not reused after a rollout. Returns None if that version cannot be
+    determined, in which case results are not cached.
+    """
+    params = {k: v for k, v in data.items() if k not in ('target', 'use_cache')}
+    if not data['template_prioritizer_version']:
+        served_version = get_served_version(data['template_set'])
+        if served_version is None:
+            return None
+        params['served_version'] = served_version
+    mol = Chem.MolFromSmiles(data['target'])
+    target = Chem.MolToSmiles(mol, isomericSmiles=True) if mol else data['target']
+    return make_key('retro', target, params)
+
+
+def get_served_version(template_set):
+    """
+    Return the latest template relevance model version served for a template set, or None if it cannot be determined.
+    """
+    try:
+        return get_template_relevance_model(template_set).get_served_version()
+    except Exception as e:
+        print('Could not determine served template relevance model version: {}'.format(e))
+        return None
+
+
 class TFXRetroModels(GenericAPIView):
     """
     API endpoint for querying available retrosynthetic models for a given template set.
@@ -1,18 +1,111 @@
+import json
+import os
+
+import numpy as np
+from django.http import StreamingHttpResponse
 from rdkit import Chem
+from rdkit.Chem import AllChem
 from rest_framework import serializers
 from rest_framework.generics import GenericAPIView
 from rest_framework.response import Response
 
 from askcos_site.globals import scscorer
+from askcos_site.process_pool import LazyProcessPool
+
+SCSCORE_MAX_BATCH = int(os.environ.get('SCSCORE_MAX_BATCH', 100000))
+SCSCORE_CHUNK_SIZE = int(os.environ.get('SCSCORE_CHUNK_SIZE', 1000))
+SCSCORE_PROCESSES = int(os.environ.get('SCSCORE_PROCESSES', 2))  # per web server process
+SCSCORE_POOL_MIN_BATCH = 200  # smaller batches are fingerprinted in the request thread
+
+_pool = LazyProcessPool(SCSCORE_PROCESSES, 'scscore')
+
+
+def get_pool():
+    """Returns the process pool used to compute fingerprints, or None if it cannot be used."""
+    return _pool.get()
+
+
+def smiles_to_fp(smiles, fp_len=1024, fp_rad=2):
+    """Computes the SCScore fingerprint of a SMILES string.
+
+    Matches the boolean Morgan fingerprint used by the 1024bool SCScore model.
+
+    Returns:
+        (np.ndarray, str): packed fingerprint bits and None, or None and an error message
+    """
+    mol = Chem.MolFromSmiles(smiles)
+    if not mol:
+        return None, 'Cannot parse smiles with rdkit.'
+    fp = AllChem.GetMorganFingerprintAsBitVect(mol, fp_rad, nBits=fp_len, useChirality=True)
+    return np.packbits(np.array(fp, dtype=np.uint8)), None
+
+
+def score_smiles(smiles_list, chunk_size=SCSCORE_CHUNK_SIZE):
+    """Scores SMILES strings in chunks, evaluating the model once per chunk.
+
+    Yields:
+        dict: smiles, score and error for each SMILES string, in order
+    """
+    fp_len = getattr(scscorer, 'FP_len', 1024)
+    fp_rad = getattr(scscorer, 'FP_rad', 2)
+    pool = get_pool() if len(smiles_list) >= SCSCORE_POOL_MIN_BATCH else None
+
+    for start in range(0, len(smiles_list), chunk_size):
+        chunk = smiles_list[start:start + chunk_size]
+        args = (chunk, [fp_len] * len(chunk), [fp_rad] * len(chunk))
+        if pool is not None:
+            fps = list(pool.map(smiles_to_fp, *args, chunksize=max(len(chunk) // (4 * SCSCORE_PROCESSES), 1)))
+        else:
+            fps = list(map(smiles_to_fp, *args))
+
+        rows = [i for i, (fp, error) in enumerate(fps) if fp is not None]
+        scores = np.zeros(len(chunk))
+        if rows:
+            x = np.unpackbits(np.stack([fps[i][0] for i in rows]), axis=1)[:, :fp_len].astype(np.float32)
+            scores[rows] = np.asarray(scscorer.apply(x)).reshape(len(rows), -1)[:, 0]
+            # Molecules without any fingerprint bits are not scored, as in get_score_from_smiles
+            scores[rows] = np.where(x.any(axis=1), scores[rows], 0)
+
+        for smiles, (fp, error), score in zip(chunk, fps, scores):
+            yield {
+                'smiles': smiles,
+                'score': float(score) if error is None else None,
+                'error': error,
+            }
+
+
+class SmilesField(serializers.Field):
+    """Field accepting a SMILES string or a list of SMILES strings."""
+
+    def get_value(self, dictionary):
+        if hasattr(dictionary, 'getlist') and len(dictionary.getlist(self.field_name)) > 1:
+            return dictionary.getlist(self.field_name)
+        return super().get_value(dictionary)
+
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            return data
+        if isinstance(data, list) and all(isinstance(x, str) for x in data):
+            return data
+        raise serializers.ValidationError('Expected a SMILES string or a list of SMILES strings.')
+
+    def to_representation(self, value):
+        return value
 
 
 class SCScorerSerializer(serializers.Serializer):
     """Serializer for SCScorer parameters."""
-    smiles = serializers.CharField()
+    smiles = SmilesField()
 
     def validate_smiles(self, value):
         """Verify that the requested smiles is valid."""
-        if not Chem.MolFromSmiles(value):
+        if isinstance(value, list):
+            if not value:
+                raise serializers.ValidationError('At least one smiles is required.')
+            if len(value) > SCSCORE_MAX_BATCH:
+                raise serializers.ValidationError(
+                    'At most {} smiles can be scored per request.'.format(SCSCORE_MAX_BATCH))
+        elif not Chem.MolFromSmiles(value):
             raise serializers.ValidationError('Cannot parse smiles with rdkit.')
         return value
 
@@ -25,11 +118,15 @@ class SCScorerAPIView(GenericAPIView):
 
     Parameters:
 
-    - `smiles` (str): SMILES string of target
+    - `smiles` (str or list): SMILES string of target, or list of SMILES strings
 
     Returns:
 
-    - `output`: synthetic complexity score
+    - `score`: synthetic complexity score, for a single SMILES string
+    - `results`: list of `smiles`, `score` and `error` for each SMILES
+      string, in the requested order, for a list of SMILES strings. Results
+      are streamed as they are computed, and SMILES strings which cannot be
+      parsed have a null score and an error message.
     """
 
     serializer_class = SCScorerSerializer
@@ -42,6 +139,9 @@ class SCScorerAPIView(GenericAPIView):
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
 
+        if isinstance(data['smiles'], list):
+            return StreamingHttpResponse(self.stream_results(data), content_type='application/json')
+
         resp = {
             'request': data,
             'score': scscorer.get_score_from_smiles(data['smiles'], noprice=True),
@@ -49,5 +149,17 @@ class SCScorerAPIView(GenericAPIView):
 
         return Response(resp)
 
+    @staticmethod
+    def stream_results(data):
+        """Yields a JSON response with the scores of a list of SMILES strings, one chunk at a time."""
+        yield '{{"request": {}, "results": ['.format(json.dumps(data))
+        buffer = []
+        for i, result in enumerate(score_smiles(data['smiles'])):
+            buffer.append(('' if i == 0 else ', ') + json.dumps(result))
+            if len(buffer) >= SCSCORE_CHUNK_SIZE:
+                yield ''.join(buffer)
+                buffer = []
+        yield ''.join(buffer) + ']}'
+
 
 scscore = SCScorerAPIView.as_view()
@@ -0,0 +1,54 @@
+"""
+Throughput benchmark of the SCScore API of a live askcos site.
+
+Compares scoring a list of SMILES strings in one request, which computes
+fingerprints in the scscore process pool and evaluates the model once per
+chunk, with scoring the same molecules in single requests. Run with::
+
+    python askcos_site/api2/scscore_benchmark.py --url https://localhost/api/v2
+"""
+
+import argparse
+import time
+
+from requests import Session
+
+SMILES = ['CN(C)CCOC(c1ccccc1)c1ccccc1', 'CCO', 'c1ccc2ccccc2c1', 'CC(=O)Oc1ccccc1C(=O)O']
+
+
+def run_benchmark(url, batch_size=3000, single_count=50):
+    """Scores molecules with batch and single requests.
+
+    Returns:
+        dict: molecules per second for batch and single requests
+    """
+    client = Session()
+    client.verify = False
+    smiles = (SMILES * (batch_size // len(SMILES) + 1))[:batch_size]
+
+    start = time.time()
+    response = client.post(url + '/scscore/', json={'smiles': smiles})
+    response.raise_for_status()
+    batch_time = time.time() - start
+
+    start = time.time()
+    for s in smiles[:single_count]:
+        client.post(url + '/scscore/', data={'smiles': s}).raise_for_status()
+    single_time = time.time() - start
+
+    return {
+        'batch': batch_size / batch_time,
+        'single': single_count / single_time,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--url', default='https://localhost/api/v2', help='base url of the v2 API')
+    parser.add_argument('--batch-size', type=int, default=3000, help='number of SMILES strings in the batch request')
+    parser.add_argument('--single-count', type=int, default=50, help='number of single requests')
+    args = parser.parse_args()
+
+    result = run_benchmark(args.url, args.batch_size, args.single_count)
+    print('SCScore throughput: batch {:.0f} molecules/s, single requests {:.0f} molecules/s'.format(
+        result['batch'], result['single']))
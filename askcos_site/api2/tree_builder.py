@@ -4,6 +4,7 @@ from rest_framework import serializers
 from rest_framework.exceptions import NotAuthenticated
 
 from askcos_site.main.models import BlacklistedReactions, BlacklistedChemicals, SavedResults
+from askcos_site.askcos_celery.scheduling import get_fair_share_user
 from askcos_site.askcos_celery.treebuilder.tb_coordinator_mcts import get_buyable_paths as get_buyable_paths_mcts
 from askcos_site.main.utils import is_banned
 from .celery import CeleryTaskAPIView
@@ -36,6 +37,7 @@ class TreeBuilderSerializer(serializers.Serializer):
 
     store_results = serializers.BooleanField(default=False)
     description = serializers.CharField(default='')
+    reserve_workers = serializers.IntegerField(default=0, min_value=0)
 
     banned_reactions = serializers.ListField(child=serializers.CharField(), required=False)
     banned_chemicals = serializers.ListField(child=serializers.CharField(), required=False)
@@ -144,6 +146,7 @@ class TreeBuilderAPIView(CeleryTaskAPIView):
     - `return_first` (bool, optional): whether to return upon finding the first pathway
     - `store_results` (bool, optional): whether to permanently save this result
     - `description` (str, optional): description to associate with stored result
+    - `reserve_workers` (int, optional): number of worker pools to reserve for this search
     - `banned_reactions` (list, optional): list of reactions to not consider
     - `banned_chemicals` (list, optional): list of molecules to not consider
 
@@ -160,6 +163,8 @@ class TreeBuilderAPIView(CeleryTaskAPIView):
         """
         if data['store_results'] and not request.user.is_authenticated:
             raise NotAuthenticated('You must be authenticated to store tree builder results.')
+        if data['reserve_workers'] and not request.user.is_authenticated:
+            raise NotAuthenticated('You must be authenticated to reserve workers.')
 
         chemical_property_logic = data['chemical_property_logic']
         if chemical_property_logic != 'none':
@@ -212,7 +217,9 @@ class TreeBuilderAPIView(CeleryTaskAPIView):
             template_set=data['template_set'],
             return_first=data['return_first'],
             paths_only=True,
-            run_async=data['store_results']
+            run_async=data['store_results'],
+            reserve_workers=data['reserve_workers'],
+            user=get_fair_share_user(request),
         )
 
         if data['store_results']:
@@ -23,6 +23,7 @@ urlpatterns += [
     path('cluster/', api2.cluster.cluster, name='cluster_api'),
     path('context/', api2.context.neural_network, name='context_api'),
     path('draw/', api2.draw.drawer, name='draw_api'),
+    path('draw/batch/', api2.draw.batch_drawer, name='draw_batch_api'),
     path('fast-filter/', api2.fast_filter.fast_filter, name='fast_filter_api'),
     path('forward/', api2.forward.template_free, name='forward_api'),
     path('impurity/', api2.impurity.impurity_predict, name='impurity_api'),
@@ -0,0 +1,202 @@
+"""
+A worker to import buyables uploads into the database.
+
+Uploaded files are stored in GridFS by the web server, so that large
+catalogs are not sent through the message broker. The worker reads the file
+incrementally, canonicalizes SMILES strings in a process pool and writes
+them with bulk upserts, see ``ingest``. After an import which changed
+buyables, the price index used by pricers and, if buyables were added, the
+fingerprint index used for buyables search are rebuilt, so
+``BUYABLES_INDEX_PATH`` must be a directory shared with the web server, and
+the worker does not start without it. Edits through
+the API schedule a rebuild with ``schedule_index_rebuild`` instead, which
+runs ``BUYABLES_INDEX_REBUILD_DELAY`` seconds later in the worker, so a burst
+of edits causes a single rebuild and web processes never build the indexes.
+Since prefork
+pool processes cannot start a process pool of their own, the worker should
+be run with the solo pool, e.g. ``celery worker -Q buyables_worker -P solo``. Otherwise SMILES are
+canonicalized in the task process.
+"""
+
+import csv
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import gridfs
+import redis
+from bson import ObjectId
+from celery import shared_task
+from celery.signals import celeryd_init
+from pymongo import MongoClient
+
+import askcos.global_config as gc
+from ..cache import get_redis_client
+from .fingerprint_index import BUILD_LOCK_TIMEOUT, build_index, check_index_path
+from .ingest import BUYABLES_INGEST_BATCH_SIZE, ingest_buyables, iter_buyables
+from .price_index import build_price_index
+
+CORRESPONDING_QUEUE = 'buyables_worker'
+BUYABLES_INGEST_PROCESSES = int(os.environ.get('BUYABLES_INGEST_PROCESSES', os.cpu_count() or 1))
+UPLOADS_COLLECTION = 'buyables_uploads'
+BUYABLES_INDEX_REBUILD_DELAY = float(os.environ.get('BUYABLES_INDEX_REBUILD_DELAY', 60))
+REBUILD_SCHEDULED_KEY = 'askcos:buyables_index:rebuild_scheduled'
+
+buyables_collection = None
+uploads_fs = None
+
+
+def get_uploads_fs(database):
+    """Returns the GridFS bucket for buyables uploads in a database."""
+    return gridfs.GridFS(database, collection=UPLOADS_COLLECTION)
+
+
+def store_upload(database, fileobj, filename=None):
+    """Stores an uploaded file for ``ingest_buyables_file``.
+
+    Args:
+        database (pymongo.database.Database): buyables database
+        fileobj: file object with the upload content
+        filename (str, optional): original name of the file
+
+    Returns:
+        str: ID of the stored file
+    """
+    return str(get_uploads_fs(database).put(fileobj, filename=filename))
+
+
+def schedule_index_rebuild(delay=BUYABLES_INDEX_REBUILD_DELAY):
+    """Schedules a rebuild of the buyables indexes in the worker, unless one is already scheduled.
+
+    Changes made before the scheduled rebuild starts are included in it, so
+    calls within ``delay`` seconds of each other cause a single rebuild.
+
+    Args:
+        delay (float): seconds to wait before rebuilding
+    """
+    try:
+        # The key expires in case the scheduled task is lost
+        scheduled = not get_redis_client().set(REBUILD_SCHEDULED_KEY, 1, nx=True, ex=int(delay) + BUILD_LOCK_TIMEOUT)
+    except redis.RedisError as e:
+        print('Could not check for a scheduled buyables index rebuild: {}'.format(e))
+        scheduled = False
+    if not scheduled:
+        rebuild_buyables_indexes.apply_async(countdown=delay)
+
+
+@celeryd_init.connect
+def configure_worker(options={}, **kwargs):
+    """Connects to the buyables database.
+
+    Args:
+        options (dict, optional): Used to check if the queue is correct.
+            (default: {{}})
+        **kwargs: Unused.
+    """
+    if 'queues' not in options:
+        return
+    if CORRESPONDING_QUEUE not in options['queues'].split(','):
+        return
+    print('### STARTING UP A BUYABLES WORKER ###')
+    check_index_path()
+
+    global buyables_collection, uploads_fs
+    client = MongoClient(gc.MONGO['path'], gc.MONGO['id'], connect=gc.MONGO['connect'])
+    database = client[gc.BUYABLES['database']]
+    buyables_collection = database[gc.BUYABLES['collection']]
+    uploads_fs = get_uploads_fs(database)
+    try:
+        buyables_collection.create_index('smiles')
+    except Exception as e:
+        print('Could not create buyables smiles index: {}'.format(e))
+    print('### BUYABLES WORKER STARTED UP ###')
+
+
+def create_pool(processes=BUYABLES_INGEST_PROCESSES):
+    """Returns a process pool for canonicalization, or None if processes cannot be started here."""
+    if processes <= 1:
+        return None
+    pool = ProcessPoolExecutor(max_workers=processes)
+    try:
+        pool.submit(int, 0).result()
+    except (AssertionError, OSError) as e:
+        # e.g. daemonic prefork pool processes are not allowed to have children
+        print('Canonicalizing buyables without a process pool: {}'.format(e))
+        pool.shutdown(wait=False)
+        return None
+    return pool
+
+
+@shared_task(bind=True)
+def ingest_buyables_file(self, file_id, file_format, allow_overwrite=True, return_limit=1000, require_price=False):
+    """Adds the buyables in an uploaded file to the database.
+
+    Progress is reported as the number of entries processed so far.
+
+    Args:
+        file_id (str): GridFS ID of the file stored by ``store_upload``
+        file_format (str): 'csv' or 'json'
+        allow_overwrite (bool): whether to update existing entries
+        return_limit (int): maximum number of inserted and updated documents to return
+        require_price (bool): whether a price of zero is an error
+
+    Returns:
+        dict: inserted and updated documents and counts, see ``ingest.ingest_buyables``
+    """
+    upload = uploads_fs.get(ObjectId(file_id))
+    size = upload.length
+
+    def progress(total):
+        percent = min(upload.tell() / size, 1) if size else 1
+        self.update_state(state='running', meta={
+            'percent': percent, 'message': 'Processed {} entries'.format(total)
+        })
+
+    pool = create_pool()
+    map_func = map
+    if pool is not None:
+        chunksize = max(BUYABLES_INGEST_BATCH_SIZE // (4 * BUYABLES_INGEST_PROCESSES), 1)
+        map_func = functools.partial(pool.map, chunksize=chunksize)
+    try:
+        result = ingest_buyables(
+            buyables_collection,
+            iter_buyables(upload, file_format),
+            allow_overwrite=allow_overwrite,
+            return_limit=return_limit,
+            map_func=map_func,
+            require_price=require_price,
+            progress=progress,
+        )
+        if result['inserted_count'] or result['updated_count']:
+            self.update_state(state='running', meta={'percent': 1, 'message': 'Rebuilding buyables index'})
+            try:
+                build_price_index(buyables_collection)
+                if result['inserted_count']:
+                    build_index(buyables_collection, map_func=map_func)
+            except Exception as e:
+                print('Could not rebuild buyables index: {}'.format(e))
+    except (ValueError, csv.Error) as e:
+        result = {'error': 'Cannot parse {}: {!s}'.format(file_format, e)}
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        uploads_fs.delete(ObjectId(file_id))
+    return result
+
+
+@shared_task
+def rebuild_buyables_indexes():
+    """Rebuilds the price and fingerprint indexes of the buyables collection."""
+    try:
+        # Changes after this point schedule another rebuild
+        get_redis_client().delete(REBUILD_SCHEDULED_KEY)
+    except redis.RedisError as e:
+        print('Could not clear scheduled buyables index rebuild: {}'.format(e))
+    pool = create_pool()
+    map_func = map if pool is None else functools.partial(pool.map, chunksize=256)
+    try:
+        build_price_index(buyables_collection)
+        build_index(buyables_collection, map_func=map_func)
+    finally:
+        if pool is not None:
+            pool.shutdown()
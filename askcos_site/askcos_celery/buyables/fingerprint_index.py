@@ -0,0 +1,308 @@
+"""
+Fingerprint index for similarity and substructure search over buyables.
+
+The index stores bit-packed Morgan fingerprints (for Tanimoto similarity)
+and RDKit pattern fingerprints (for substructure screening) of all buyables
+as NumPy arrays on disk, which are memory-mapped by every process using the
+index. Rows are sorted by the number of bits set in the Morgan fingerprint,
+so similarity searches with a threshold only scan rows whose bit count can
+reach it. Substructure candidates passing the fingerprint screen are
+verified with RDKit.
+
+Each build is written to a new directory under ``BUYABLES_INDEX_PATH`` and
+activated by atomically replacing the ``current`` file, so readers never see
+a partial index. Builds only run in the buyables worker: after each import,
+and after buyables are edited or the index is missing or older than
+``BUYABLES_INDEX_TTL``, see ``buyables_worker.schedule_index_rebuild``. Web
+processes only map the current build, so ``BUYABLES_INDEX_PATH`` must be set
+to a directory shared by the buyables worker and the web server, see
+``check_index_path``.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+from bson import ObjectId
+from django.core.exceptions import ImproperlyConfigured
+from rdkit import Chem, DataStructs, RDLogger
+from rdkit.Chem import AllChem
+
+lg = RDLogger.logger()
+lg.setLevel(RDLogger.CRITICAL)
+
+BUYABLES_INDEX_PATH = os.environ.get('BUYABLES_INDEX_PATH')
+BUYABLES_INDEX_TTL = float(os.environ.get('BUYABLES_INDEX_TTL', 86400))
+FP_BITS = 2048
+MORGAN_RADIUS = 2
+CHUNK_SIZE = 65536  # rows compared at once, limits temporary memory use
+BUILD_LOCK_TIMEOUT = 3600  # seconds after which a build lock is considered abandoned
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def fingerprint_mol(mol):
+    """Returns packed Morgan and pattern fingerprints of a molecule as uint8 arrays."""
+    fps = []
+    for fp in (AllChem.GetMorganFingerprintAsBitVect(mol, MORGAN_RADIUS, nBits=FP_BITS),
+               Chem.PatternFingerprint(mol, fpSize=FP_BITS)):
+        bits = np.zeros((FP_BITS,), dtype=np.uint8)
+        DataStructs.ConvertToNumpyArray(fp, bits)
+        fps.append(np.packbits(bits))
+    return fps
+
+
+def fingerprint_smiles(smiles):
+    """Returns packed Morgan and pattern fingerprint bytes for a SMILES string, or None if it cannot be parsed."""
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return None
+    morgan, pattern = fingerprint_mol(mol)
+    return morgan.tobytes(), pattern.tobytes()
+
+
+def check_index_path(path=BUYABLES_INDEX_PATH):
+    """Raises ImproperlyConfigured if the index directory is not set.
+
+    There is no default, since a directory local to each container would
+    leave web processes without the builds of the buyables worker, so every
+    search would fail while rebuilds are scheduled again and again.
+    """
+    if not path:
+        raise ImproperlyConfigured(
+            'BUYABLES_INDEX_PATH must be set to a directory shared by the buyables worker and the web server'
+        )
+
+
+def build_index(collection, path=BUYABLES_INDEX_PATH, map_func=map):
+    """Builds the fingerprint index of a buyables collection and makes it current.
+
+    Args:
+        collection (pymongo.collection.Collection): buyables collection
+        path (str): index directory
+        map_func (callable): map function used to compute fingerprints,
+            e.g. the ``map`` method of a process pool
+
+    Returns:
+        str: directory of the new index build
+    """
+    start = time.time()
+    os.makedirs(path, exist_ok=True)
+    ids, smiles, sources, source_names = [], [], [], {}
+    for doc in collection.find({}, {'smiles': 1, 'source': 1}):
+        if not doc.get('smiles') or not isinstance(doc['_id'], ObjectId):
+            continue
+        ids.append(doc['_id'].binary)
+        smiles.append(doc['smiles'])
+        sources.append(source_names.setdefault(doc.get('source') or '', len(source_names)))
+
+    morgan, pattern, keep = [], [], []
+    for i, fps in enumerate(map_func(fingerprint_smiles, smiles)):
+        if fps is not None:
+            morgan.append(fps[0])
+            pattern.append(fps[1])
+            keep.append(i)
+    nbytes = FP_BITS // 8
+    morgan = np.frombuffer(b''.join(morgan), dtype=np.uint8).reshape(-1, nbytes)
+    pattern = np.frombuffer(b''.join(pattern), dtype=np.uint8).reshape(-1, nbytes)
+    counts = POPCOUNT[morgan].sum(axis=1, dtype=np.uint16)
+    order = np.argsort(counts, kind='stable')
+    keep = np.array(keep, dtype=np.int64)[order]
+
+    encoded = [smiles[i].encode('utf-8') for i in keep]
+    offsets = np.zeros((len(encoded) + 1,), dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+
+    build_dir = tempfile.mkdtemp(prefix='build-', dir=path)
+    np.save(os.path.join(build_dir, 'morgan.npy'), morgan[order])
+    np.save(os.path.join(build_dir, 'counts.npy'), counts[order])
+    np.save(os.path.join(build_dir, 'pattern.npy'), pattern[order])
+    np.save(os.path.join(build_dir, 'ids.npy'), np.frombuffer(b''.join(ids[i] for i in keep), dtype=np.uint8).reshape(-1, 12))
+    np.save(os.path.join(build_dir, 'sources.npy'), np.array([sources[i] for i in keep], dtype=np.int32))
+    np.save(os.path.join(build_dir, 'smiles.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    np.save(os.path.join(build_dir, 'offsets.npy'), offsets)
+    with open(os.path.join(build_dir, 'meta.json'), 'w') as f:
+        json.dump({'built': start, 'count': len(keep), 'sources': sorted(source_names, key=source_names.get)}, f)
+
+    current = os.path.join(path, 'current')
+    with open(current + '.tmp', 'w') as f:
+        f.write(os.path.basename(build_dir))
+    os.replace(current + '.tmp', current)
+    remove_old_builds(path, keep=os.path.basename(build_dir))
+    print('Built buyables fingerprint index of {} entries in {:.1f} s'.format(len(keep), time.time() - start))
+    return build_dir
+
+
+def remove_old_builds(path, keep):
+    """Deletes previous index builds. Processes which still map them keep their open files."""
+    for name in os.listdir(path):
+        if name.startswith('build-') and name != keep:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+class BuyablesFingerprintIndex(object):
+    """Memory-mapped fingerprint index of buyables.
+
+    Attributes:
+        build_dir (str): directory of the index build
+        built (float): time when the build was started
+        sources (list of str): names of buyables sources, indexed by source code
+    """
+    def __init__(self, build_dir):
+        self.build_dir = build_dir
+        with open(os.path.join(build_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.built = meta['built']
+        self.sources = meta['sources']
+        self.morgan = self.load('morgan')
+        self.counts = self.load('counts')
+        self.pattern = self.load('pattern')
+        self.ids = self.load('ids')
+        self.source_codes = self.load('sources')
+        self.smiles_data = self.load('smiles')
+        self.offsets = self.load('offsets')
+
+    def load(self, name):
+        filename = os.path.join(self.build_dir, name + '.npy')
+        try:
+            return np.load(filename, mmap_mode='r')
+        except ValueError:
+            # Empty arrays cannot be mapped, e.g. if the buyables collection is empty
+            return np.load(filename)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def get_smiles(self, row):
+        return bytes(self.smiles_data[self.offsets[row]:self.offsets[row + 1]]).decode('utf-8')
+
+    def get_ids(self, rows):
+        return [ObjectId(bytes(self.ids[row])) for row in rows]
+
+    def get_source_mask(self, source, lo, hi):
+        """Returns a boolean mask of rows lo to hi from the given source, or None for all sources."""
+        if not source:
+            return None
+        try:
+            code = self.sources.index(source)
+        except ValueError:
+            return np.zeros((hi - lo,), dtype=bool)
+        return np.asarray(self.source_codes[lo:hi]) == code
+
+    def similarity_search(self, mol, limit=100, min_similarity=0.0, source=None):
+        """Finds the buyables most similar to a molecule by Tanimoto similarity of Morgan fingerprints.
+
+        Returns:
+            list of (int, float): rows and similarities, most similar first
+        """
+        query = fingerprint_mol(mol)[0]
+        query_count = int(POPCOUNT[query].sum())
+        lo, hi = 0, len(self)
+        if min_similarity > 0:
+            # Tanimoto similarity is at most min(a, b) / max(a, b) for bit counts a and b
+            lo = int(np.searchsorted(self.counts, int(np.ceil(query_count * min_similarity)), side='left'))
+            hi = int(np.searchsorted(self.counts, int(np.floor(query_count / min_similarity)), side='right'))
+
+        rows, sims = [], []
+        for start in range(lo, hi, CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, hi)
+            common = POPCOUNT[np.bitwise_and(self.morgan[start:end], query)].sum(axis=1, dtype=np.int32)
+            union = self.counts[start:end].astype(np.int32) + query_count - common
+            sim = common / np.maximum(union, 1)
+            mask = sim >= min_similarity
+            source_mask = self.get_source_mask(source, start, end)
+            if source_mask is not None:
+                mask &= source_mask
+            found = np.nonzero(mask)[0]
+            rows.append(found + start)
+            sims.append(sim[found])
+        if not rows:
+            return []
+        rows = np.concatenate(rows)
+        sims = np.concatenate(sims)
+        if len(sims) > limit:
+            top = np.argpartition(-sims, limit - 1)[:limit]
+            rows, sims = rows[top], sims[top]
+        order = np.argsort(-sims, kind='stable')
+        return [(int(rows[i]), float(sims[i])) for i in order]
+
+    def substructure_search(self, query_mol, limit=100, source=None):
+        """Finds buyables containing a substructure.
+
+        Candidates are screened with pattern fingerprints, then verified
+        with RDKit until ``limit`` matches are found.
+
+        Returns:
+            list of int: rows of matching buyables
+        """
+        query = fingerprint_mol(query_mol)[1]
+        cols = np.nonzero(query)[0]
+        query_bits = query[cols]
+        matches = []
+        for start in range(0, len(self), CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, len(self))
+            chunk = np.asarray(self.pattern[start:end])[:, cols]
+            mask = np.all(np.bitwise_and(chunk, query_bits) == query_bits, axis=1)
+            source_mask = self.get_source_mask(source, start, end)
+            if source_mask is not None:
+                mask &= source_mask
+            for row in np.nonzero(mask)[0] + start:
+                mol = Chem.MolFromSmiles(self.get_smiles(row))
+                if mol is not None and mol.HasSubstructMatch(query_mol):
+                    matches.append(int(row))
+                    if len(matches) >= limit:
+                        return matches
+        return matches
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def load_current(path=BUYABLES_INDEX_PATH):
+    """Loads the current index build, or returns None if there is none."""
+    try:
+        with open(os.path.join(path, 'current')) as f:
+            build_dir = os.path.join(path, f.read().strip())
+        return BuyablesFingerprintIndex(build_dir)
+    except (OSError, ValueError) as e:
+        print('Could not load buyables index: {}'.format(e))
+        return None
+
+
+def is_stale(index):
+    """Returns whether an index is older than the TTL."""
+    return time.time() - index.built > BUYABLES_INDEX_TTL
+
+
+def get_index(request_rebuild=None, path=BUYABLES_INDEX_PATH):
+    """Returns the current fingerprint index, reloading it if a new build was activated.
+
+    Args:
+        request_rebuild (callable, optional): called without arguments if the
+            index is missing or stale, e.g. ``buyables_worker.schedule_index_rebuild``
+        path (str): index directory
+
+    Returns:
+        BuyablesFingerprintIndex: the current index, or None if no index has been built yet
+    """
+    global _index
+    with _index_lock:
+        try:
+            with open(os.path.join(path, 'current')) as f:
+                current = os.path.join(path, f.read().strip())
+        except OSError:
+            current = None
+        if current is not None and (_index is None or _index.build_dir != current):
+            # An index of an empty collection is falsy, so compare to None
+            index = load_current(path)
+            if index is not None:
+                _index = index
+        index = _index
+    if request_rebuild is not None and (index is None or is_stale(index)):
+        request_rebuild()
+    return index
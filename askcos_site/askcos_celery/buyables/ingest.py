@@ -0,0 +1,272 @@
+"""
+Bulk ingest of buyables uploads.
+
+Uploaded CSV or JSON files are read incrementally and processed in batches.
+Each batch is canonicalized with RDKit, optionally in a process pool, then
+looked up with a single query and written with a single unordered
+``bulk_write`` of upserts. Results use the same inserted, updated and
+duplicate counts as adding the buyables one at a time.
+"""
+
+import codecs
+import csv
+import json
+import os
+from collections import OrderedDict
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from rdkit import Chem, RDLogger
+
+lg = RDLogger.logger()
+lg.setLevel(RDLogger.CRITICAL)
+
+BUYABLES_INGEST_BATCH_SIZE = int(os.environ.get('BUYABLES_INGEST_BATCH_SIZE', 5000))
+READ_CHUNK_SIZE = 1 << 20
+
+
+def iter_chunks(fileobj, chunk_size=READ_CHUNK_SIZE):
+    """Yields decoded text chunks from a binary file object."""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    while True:
+        data = fileobj.read(chunk_size)
+        if not data:
+            break
+        yield decoder.decode(data)
+    yield decoder.decode(b'', final=True)
+
+
+def iter_lines(fileobj):
+    """Yields lines including line endings from a binary file object, as expected by ``csv.reader``."""
+    rest = ''
+    for chunk in iter_chunks(fileobj):
+        lines = (rest + chunk).splitlines(True)
+        rest = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+def iter_json_array(fileobj):
+    """Yields the elements of a JSON array from a binary file object without loading the whole array.
+
+    Raises:
+        ValueError: if the file does not contain a JSON array
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter_chunks(fileobj)
+    buffer = ''
+    pos = 0
+    started = False
+    for chunk in chunks:
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while True:
+            # Skip whitespace and separators between elements
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError('Expected a JSON array')
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Element continues in the next chunk
+                break
+            pos = end
+            yield value
+    raise ValueError('Unexpected end of JSON array')
+
+
+def iter_buyables(fileobj, file_format):
+    """Yields buyables entries as dicts from an uploaded CSV or JSON file.
+
+    Args:
+        fileobj: binary file object
+        file_format (str): 'csv' or 'json'
+    """
+    if file_format == 'csv':
+        return csv.DictReader(iter_lines(fileobj))
+    elif file_format == 'json':
+        return iter_json_array(fileobj)
+    raise ValueError('File format not supported!')
+
+
+def canonicalize_buyable(buyable, require_price=False):
+    """Validates a buyables entry and canonicalizes its SMILES string.
+
+    Args:
+        buyable (dict): entry with smiles, ppg and optional source
+        require_price (bool): whether a price of zero is an error
+
+    Returns:
+        (dict, str): new document and None, or None and an error message
+    """
+    if not isinstance(buyable, dict):
+        return None, 'Improperly formatted entry'
+    smiles = buyable.get('smiles')
+    if not smiles:
+        return None, 'Smiles not provided for buyables entry'
+    try:
+        ppg = float(buyable.get('ppg') or 0.0)
+    except (TypeError, ValueError):
+        return None, 'Price must be a float value.'
+    if ppg < 0 or ppg != ppg:
+        return None, 'Price must be a non-negative float value.'
+    if require_price and not ppg:
+        return None, 'Price not provided. Price must be a nonzero float value.'
+    mol = Chem.MolFromSmiles(str(smiles))
+    if not mol:
+        return None, 'Cannot parse smiles with rdkit'
+    doc = {
+        'smiles': Chem.MolToSmiles(mol, isomericSmiles=True),
+        'ppg': ppg,
+        'source': buyable.get('source') or '',
+    }
+    return doc, None
+
+
+def write_batch(collection, docs, allow_overwrite=True):
+    """Writes canonical buyables documents using one query and one bulk write.
+
+    Documents repeating a SMILES string earlier in the batch are counted as
+    updates (or duplicates if ``allow_overwrite`` is False), as if they were
+    added one at a time.
+
+    Returns:
+        dict: lists of inserted and updated documents, number of duplicates
+            and an error message if the bulk write partially failed
+    """
+    unique = OrderedDict()
+    repeats = []
+    for doc in docs:
+        if doc['smiles'] in unique:
+            repeats.append(doc)
+            if allow_overwrite:
+                unique[doc['smiles']] = doc
+        else:
+            unique[doc['smiles']] = doc
+
+    existing = {
+        doc['smiles']: doc['_id']
+        for doc in collection.find({'smiles': {'$in': list(unique)}}, {'smiles': 1})
+    }
+
+    ops = []
+    op_smiles = []
+    for smiles, doc in unique.items():
+        if smiles in existing and not allow_overwrite:
+            continue
+        values = {'ppg': doc['ppg'], 'source': doc['source']}
+        # $setOnInsert leaves entries added concurrently by another upload unchanged
+        update = {'$set': values} if allow_overwrite else {'$setOnInsert': values}
+        ops.append(UpdateOne({'smiles': smiles}, update, upsert=True))
+        op_smiles.append(smiles)
+
+    error = None
+    upserted = {}
+    if ops:
+        try:
+            result = collection.bulk_write(ops, ordered=False)
+            upserted = {op_smiles[index]: _id for index, _id in result.upserted_ids.items()}
+        except BulkWriteError as e:
+            upserted = {op_smiles[x['index']]: x['_id'] for x in e.details.get('upserted', [])}
+            error = 'Addition of {} buyables failed'.format(len(e.details.get('writeErrors', [])))
+
+    ids = dict(existing, **upserted)
+    result = {'inserted': [], 'updated': [], 'duplicate_count': 0, 'error': error}
+    for smiles, doc in unique.items():
+        if smiles in upserted:
+            result['inserted'].append(dict(doc, _id=str(upserted[smiles])))
+        elif allow_overwrite:
+            result['updated'].append(dict(doc, _id=str(ids.get(smiles))))
+        else:
+            result['duplicate_count'] += 1
+    for doc in repeats:
+        if allow_overwrite:
+            result['updated'].append(dict(doc, _id=str(ids.get(doc['smiles']))))
+        else:
+            result['duplicate_count'] += 1
+    return result
+
+
+def ingest_buyables(collection, buyables, allow_overwrite=True, return_limit=1000,
+                    batch_size=BUYABLES_INGEST_BATCH_SIZE, map_func=map, require_price=False, progress=None):
+    """Adds buyables entries to the database in batches.
+
+    Args:
+        collection (pymongo.collection.Collection): buyables collection
+        buyables (iterable of dict): entries with smiles, ppg and source
+        allow_overwrite (bool): whether to update the price and source of existing entries
+        return_limit (int): maximum number of inserted and updated documents to return
+        batch_size (int): number of entries per database write
+        map_func (callable): map function used to canonicalize entries,
+            e.g. the ``map`` method of a process pool
+        require_price (bool): whether a price of zero is an error
+        progress (callable, optional): called with the number of entries
+            processed after each batch
+
+    Returns:
+        dict: inserted and updated documents (up to ``return_limit``) and
+            inserted, updated, duplicate, error, successful and total counts
+    """
+    result = {
+        'error': None,
+        'count': 0,
+        'inserted': [],
+        'updated': [],
+        'inserted_count': 0,
+        'updated_count': 0,
+        'duplicate_count': 0,
+        'error_count': 0,
+        'total': 0,
+    }
+
+    def process(batch):
+        checked = map_func(canonicalize_buyable, batch, [require_price] * len(batch))
+        docs = []
+        for doc, error in checked:
+            if error:
+                result['error'] = error
+                result['error_count'] += 1
+            else:
+                docs.append(doc)
+        if not docs:
+            return
+        try:
+            written = write_batch(collection, docs, allow_overwrite=allow_overwrite)
+        except PyMongoError as e:
+            result['error'] = 'Addition of buyables failed: {0!s}'.format(e)
+            result['error_count'] += len(docs)
+            return
+        if written['error']:
+            result['error'] = written['error']
+        for key in ('inserted', 'updated'):
+            result[key + '_count'] += len(written[key])
+            result[key].extend(written[key][:max(return_limit - len(result[key]), 0)])
+        result['duplicate_count'] += written['duplicate_count']
+        result['count'] += len(written['inserted']) + len(written['updated']) + written['duplicate_count']
+
+    batch = []
+    for buyable in buyables:
+        batch.append(buyable)
+        result['total'] += 1
+        if len(batch) >= batch_size:
+            process(batch)
+            batch = []
+            if progress is not None:
+                progress(result['total'])
+    if batch:
+        process(batch)
+        if progress is not None:
+            progress(result['total'])
+
+    return result
@@ -0,0 +1,261 @@
+"""
+Memory-mapped price index of buyables.
+
+Instead of loading the buyables collection into dictionaries in every
+process, the price index is written once to a single ``.npy`` file of
+records sorted by a 64-bit hash of the canonical SMILES string. Each record
+holds the hash, the price and a hash of the source. Processes map the file
+read-only, so all of them share a single copy in the page cache, and a
+lookup is a binary search over the mapped keys.
+
+Like the base ``Pricer``, a chemical which is not found by its isomeric
+SMILES string is looked up by its non-isomeric SMILES string. Buyables whose
+non-isomeric SMILES string differs from the stored one have an additional
+``flat`` record for this lookup. Lookups by xrn query the buyables
+collection, since the xrn is not part of the index.
+
+The file is kept next to the buyables fingerprint index. It is replaced
+atomically when rebuilt by the buyables worker, e.g. after buyables are
+edited, see ``buyables_worker.schedule_index_rebuild``, or in the background
+after ``BUYABLES_INDEX_TTL``, and reopened by running processes when a new
+file appears.
+"""
+
+import hashlib
+import os
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+from rdkit import Chem
+
+from askcos.utilities.buyable.pricer import Pricer
+from .fingerprint_index import BUILD_LOCK_TIMEOUT, BUYABLES_INDEX_PATH, BUYABLES_INDEX_TTL, check_index_path
+
+PRICE_INDEX_FILE = 'prices.npy'
+PRICE_INDEX_DTYPE = np.dtype([('key', '<u8'), ('ppg', '<f8'), ('source', '<u4'), ('flat', '?')])
+STEREO_OR_ISOTOPE = re.compile(r'[@/\\]|\[\d')  # parts of SMILES strings removed by isomericSmiles=False
+PRICE_INDEX_CHECK_INTERVAL = 60  # seconds between checks for a new or stale index file
+
+
+def smiles_key(smiles):
+    """Returns the 64-bit index key of a canonical SMILES string."""
+    return int.from_bytes(hashlib.blake2b(smiles.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def source_key(source):
+    """Returns the 32-bit index key of a buyables source."""
+    return zlib.crc32((source or '').encode('utf-8'))
+
+
+def flat_smiles(smiles):
+    """Returns the non-isomeric SMILES string of a canonical SMILES string, or None if it is the same."""
+    if not STEREO_OR_ISOTOPE.search(smiles):
+        return None
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return None
+    flat = Chem.MolToSmiles(mol, isomericSmiles=False)
+    return flat if flat != smiles else None
+
+
+def iter_records(collection):
+    """Yields price index records of the documents in a buyables collection."""
+    for doc in collection.find({}, {'_id': 0, 'smiles': 1, 'ppg': 1, 'source': 1}):
+        if not doc.get('smiles'):
+            continue
+        ppg, source = float(doc.get('ppg') or 0.0), source_key(doc.get('source'))
+        yield smiles_key(doc['smiles']), ppg, source, False
+        flat = flat_smiles(doc['smiles'])
+        if flat is not None:
+            yield smiles_key(flat), ppg, source, True
+
+
+def build_price_index(collection, path=BUYABLES_INDEX_PATH):
+    """Writes the price index of a buyables collection, replacing the previous index file.
+
+    Returns:
+        str: path of the index file
+    """
+    start = time.time()
+    os.makedirs(path, exist_ok=True)
+    records = np.array(list(iter_records(collection)), dtype=PRICE_INDEX_DTYPE)
+    records.sort(order=['key', 'ppg'])
+
+    filename = os.path.join(path, PRICE_INDEX_FILE)
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, records)
+    os.replace(tmp, filename)
+    print('Built buyables price index of {} entries in {:.1f} s'.format(len(records), time.time() - start))
+    return filename
+
+
+class MmapPricer(Pricer):
+    """Pricer which looks up prices in the memory-mapped price index.
+
+    If no index file exists yet, or it has an older format, ``load`` builds
+    it from the buyables collection, waiting for another process if it is
+    already building it.
+
+    Attributes:
+        collection (pymongo.collection.Collection): buyables collection used to build the index
+        path (str): directory of the index file
+        records (np.memmap): mapped index records, sorted by key
+    """
+    def __init__(self, collection, path=BUYABLES_INDEX_PATH, **kwargs):
+        check_index_path(path)
+        super().__init__(**kwargs)
+        self.collection = collection
+        self.path = path
+        self.filename = os.path.join(path, PRICE_INDEX_FILE)
+        self.records = None
+        self.keys = None
+        self.mtime = None
+        self.check_time = 0
+        self.lock = threading.Lock()
+        self.build_thread = None
+
+    def load(self, *args, **kwargs):
+        """Opens the price index, building it first if it does not exist or cannot be used."""
+        try:
+            self.open()
+        except (OSError, ValueError):
+            self.build(wait=True)
+            self.open()
+
+    def open(self):
+        """Maps the current index file."""
+        mtime = os.path.getmtime(self.filename)
+        try:
+            records = np.load(self.filename, mmap_mode='r')
+        except ValueError:
+            # Empty arrays cannot be mapped
+            records = np.load(self.filename)
+        if records.dtype != PRICE_INDEX_DTYPE:
+            raise ValueError('Buyables price index {} has an older format'.format(self.filename))
+        self.records = records
+        self.keys = records['key']
+        self.mtime = mtime
+        self.check_time = time.time()
+
+    def build(self, wait=False):
+        """Builds the index unless another process is building it.
+
+        Args:
+            wait (bool): build in this thread, or wait for the other process
+                to finish, instead of building in a background thread
+        """
+        lock = os.path.join(self.path, 'prices.lock')
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            if time.time() - os.path.getmtime(lock) > BUILD_LOCK_TIMEOUT:
+                os.remove(lock)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL))
+        except OSError:
+            # Another process is building the index
+            while wait and os.path.exists(lock):
+                time.sleep(1)
+            return
+
+        def build():
+            try:
+                build_price_index(self.collection, path=self.path)
+            finally:
+                os.remove(lock)
+
+        if wait:
+            build()
+        else:
+            def build_in_background():
+                try:
+                    build()
+                except Exception as e:
+                    print('Could not build buyables price index: {}'.format(e))
+            self.build_thread = threading.Thread(target=build_in_background, name='price-index-build', daemon=True)
+            self.build_thread.start()
+
+    def is_stale(self):
+        return time.time() - self.mtime > BUYABLES_INDEX_TTL
+
+    def check_index(self):
+        """Reopens the index if the file was replaced, and starts a rebuild if it is stale."""
+        now = time.time()
+        if now - self.check_time < PRICE_INDEX_CHECK_INTERVAL or not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.check_time = now
+            try:
+                if os.path.getmtime(self.filename) != self.mtime:
+                    self.open()
+            except (OSError, ValueError) as e:
+                print('Could not reopen buyables price index: {}'.format(e))
+            building = self.build_thread is not None and self.build_thread.is_alive()
+            if not building and self.is_stale():
+                self.build()
+        finally:
+            self.lock.release()
+
+    def find_price(self, smiles, sources=None, flat=True):
+        """Returns the lowest price of index records with a SMILES string, or 0.0 if there is none.
+
+        Args:
+            smiles (str): canonical SMILES string
+            sources (set, optional): source keys to consider, all sources by default
+            flat (bool): whether to include records of non-isomeric SMILES strings
+        """
+        key = np.uint64(smiles_key(smiles))
+        lo = int(np.searchsorted(self.keys, key, side='left'))
+        hi = int(np.searchsorted(self.keys, key, side='right'))
+        for record in self.records[lo:hi]:
+            if (flat or not record['flat']) and (sources is None or int(record['source']) in sources):
+                return float(record['ppg'])
+        return 0.0
+
+    def lookup_smiles(self, smiles, source=None, alreadyCanonical=False, isomericSmiles=True):
+        """Returns the lowest price of a chemical, or 0.0 if it is not buyable.
+
+        If the chemical is not found, it is looked up by its non-isomeric SMILES string.
+
+        Args:
+            smiles (str): SMILES string of the chemical
+            source (str or list, optional): buyables source(s) to consider
+            alreadyCanonical (bool): whether ``smiles`` is already canonical
+            isomericSmiles (bool): whether to keep stereochemistry when canonicalizing
+        """
+        if self.records is None:
+            self.load()
+        self.check_index()
+        mol = None
+        if not alreadyCanonical:
+            mol = Chem.MolFromSmiles(smiles)
+            if not mol:
+                return 0.0
+            smiles = Chem.MolToSmiles(mol, isomericSmiles=isomericSmiles)
+
+        sources = None
+        if source is not None:
+            sources = {source_key(s) for s in ([source] if isinstance(source, str) else source)}
+        if isomericSmiles:
+            ppg = self.find_price(smiles, sources, flat=False)
+            if ppg:
+                return ppg
+            if STEREO_OR_ISOTOPE.search(smiles):
+                mol = mol or Chem.MolFromSmiles(smiles)
+                if not mol:
+                    return 0.0
+                smiles = Chem.MolToSmiles(mol, isomericSmiles=False)
+        return self.find_price(smiles, sources)
+
+    def lookup_xrn(self, xrn):
+        """Returns the lowest price of a chemical by its xrn, or 0.0 if it is not buyable.
+
+        The xrn is not part of the index, so the buyables collection is queried.
+        """
+        docs = self.collection.find({'xrn': xrn}, {'_id': 0, 'ppg': 1}).sort('ppg', 1).limit(1)
+        return next((float(doc.get('ppg') or 0.0) for doc in docs), 0.0)
@@ -0,0 +1,350 @@
+"""
+Caches shared by celery workers and web processes.
+
+Each ``TieredCache`` has an in-process LRU tier and an optional Redis tier
+which is shared between all processes using the same Redis server. A
+``FileCache`` has an on-disk tier instead, for larger binary values. Hit and
+miss counters of every cache are periodically written to Redis so that they
+can be aggregated by the status API using ``get_cache_stats``.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
+REDIS_PORT = os.environ.get('REDIS_PORT', '6379')
+CACHE_KEY_PREFIX = 'askcos:cache:'
+CACHE_STATS_PREFIX = 'askcos:cache_stats:'
+CACHE_STATS_INTERVAL = 30  # seconds between writing cache statistics to redis
+CACHE_SWEEP_INTERVAL = float(os.environ.get('CACHE_SWEEP_INTERVAL', 3600))
+CACHE_TMP_MAX_AGE = 3600  # seconds after which temporary files of interrupted writes are deleted
+
+_redis_client = None
+_redis_lock = threading.Lock()
+
+
+def get_redis_client():
+    """Returns a redis client for the celery result backend server, creating it if necessary."""
+    global _redis_client
+    if _redis_client is None:
+        with _redis_lock:
+            if _redis_client is None:
+                _redis_client = redis.Redis(host=REDIS_HOST, port=int(REDIS_PORT), socket_timeout=1)
+    return _redis_client
+
+
+def make_key(*args):
+    """Creates a fixed length hash from JSON serializable key components."""
+    return hashlib.sha1(json.dumps(args, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class LRUCache(object):
+    """Thread safe in-memory least recently used cache with optional expiry.
+
+    Attributes:
+        maxsize (int): maximum number of entries
+        ttl (float): seconds before an entry expires, or None to never expire
+    """
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        """Returns the value for key, or default if it is missing or expired."""
+        with self.lock:
+            try:
+                value, expires = self.data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Stores value for key, evicting the least recently used entries if full."""
+        expires = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class TieredCache(object):
+    """Cache with an in-process LRU tier and an optional shared Redis tier.
+
+    Keys are tuples of JSON serializable values. Values stored in the Redis
+    tier must be JSON serializable, and are returned as decoded JSON.
+
+    Attributes:
+        name (str): name of the cache, used for Redis keys and statistics
+        local (LRUCache): in-process tier
+        use_redis (bool): whether to use the shared Redis tier
+        ttl (float): seconds before entries expire in both tiers
+        hits (int): number of lookups answered by the local tier
+        redis_hits (int): number of lookups answered by the Redis tier
+        misses (int): number of lookups not found in any tier
+    """
+    def __init__(self, name, maxsize=1000, ttl=3600, use_redis=False):
+        self.name = name
+        self.local = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.use_redis = use_redis
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.stats_time = 0
+
+    def redis_key(self, key):
+        return CACHE_KEY_PREFIX + self.name + ':' + make_key(*key)
+
+    def get(self, key, default=None):
+        """Looks up key in the local tier, then the Redis tier."""
+        value = self.local.get(key)
+        if value is not None:
+            self.hits += 1
+            self.maybe_report_stats()
+            return value
+
+        if self.use_redis:
+            try:
+                data = get_redis_client().get(self.redis_key(key))
+            except redis.RedisError:
+                self.errors += 1
+                data = None
+            if data is not None:
+                value = json.loads(data)
+                self.local.set(key, value)
+                self.redis_hits += 1
+                self.maybe_report_stats()
+                return value
+
+        self.misses += 1
+        self.maybe_report_stats()
+        return default
+
+    def set(self, key, value):
+        """Stores value in the local tier and the Redis tier."""
+        self.local.set(key, value)
+        if self.use_redis:
+            try:
+                get_redis_client().set(self.redis_key(key), json.dumps(value), ex=int(self.ttl) if self.ttl else None)
+            except (redis.RedisError, TypeError, ValueError):
+                self.errors += 1
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        """Returns hit/miss counters and size of the local tier."""
+        return {
+            'name': self.name,
+            'size': len(self.local),
+            'maxsize': self.local.maxsize,
+            'hits': self.hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'errors': self.errors,
+        }
+
+    def maybe_report_stats(self):
+        """Writes statistics of this process to Redis at most every ``CACHE_STATS_INTERVAL`` seconds."""
+        now = time.time()
+        if now - self.stats_time < CACHE_STATS_INTERVAL:
+            return
+        self.stats_time = now
+        key = '{}{}:{}:{}'.format(CACHE_STATS_PREFIX, self.name, socket.gethostname(), os.getpid())
+        try:
+            get_redis_client().set(key, json.dumps(self.stats()), ex=CACHE_STATS_INTERVAL * 4)
+        except redis.RedisError:
+            self.errors += 1
+
+
+class FileCache(TieredCache):
+    """Cache of bytes values with an in-process LRU tier and an on-disk tier.
+
+    Files are named by the hash of their key, so the disk tier is shared by
+    all processes using the same directory. Files are written atomically and
+    expire ``ttl`` seconds after they were written, if ``ttl`` is set.
+
+    The directory grows by one file per stored value. Expired files are only
+    deleted by sweeps, which run in a background thread of a process storing
+    values at most every ``sweep_interval`` seconds. A sweep deletes expired
+    files and, if ``max_bytes`` is set, the oldest files until the disk tier
+    is no larger than ``max_bytes``. Between sweeps the directory can grow by
+    the values stored in that time. Without ``ttl`` and ``max_bytes`` the
+    directory grows without bound.
+
+    Attributes:
+        path (str): directory of the disk tier
+        max_bytes (int): maximum size of the disk tier after a sweep, or None for no limit
+        sweep_interval (float): minimum seconds between sweeps of the directory
+        disk_hits (int): number of lookups answered by the disk tier
+    """
+    def __init__(self, name, path, maxsize=1000, ttl=None, max_bytes=None, sweep_interval=CACHE_SWEEP_INTERVAL):
+        super().__init__(name, maxsize=maxsize, ttl=ttl)
+        self.path = os.path.join(path, name)
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.sweep_time = 0
+        self.disk_hits = 0
+
+    def file_path(self, key):
+        digest = make_key(*key)
+        return os.path.join(self.path, digest[:2], digest)
+
+    def get(self, key, default=None):
+        """Looks up key in the local tier, then the disk tier."""
+        value = self.local.get(key)
+        if value is not None:
+            self.hits += 1
+            self.maybe_report_stats()
+            return value
+
+        path = self.file_path(key)
+        try:
+            if not self.ttl or os.path.getmtime(path) > time.time() - self.ttl:
+                with open(path, 'rb') as f:
+                    value = f.read()
+        except OSError:
+            value = None
+        if value is not None:
+            self.local.set(key, value)
+            self.disk_hits += 1
+            self.maybe_report_stats()
+            return value
+
+        self.misses += 1
+        self.maybe_report_stats()
+        return default
+
+    def set(self, key, value):
+        """Stores value in the local tier and the disk tier."""
+        self.local.set(key, value)
+        path = self.file_path(key)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except OSError:
+            self.errors += 1
+        self.maybe_sweep()
+
+    def maybe_sweep(self):
+        """Starts a sweep in a background thread if the directory was not swept for ``sweep_interval`` seconds."""
+        now = time.time()
+        if (not self.ttl and not self.max_bytes) or now - self.sweep_time < self.sweep_interval:
+            return
+        self.sweep_time = now
+        # Other processes check the time of the last sweep in the shared directory
+        marker = os.path.join(self.path, 'last_sweep')
+        try:
+            if now - os.path.getmtime(marker) < self.sweep_interval:
+                return
+        except OSError:
+            pass
+        try:
+            with open(marker, 'w'):
+                pass
+        except OSError:
+            return
+        threading.Thread(target=self.sweep, name='{}-cache-sweep'.format(self.name), daemon=True).start()
+
+    def sweep(self):
+        """Deletes expired files, then the oldest files while the disk tier is larger than ``max_bytes``.
+
+        Returns:
+            2-tuple of (int, int): number of deleted files and size of the remaining files in bytes
+        """
+        now = time.time()
+        files, deleted = [], 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if filename.endswith('.tmp'):
+                    expired = stat.st_mtime < now - CACHE_TMP_MAX_AGE
+                elif dirpath != self.path:
+                    expired = self.ttl and stat.st_mtime < now - self.ttl
+                    if not expired:
+                        files.append((stat.st_mtime, stat.st_size, path))
+                else:
+                    continue
+                if expired:
+                    try:
+                        os.remove(path)
+                        deleted += 1
+                    except OSError:
+                        pass
+
+        size = sum(file_size for _, file_size, _ in files)
+        if self.max_bytes and size > self.max_bytes:
+            files.sort()
+            for _, file_size, path in files:
+                if size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    deleted += 1
+                    size -= file_size
+                except OSError:
+                    pass
+        print('Swept {} cache: deleted {} files, {:.1f} MB remaining'.format(self.name, deleted, size / 2 ** 20))
+        return deleted, size
+
+    def stats(self):
+        stats = super().stats()
+        stats['disk_hits'] = self.disk_hits
+        return stats
+
+
+def get_cache_stats():
+    """Aggregates the most recent cache statistics reported by all processes.
+
+    Returns:
+        list of dict: statistics for each cache name, summed over processes
+    """
+    totals = {}
+    client = get_redis_client()
+    try:
+        keys = list(client.scan_iter(match=CACHE_STATS_PREFIX + '*', count=1000))
+        values = client.mget(keys) if keys else []
+    except redis.RedisError:
+        return []
+    for data in values:
+        if data is None:
+            continue
+        stats = json.loads(data)
+        total = totals.setdefault(stats['name'], {'name': stats['name'], 'processes': 0})
+        total['processes'] += 1
+        for field in ('size', 'hits', 'redis_hits', 'disk_hits', 'misses', 'errors'):
+            total[field] = total.get(field, 0) + stats.get(field, 0)
+    for total in totals.values():
+        shared_hits = total['redis_hits'] + total['disk_hits']
+        lookups = total['hits'] + shared_hits + total['misses']
+        total['hit_rate'] = (total['hits'] + shared_hits) / lookups if lookups else None
+    return sorted(totals.values(), key=lambda x: x['name'])
@@ -1,4 +1,6 @@
 from __future__ import absolute_import, unicode_literals, print_function
+import os
+
 from kombu import Exchange, Queue
 
 CELERY_TASK_SERIALIZER = 'json'
@@ -12,6 +14,7 @@ CELERY_RESULT_PERSISTENT = False
 
 CELERY_TASK_QUEUES = [
     Queue('tb_c_worker', Exchange('tb_c_worker'), routing_key='tb_c_worker', queue_arguments={'x-max-priority':20}),
+    Queue('tb_c_worker_reservable', Exchange('tb_c_worker_reservable'), routing_key='tb_c_worker_reservable', queue_arguments={'x-max-priority': 20}),
     Queue('tb_worker', Exchange('tb_worker'), routing_key='tb_worker', queue_arguments={'x-max-priority': 20}),
 
 ]
@@ -19,6 +22,9 @@ CELERY_TASK_QUEUES = [
 
 CELERY_BROKER_HEARTBEAT = 0
 
+# Task events keep worker status up to date between heartbeats, see askcos_celery/worker_status.py
+CELERY_WORKER_SEND_TASK_EVENTS = os.environ.get('CELERY_WORKER_SEND_TASK_EVENTS', 'True') in ['True', 'true', '1']
+
 # global max priority setting
 CELERYD_PREFETCH_MULTIPLIER = 1
 
@@ -27,7 +33,9 @@ CELERY_TASK_ROUTES = {
     'askcos_site.askcos_celery.treebuilder.tb_c_worker.get_top_precursors': {'queue': 'tb_c_worker'},
     'askcos_site.askcos_celery.treebuilder.tb_c_worker.fast_filter_check': {'queue': 'tb_c_worker'},
     'askcos_site.askcos_celery.treebuilder.tb_c_worker.apply_one_template_by_idx': {'queue': 'tb_c_worker'},
+    'askcos_site.askcos_celery.treebuilder.tb_c_worker.apply_templates_by_idx': {'queue': 'tb_c_worker'},
     'askcos_site.askcos_celery.treebuilder.tb_c_worker.template_relevance': {'queue': 'tb_c_worker'},
+    'askcos_site.askcos_celery.treebuilder.tb_c_worker.reserve_worker_pool': {'queue': 'tb_c_worker_reservable'},
     'askcos_site.askcos_celery.treebuilder.tb_coordinator_mcts.*':{'queue': 'tb_coordinator_mcts'},
     'askcos_site.askcos_celery.treeevaluator.tree_evaluation_coordinator.*':{'queue':'te_coordinator'},
     'askcos_site.askcos_celery.treeevaluator.scoring_coordinator.*':{'queue':'sc_coordinator'},
@@ -39,4 +47,5 @@ CELERY_TASK_ROUTES = {
     'askcos_site.askcos_celery.atom_mapper.atom_mapping_worker.*':{'queue':'atom_mapping_worker'},
     'askcos_site.askcos_celery.impurity.impurity_predictor_worker.*': {'queue': 'atom_mapping_worker'},
     'askcos_site.askcos_celery.generalselectivity.selec_worker.get_selec': {'queue': 'selec_worker'},
+    'askcos_site.askcos_celery.buyables.buyables_worker.*': {'queue': 'buyables_worker'},
 }
@@ -5,6 +5,7 @@ from rdkit import RDLogger
 from askcos.synthetic.impurity.impurity_predictor import ImpurityPredictor
 from ..atom_mapper.atom_mapping_worker import get_atom_mapping
 from ..impurity.impurity_predictor_worker import predict_reaction
+from ..scheduling import get_lane_options
 from ..treebuilder.tb_c_worker import fast_filter_check
 
 lg = RDLogger.logger()
@@ -38,7 +39,7 @@ def get_impurities(self, reactants, reagents='', products='', solvents='',
     def inspector(rxnsmiles, model=inspector_selection):
         if model == 'Reaxys inspector':
             react, prod = rxnsmiles.split('>>')
-            result = fast_filter_check.delay(react, prod)
+            result = fast_filter_check.apply_async(args=(react, prod), **get_lane_options('interactive'))
         else:
             raise NotImplementedError('{0} is not yet supported for impurity prediction.'.format(model))
         return result.get(3)
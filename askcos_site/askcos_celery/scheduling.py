@@ -0,0 +1,179 @@
+"""
+Priority lanes and per-user fair share for tasks on priority queues.
+
+Queues declared with ``x-max-priority`` deliver higher priority messages
+first, so tasks are published in one of two lanes:
+
+- ``interactive``: requests which a user is waiting on, e.g. single-step
+  retrosynthesis from the API, which always get the highest priority
+- ``batch``: subtasks of long running jobs such as tree builder expansions
+
+Batch tasks of a tree search get a priority which decreases with the number
+of searches that the same user is running concurrently, so one user cannot
+take all worker capacity from other users by starting many searches.
+
+Tasks published using ``get_lane_options`` carry their lane and send time
+in message headers. Workers record the time each task waited in the queue
+with ``record_queue_wait``, and ``get_queue_wait_stats`` summarizes recent
+waits per lane for the status API.
+"""
+
+import os
+import time
+
+import redis
+
+from .cache import get_redis_client
+
+INTERACTIVE_PRIORITY = int(os.environ.get('INTERACTIVE_TASK_PRIORITY', 18))
+BATCH_PRIORITY = int(os.environ.get('BATCH_TASK_PRIORITY', 10))
+BATCH_MIN_PRIORITY = int(os.environ.get('BATCH_TASK_MIN_PRIORITY', 1))
+# Decrease in batch priority for each additional concurrent search by a user
+FAIR_SHARE_STEP = int(os.environ.get('FAIR_SHARE_PRIORITY_STEP', 2))
+FAIR_SHARE_REFRESH_INTERVAL = 2  # seconds between updates of the priority of a search
+LANE_PRIORITIES = {
+    'interactive': INTERACTIVE_PRIORITY,
+    'batch': BATCH_PRIORITY,
+}
+
+ACTIVE_SEARCHES_PREFIX = 'askcos:active_searches:'
+ACTIVE_SEARCHES_TTL = 86400  # safety expiry in case a coordinator dies during a search
+QUEUE_WAIT_PREFIX = 'askcos:queue_wait:'
+QUEUE_WAIT_SAMPLES = 1000  # most recent waits kept per lane
+
+
+def get_lane_options(lane, priority=None):
+    """Returns ``apply_async`` options for publishing a task in a lane.
+
+    Args:
+        lane (str): 'interactive' or 'batch'
+        priority (int, optional): priority overriding the default of the lane
+
+    Returns:
+        dict: ``priority`` and ``headers`` options
+    """
+    if priority is None:
+        priority = LANE_PRIORITIES[lane]
+    return {
+        'priority': priority,
+        'headers': {'lane': lane, 'sent_time': time.time()},
+    }
+
+
+def get_fair_share_user(request):
+    """Returns the key which identifies who made a request, for fair share scheduling.
+
+    Authenticated users are identified by their user ID and anonymous users
+    by their remote address, so that every entry point keys searches the same way.
+
+    Args:
+        request: Django or DRF request
+
+    Returns:
+        str: 'user:<id>' or 'ip:<address>'
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return 'user:{}'.format(user.id)
+    return 'ip:{}'.format(request.META.get('REMOTE_ADDR') or 'unknown')
+
+
+def _active_searches_key(user):
+    return ACTIVE_SEARCHES_PREFIX + str(user or 'anonymous')
+
+
+def start_search(user):
+    """Counts a new search by user.
+
+    Returns:
+        int: number of active searches by user, including the new one
+    """
+    key = _active_searches_key(user)
+    try:
+        pipe = get_redis_client().pipeline()
+        pipe.incr(key)
+        pipe.expire(key, ACTIVE_SEARCHES_TTL)
+        return pipe.execute()[0]
+    except redis.RedisError as e:
+        print('Could not count active searches: {}'.format(e))
+        return 1
+
+
+def finish_search(user):
+    """Removes a finished search by user from the count of active searches."""
+    key = _active_searches_key(user)
+    try:
+        client = get_redis_client()
+        if client.decr(key) <= 0:
+            client.delete(key)
+    except redis.RedisError as e:
+        print('Could not count active searches: {}'.format(e))
+
+
+def get_active_searches(user):
+    """Returns the number of searches which user is currently running."""
+    try:
+        count = get_redis_client().get(_active_searches_key(user))
+    except redis.RedisError:
+        return 1
+    return max(int(count or 0), 1)
+
+
+def get_search_priority(active_searches):
+    """Returns the batch priority for each search of a user with ``active_searches`` concurrent searches."""
+    priority = BATCH_PRIORITY - FAIR_SHARE_STEP * (active_searches - 1)
+    return max(priority, BATCH_MIN_PRIORITY)
+
+
+def record_queue_wait(request):
+    """Records the time a task waited in the queue, if it was published with lane options.
+
+    Args:
+        request (celery.app.task.Context): request of the task which is starting
+    """
+    lane = request.get('lane')
+    sent_time = request.get('sent_time')
+    if lane is None or sent_time is None:
+        return
+    wait = max(time.time() - float(sent_time), 0)
+    key = QUEUE_WAIT_PREFIX + lane
+    try:
+        pipe = get_redis_client().pipeline()
+        pipe.lpush(key, round(wait, 4))
+        pipe.ltrim(key, 0, QUEUE_WAIT_SAMPLES - 1)
+        pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+def _percentile(values, fraction):
+    """Returns the value at a fraction of sorted values, using the nearest rank."""
+    index = min(int(fraction * len(values)), len(values) - 1)
+    return values[index]
+
+
+def get_queue_wait_stats():
+    """Summarizes recent queue waits for each lane.
+
+    Returns:
+        list of dict: number of samples and mean, p50, p95 and max wait in seconds for each lane
+    """
+    client = get_redis_client()
+    stats = []
+    for lane in sorted(LANE_PRIORITIES):
+        try:
+            waits = sorted(float(x) for x in client.lrange(QUEUE_WAIT_PREFIX + lane, 0, -1))
+        except redis.RedisError:
+            return []
+        if not waits:
+            stats.append({'lane': lane, 'count': 0})
+            continue
+        stats.append({
+            'lane': lane,
+            'count': len(waits),
+            'mean': sum(waits) / len(waits),
+            'p50': _percentile(waits, 0.5),
+            'p95': _percentile(waits, 0.95),
+            'max': waits[-1],
+        })
+    return stats
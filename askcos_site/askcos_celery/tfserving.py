@@ -1,20 +1,191 @@
+import os
+import threading
+
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connection settings for the tensorflow serving http client, configurable via environment
+TF_SERVING_POOL_SIZE = int(os.environ.get('TF_SERVING_POOL_SIZE', 16))
+TF_SERVING_KEEP_ALIVE = os.environ.get('TF_SERVING_KEEP_ALIVE', 'True') in ['True', 'true', '1']
+TF_SERVING_CONNECT_TIMEOUT = float(os.environ.get('TF_SERVING_CONNECT_TIMEOUT', 3.05))
+TF_SERVING_READ_TIMEOUT = float(os.environ.get('TF_SERVING_READ_TIMEOUT', 30))
+TF_SERVING_RETRIES = int(os.environ.get('TF_SERVING_RETRIES', 3))
+TF_SERVING_BACKOFF = float(os.environ.get('TF_SERVING_BACKOFF', 0.1))
+
+# Payload encoding for predict requests: 'json', 'json-compact' or 'grpc'
+TF_SERVING_TRANSPORT = os.environ.get('TF_SERVING_TRANSPORT', 'json')
+TF_SERVING_GRPC_PORT = int(os.environ.get('TF_SERVING_GRPC_PORT', 8500))
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+_grpc_stubs = {}
+_grpc_pid = None
+
+
+def create_session(pool_size=TF_SERVING_POOL_SIZE, keep_alive=TF_SERVING_KEEP_ALIVE,
+                   retries=TF_SERVING_RETRIES, backoff=TF_SERVING_BACKOFF):
+    """Creates a pooled requests session for talking to tensorflow serving.
+
+    Args:
+        pool_size (int): Maximum number of connections kept open per host.
+        keep_alive (bool): Whether to reuse connections between requests.
+        retries (int): Number of retries on connection errors and 502/503/504 responses.
+        backoff (float): Backoff factor in seconds between retries.
+
+    Returns:
+        requests.Session: session with a pooled adapter mounted for http
+    """
+    retry_settings = {
+        'total': retries,
+        'connect': retries,
+        'read': retries,
+        'backoff_factor': backoff,
+        'status_forcelist': (502, 503, 504),
+        'raise_on_status': False,
+    }
+    # Predictions are idempotent, so POST requests may also be retried
+    try:
+        retry = Retry(allowed_methods=None, **retry_settings)
+    except TypeError:
+        retry = Retry(method_whitelist=False, **retry_settings)
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+    return session
+
+
+def get_session():
+    """Returns the requests session for the current process, creating it if necessary.
+
+    A new session is created after a fork so that pooled sockets are never shared between processes.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = create_session()
+                _session_pid = pid
+    return _session
+
+
+def to_json(value, compact=False):
+    """Converts numpy arrays in a request body to lists.
+
+    Args:
+        value: numpy array, or list/dict containing numpy arrays
+        compact (bool): Send integral float arrays (e.g. fingerprints) as integers,
+            which is lossless and much shorter than float literals.
+
+    Returns:
+        JSON serializable version of value
+    """
+    if isinstance(value, dict):
+        return {k: to_json(v, compact=compact) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json(v, compact=compact) for v in value]
+    if isinstance(value, np.ndarray):
+        if compact and value.dtype.kind == 'f' and np.array_equal(value, np.trunc(value)):
+            return value.astype(np.int64).tolist()
+        return value.tolist()
+    return value
+
+
+def _load_grpc():
+    """Imports the optional gRPC dependencies for the grpc transport."""
+    try:
+        import grpc
+        from tensorflow.core.framework import tensor_pb2, tensor_shape_pb2, types_pb2
+        from tensorflow_serving.apis import predict_pb2, prediction_service_pb2_grpc
+    except ImportError as e:
+        raise ImportError('The grpc transport requires the grpcio and tensorflow-serving-api packages ({})'.format(e))
+    return grpc, tensor_pb2, tensor_shape_pb2, types_pb2, predict_pb2, prediction_service_pb2_grpc
+
+
+def get_grpc_stub(target):
+    """Returns a prediction service stub for a host:port target, creating a channel once per process."""
+    global _grpc_stubs, _grpc_pid
+    pid = os.getpid()
+    with _session_lock:
+        if _grpc_pid != pid:
+            # gRPC channels cannot be used across a fork
+            _grpc_stubs = {}
+            _grpc_pid = pid
+        stub = _grpc_stubs.get(target)
+        if stub is None:
+            grpc, _, _, _, _, prediction_service_pb2_grpc = _load_grpc()
+            channel = grpc.insecure_channel(target)
+            stub = _grpc_stubs[target] = prediction_service_pb2_grpc.PredictionServiceStub(channel)
+    return stub
+
+
+def make_tensor_proto(array):
+    """Creates a float32 TensorProto with the array stored as raw ``tensor_content`` bytes."""
+    _, tensor_pb2, tensor_shape_pb2, types_pb2, _, _ = _load_grpc()
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    shape = tensor_shape_pb2.TensorShapeProto(
+        dim=[tensor_shape_pb2.TensorShapeProto.Dim(size=size) for size in array.shape]
+    )
+    return tensor_pb2.TensorProto(dtype=types_pb2.DT_FLOAT, tensor_shape=shape, tensor_content=array.tobytes())
+
+
+def tensor_proto_to_array(proto):
+    """Converts a float TensorProto returned by TF Serving into a numpy array."""
+    shape = [dim.size for dim in proto.tensor_shape.dim]
+    if proto.tensor_content:
+        array = np.frombuffer(proto.tensor_content, dtype=np.float32)
+    else:
+        array = np.array(proto.float_val, dtype=np.float32)
+    return array.reshape(shape)
+
 
 class TFServingAPIModel(object):
     """Base tensorflow serving API Model class.
-    
+
     Attributes:
         hostname (str): hostname of service serving tf model.
         model_name (str): Name of model provided to tf serving.
         version (int): version of the model to use when serving
+        timeout (tuple of float): connect and read timeouts for API requests
+        transport (str): request encoding, one of 'json', 'json-compact' or 'grpc'
+        input_name (str): name of the model input, used by the grpc transport for unnamed instances
+        port (int): port of the REST API
+        grpc_port (int): port of the gRPC API
 
     """
-    def __init__(self, hostname, model_name, version=None):
-        self.baseurl = 'http://{}:8501/v1/models/{}'.format(hostname, model_name)
+    def __init__(self, hostname, model_name, version=None, timeout=None, transport=None, port=8501, grpc_port=None):
+        self.hostname = hostname
+        self.model_name = model_name
+        self.version = version
+        self.port = port
+        self.grpc_port = grpc_port or TF_SERVING_GRPC_PORT
+        self.baseurl = 'http://{}:{}/v1/models/{}'.format(hostname, port, model_name)
         if version:
             self.baseurl += '/versions/{}'.format(version)
         self.url = self.baseurl+':predict'
+        self.metaurl = self.baseurl+'/metadata'
+        self.timeout = timeout or (TF_SERVING_CONNECT_TIMEOUT, TF_SERVING_READ_TIMEOUT)
+        self.transport = transport or TF_SERVING_TRANSPORT
+        if self.transport not in ('json', 'json-compact', 'grpc'):
+            raise ValueError('Unsupported tensorflow serving transport: {}'.format(self.transport))
+        self.input_name = None
+
+    @property
+    def session(self):
+        """Pooled requests session shared by all API models in this process."""
+        return get_session()
+
+    def get_metadata(self):
+        """Retrieves the model metadata from the TF Serving REST API."""
+        resp = self.session.get(self.metaurl, timeout=self.timeout)
+        return resp.json()
 
     def load_model(self, model_path=None):
         """Override load method, no model to load"""
@@ -37,7 +208,67 @@ class TFServingAPIModel(object):
         Calls a transformation function before and after actually calling the API endpoint to allow for customizable pipelines.
         """
         x = self.transform_input(*args, **kwargs)
-        resp = requests.post(self.url, json={'instances': x})
-        pred = np.array(resp.json()['predictions']).reshape(-1)
+        pred = self.post_instances(x).reshape(-1)
         pred = self.transform_output(pred, **kwargs)
-        return pred
\ No newline at end of file
+        return pred
+
+    def post_instances(self, instances):
+        """Sends instances to the TF Serving predict endpoint using the configured transport.
+
+        Args:
+            instances (list): Model inputs, one entry per instance. Each entry is
+                either an array or a dict of arrays keyed by input name.
+
+        Returns:
+            np.array: predictions, with the first axis indexing instances
+        """
+        if self.transport == 'grpc':
+            return self.predict_grpc(instances)
+        resp = self.session.post(self.url, json=self.make_json_body(instances), timeout=self.timeout)
+        resp.raise_for_status()
+        return np.array(resp.json()['predictions'])
+
+    def make_json_body(self, instances):
+        """Returns the REST predict request body for instances."""
+        return {'instances': to_json(instances, compact=self.transport == 'json-compact')}
+
+    def make_predict_request(self, instances):
+        """Returns a gRPC PredictRequest with the instances as raw float32 tensors."""
+        _, _, _, _, predict_pb2, _ = _load_grpc()
+
+        if isinstance(instances[0], dict):
+            inputs = {
+                name: np.stack([np.asarray(instance[name], dtype=np.float32) for instance in instances])
+                for name in instances[0]
+            }
+        else:
+            if self.input_name is None:
+                signature = self.get_metadata()['metadata']['signature_def']['signature_def']['serving_default']
+                self.input_name = list(signature['inputs'].keys())[0]
+            inputs = {self.input_name: np.asarray(instances, dtype=np.float32)}
+
+        request = predict_pb2.PredictRequest()
+        request.model_spec.name = self.model_name
+        request.model_spec.signature_name = 'serving_default'
+        if self.version:
+            request.model_spec.version.value = int(self.version)
+        for name, array in inputs.items():
+            request.inputs[name].CopyFrom(make_tensor_proto(array))
+        return request
+
+    def predict_grpc(self, instances):
+        """Sends instances to the TF Serving gRPC API as raw float32 tensors.
+
+        Args:
+            instances (list): Model inputs, one entry per instance.
+
+        Returns:
+            np.array: predictions, with the first axis indexing instances
+        """
+        request = self.make_predict_request(instances)
+        stub = get_grpc_stub('{}:{}'.format(self.hostname, self.grpc_port))
+        timeout = self.timeout[-1] if isinstance(self.timeout, (tuple, list)) else self.timeout
+        response = stub.Predict(request, timeout=timeout)
+        # Models served here have a single output tensor
+        output = next(iter(response.outputs.values()))
+        return tensor_proto_to_array(output)
@@ -0,0 +1,127 @@
+"""
+Benchmark of tensorflow serving request transports.
+
+Sends fast filter style requests (product and reaction fingerprints) to the
+stub server in ``tfserving_stub`` with each transport of
+``TFServingAPIModel``, and reports for each batch size:
+
+- request and response bytes
+- time to encode a request and to decode a response, in milliseconds
+- median round trip time of ``post_instances``, in milliseconds
+
+The grpc transport is skipped if grpcio and tensorflow-serving-api are not
+installed. Run with::
+
+    python -m askcos_site.askcos_celery.tfserving_benchmark
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from .tfserving import TFServingAPIModel, _load_grpc, get_grpc_stub, tensor_proto_to_array
+from .tfserving_stub import start_stub_servers
+
+FP_LENGTH = 2048
+FP_DENSITY = 0.03  # fraction of bits set in a typical Morgan fingerprint
+
+
+def make_instances(n, rng):
+    """Returns ``n`` fast filter instances with random sparse fingerprints."""
+    instances = []
+    for _ in range(n):
+        pfp = (rng.random(FP_LENGTH) < FP_DENSITY).astype(np.float32)
+        rfp = (rng.random(FP_LENGTH) < FP_DENSITY).astype(np.float32)
+        instances.append({'input_1': pfp, 'input_2': pfp - rfp})
+    return instances
+
+
+def median_time(func, repeat):
+    """Returns the median time of ``repeat`` calls of ``func`` in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+def benchmark_json(model, instances, repeat):
+    body = json.dumps(model.make_json_body(instances))
+    response = model.session.post(model.url, data=body, headers={'Content-Type': 'application/json'}).content
+    return {
+        'request_bytes': len(body),
+        'response_bytes': len(response),
+        'encode_ms': median_time(lambda: json.dumps(model.make_json_body(instances)), repeat),
+        'decode_ms': median_time(lambda: np.array(json.loads(response)['predictions']), repeat),
+        'round_trip_ms': median_time(lambda: model.post_instances(instances), repeat),
+    }
+
+
+def benchmark_grpc(model, instances, repeat):
+    _, _, _, _, predict_pb2, _ = _load_grpc()
+    model.predict_grpc(instances)  # opens the channel
+    request = model.make_predict_request(instances)
+    response = get_grpc_stub('{}:{}'.format(model.hostname, model.grpc_port)).Predict(request).SerializeToString()
+
+    def decode():
+        outputs = predict_pb2.PredictResponse.FromString(response).outputs
+        return tensor_proto_to_array(next(iter(outputs.values())))
+
+    return {
+        'request_bytes': request.ByteSize(),
+        'response_bytes': len(response),
+        'encode_ms': median_time(lambda: model.make_predict_request(instances).SerializeToString(), repeat),
+        'decode_ms': median_time(decode, repeat),
+        'round_trip_ms': median_time(lambda: model.post_instances(instances), repeat),
+    }
+
+
+def run_benchmark(batch_sizes=(1, 32, 256), repeat=20, seed=0):
+    """Runs the benchmark against stub servers started in this process.
+
+    Returns:
+        list of dict: results for each transport and batch size
+    """
+    try:
+        _load_grpc()
+        transports = ['json', 'json-compact', 'grpc']
+    except ImportError as e:
+        print('Skipping grpc transport: {}'.format(e))
+        transports = ['json', 'json-compact']
+
+    server, grpc_server, grpc_port = start_stub_servers(0, 0 if 'grpc' in transports else None)
+    rng = np.random.default_rng(seed)
+    results = []
+    try:
+        for batch_size in batch_sizes:
+            instances = make_instances(batch_size, rng)
+            for transport in transports:
+                model = TFServingAPIModel('localhost', 'fast_filter', transport=transport,
+                                          port=server.server_port, grpc_port=grpc_port)
+                func = benchmark_grpc if transport == 'grpc' else benchmark_json
+                result = func(model, instances, repeat)
+                result.update(transport=transport, batch_size=batch_size)
+                results.append(result)
+    finally:
+        server.shutdown()
+        if grpc_server is not None:
+            grpc_server.stop(None)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 32, 256])
+    parser.add_argument('--repeat', type=int, default=20, help='repetitions of each timing')
+    args = parser.parse_args()
+
+    columns = ['transport', 'batch_size', 'request_bytes', 'response_bytes', 'encode_ms', 'decode_ms', 'round_trip_ms']
+    print(' '.join('{:>14}'.format(column) for column in columns))
+    for result in run_benchmark(args.batch_sizes, args.repeat):
+        print(' '.join(
+            '{:>14.3f}'.format(result[column]) if isinstance(result[column], float) else '{:>14}'.format(result[column])
+            for column in columns
+        ))
@@ -0,0 +1,209 @@
+"""
+Stub tensorflow serving server for testing and benchmarking API models.
+
+Serves the parts of the TF Serving REST API used by ``TFServingAPIModel``
+(model status, metadata and predict) and, if grpcio and
+tensorflow-serving-api are installed, the gRPC ``Predict`` method. Models are
+not real: each prediction is a deterministic function of the mean of the
+instance inputs, so clients can be tested and request encodings compared
+without tensorflow serving or trained models.
+
+Run from the command line, e.g. to serve both tree builder models on the
+default ports::
+
+    python -m askcos_site.askcos_celery.tfserving_stub --port 8501 --grpc-port 8500
+"""
+
+import argparse
+import json
+import re
+import threading
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from .tfserving import _load_grpc, make_tensor_proto, tensor_proto_to_array
+
+# Inputs (name and length) and number of outputs of each model served by default
+STUB_MODELS = {
+    'template_relevance': {'inputs': {'dense_input': 2048}, 'outputs': 1000},
+    'fast_filter': {'inputs': {'input_1': 2048, 'input_2': 2048}, 'outputs': 1},
+}
+STUB_MODEL_VERSION = '1'
+
+MODEL_PATH = re.compile(r'^/v1/models/(?P<name>[^/:]+)(/versions/(?P<version>\d+))?(?P<action>/metadata|:predict)?$')
+
+
+def get_metadata(name, spec):
+    """Returns the REST metadata response of a stub model."""
+    def tensor_info(tensor_name, size):
+        return {
+            'dtype': 'DT_FLOAT',
+            'tensor_shape': {'dim': [{'size': '-1', 'name': ''}, {'size': str(size), 'name': ''}], 'unknown_rank': False},
+            'name': tensor_name,
+        }
+    signature = {
+        'inputs': {input_name: tensor_info(input_name, size) for input_name, size in spec['inputs'].items()},
+        'outputs': {'output_0': tensor_info('output_0', spec['outputs'])},
+        'method_name': 'tensorflow/serving/predict',
+    }
+    return {
+        'model_spec': {'name': name, 'signature_name': '', 'version': STUB_MODEL_VERSION},
+        'metadata': {'signature_def': {'signature_def': {'serving_default': signature}}},
+    }
+
+
+def stub_predict(spec, inputs):
+    """Computes stub predictions.
+
+    Args:
+        spec (dict): inputs and number of outputs of the model
+        inputs (dict): array of instances for each input name
+
+    Returns:
+        np.array: predictions with shape (instances, outputs)
+    """
+    means = np.mean([np.asarray(inputs[name], dtype=np.float32).reshape(len(inputs[name]), -1).mean(axis=1)
+                     for name in spec['inputs']], axis=0)
+    ramp = np.linspace(0, 1, spec['outputs'], dtype=np.float32)
+    return means[:, None] * ramp[None, :] + ramp[None, ::-1] / 10
+
+
+def instances_to_inputs(spec, instances):
+    """Converts the instances of a REST predict request to an array for each input name."""
+    if isinstance(instances[0], dict):
+        return {name: np.array([instance[name] for instance in instances]) for name in spec['inputs']}
+    name = next(iter(spec['inputs']))
+    return {name: np.array(instances)}
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """Handles TF Serving REST API requests for ``StubServer.models``."""
+    server_version = 'TFServingStub/1.0'
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_model(self):
+        match = MODEL_PATH.match(self.path)
+        if not match or match.group('name') not in self.server.models:
+            self.send_json({'error': 'Servable not found for request: {}'.format(self.path)}, status=404)
+            return None, None
+        return match, self.server.models[match.group('name')]
+
+    def do_GET(self):
+        match, spec = self.get_model()
+        if spec is None:
+            return
+        if match.group('action') == '/metadata':
+            self.send_json(get_metadata(match.group('name'), spec))
+        else:
+            self.send_json({'model_version_status': [
+                {'version': STUB_MODEL_VERSION, 'state': 'AVAILABLE', 'status': {'error_code': 'OK', 'error_message': ''}}
+            ]})
+
+    def do_POST(self):
+        match, spec = self.get_model()
+        if spec is None:
+            return
+        if match.group('action') != ':predict':
+            self.send_json({'error': 'Unsupported request'}, status=400)
+            return
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        predictions = stub_predict(spec, instances_to_inputs(spec, body['instances']))
+        self.send_json({'predictions': predictions.tolist()})
+
+
+class StubServer(ThreadingHTTPServer):
+    """Threaded REST server for stub models.
+
+    Attributes:
+        models (dict): inputs and number of outputs of each model, by name
+    """
+    daemon_threads = True
+
+    def __init__(self, address, models=None):
+        super().__init__(address, StubRequestHandler)
+        self.models = models or STUB_MODELS
+
+
+def create_grpc_server(port, models=None, max_workers=4, host='localhost'):
+    """Creates a gRPC server with a stub ``PredictionService``.
+
+    Args:
+        port (int): port to listen on, or 0 for any free port
+        models (dict, optional): inputs and number of outputs of each model, by name
+        host (str): address to listen on
+
+    Returns:
+        2-tuple of (grpc.Server, int): server, which is not yet started, and its port
+    """
+    grpc, _, _, _, predict_pb2, prediction_service_pb2_grpc = _load_grpc()
+    models = models or STUB_MODELS
+
+    class StubPredictionService(prediction_service_pb2_grpc.PredictionServiceServicer):
+        def Predict(self, request, context):
+            spec = models.get(request.model_spec.name)
+            if spec is None:
+                context.abort(grpc.StatusCode.NOT_FOUND, 'Servable not found: {}'.format(request.model_spec.name))
+            inputs = {name: tensor_proto_to_array(proto) for name, proto in request.inputs.items()}
+            response = predict_pb2.PredictResponse()
+            response.model_spec.name = request.model_spec.name
+            response.model_spec.version.value = int(STUB_MODEL_VERSION)
+            response.outputs['output_0'].CopyFrom(make_tensor_proto(stub_predict(spec, inputs)))
+            return response
+
+    # Like tensorflow serving, accept messages of any size
+    options = [('grpc.max_receive_message_length', -1), ('grpc.max_send_message_length', -1)]
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers), options=options)
+    prediction_service_pb2_grpc.add_PredictionServiceServicer_to_server(StubPredictionService(), server)
+    port = server.add_insecure_port('{}:{}'.format(host, port))
+    return server, port
+
+
+def start_stub_servers(port=0, grpc_port=None, models=None, host='localhost'):
+    """Starts stub REST and optionally gRPC servers in background threads.
+
+    Args:
+        port (int): REST port, or 0 for any free port
+        grpc_port (int, optional): gRPC port, 0 for any free port, or None to not start a gRPC server
+        models (dict, optional): inputs and number of outputs of each model, by name
+        host (str): address to listen on
+
+    Returns:
+        3-tuple of (StubServer, grpc.Server, int): REST server, gRPC server
+            or None, and gRPC port or None. The REST port is ``server.server_port``.
+    """
+    server = StubServer((host, port), models)
+    threading.Thread(target=server.serve_forever, name='tfserving-stub', daemon=True).start()
+    grpc_server = None
+    if grpc_port is not None:
+        grpc_server, grpc_port = create_grpc_server(grpc_port, models, host=host)
+        grpc_server.start()
+    return server, grpc_server, grpc_port
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--host', default='localhost', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8501, help='REST API port')
+    parser.add_argument('--grpc-port', type=int, default=None, help='gRPC API port, not started by default')
+    args = parser.parse_args()
+
+    server, grpc_server, grpc_port = start_stub_servers(args.port, args.grpc_port, host=args.host)
+    print('Serving stub models {} on REST port {}{}'.format(
+        ', '.join(sorted(server.models)), server.server_port,
+        ' and gRPC port {}'.format(grpc_port) if grpc_server else ''))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
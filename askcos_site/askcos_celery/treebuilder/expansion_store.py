@@ -0,0 +1,103 @@
+"""
+Persistent store of template application results for the MCTS tree builder.
+
+Intermediates such as common building blocks are expanded in nearly every
+tree search. The ``ExpansionStore`` keeps the outcomes of applying a template
+to a chemical in MongoDB, so that later searches with the same settings can
+reuse them instead of sending the template application to a worker.
+"""
+
+import datetime
+import os
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from ..cache import LRUCache, make_key
+
+EXPANSION_STORE_TTL = int(os.environ.get('MCTS_EXPANSION_STORE_TTL', 7 * 86400))
+EXPANSION_STORE_LOCAL_SIZE = int(os.environ.get('MCTS_EXPANSION_STORE_LOCAL_SIZE', 100000))
+
+
+class ExpansionStore(object):
+    """Stores outcomes of template applications keyed by chemical, template and search settings.
+
+    Outcomes are stored without the pathway ID, which is specific to a
+    search, as lists of (smiles, template_idx, precursors, value).
+
+    Attributes:
+        collection (pymongo.collection.Collection): collection for stored expansions
+        local (LRUCache): in-process tier in front of the collection
+        ttl (int): seconds before stored expansions expire
+    """
+    def __init__(self, collection, ttl=EXPANSION_STORE_TTL, local_size=EXPANSION_STORE_LOCAL_SIZE):
+        self.collection = collection
+        self.ttl = ttl
+        self.local = LRUCache(maxsize=local_size, ttl=ttl)
+        self.indexes_created = False
+
+    @staticmethod
+    def get_key(smiles, template_idx, settings):
+        """Returns the store key for applying a template to a chemical.
+
+        Args:
+            smiles (str): SMILES string of the expanded chemical
+            template_idx (int): index of the applied template
+            settings (dict): settings which affect outcomes, e.g. template set,
+                model version and fast filter threshold
+        """
+        return make_key('expansion', smiles, template_idx, settings)
+
+    def ensure_indexes(self):
+        """Creates the TTL index used to expire old expansions."""
+        if self.indexes_created:
+            return
+        try:
+            self.collection.create_index('created', expireAfterSeconds=self.ttl)
+        except PyMongoError as e:
+            print('Could not create expansion store index: {}'.format(e))
+        self.indexes_created = True
+
+    def get_many(self, keys):
+        """Looks up stored outcomes for several keys.
+
+        Returns:
+            dict: outcomes keyed by store key, for keys which were found
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            outcomes = self.local.get(key)
+            if outcomes is not None:
+                found[key] = outcomes
+            else:
+                missing.append(key)
+        if missing:
+            try:
+                for doc in self.collection.find({'_id': {'$in': missing}}, {'outcomes': 1}):
+                    found[doc['_id']] = doc['outcomes']
+                    self.local.set(doc['_id'], doc['outcomes'])
+            except PyMongoError as e:
+                print('Could not read from expansion store: {}'.format(e))
+        return found
+
+    def set_many(self, expansions):
+        """Stores outcomes for several expansions.
+
+        Args:
+            expansions (dict): outcomes keyed by store key
+        """
+        if not expansions:
+            return
+        self.ensure_indexes()
+        now = datetime.datetime.utcnow()
+        docs = []
+        for key, outcomes in expansions.items():
+            self.local.set(key, outcomes)
+            docs.append({'_id': key, 'outcomes': outcomes, 'created': now})
+        try:
+            self.collection.insert_many(docs, ordered=False)
+        except BulkWriteError:
+            # Expansions stored concurrently by another search are duplicates
+            pass
+        except PyMongoError as e:
+            print('Could not write to expansion store: {}'.format(e))
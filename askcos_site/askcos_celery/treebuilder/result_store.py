@@ -0,0 +1,431 @@
+"""
+Chunked, compressed storage of saved tree builder results.
+
+A result is stored as a small document in the results collection, holding
+the settings, the tree status and a description of the stored data, and as
+zlib compressed chunks in the ``result_chunks`` collection of the same
+database. Paths are split into chunks of ``RESULT_CHUNK_PATHS`` trees, and
+every chunk is split further into pieces of at most ``RESULT_CHUNK_BYTES``,
+so results are not limited by the MongoDB document size.
+
+SMILES strings and template IDs repeat across trees and the chemical graph,
+so they are replaced by indices into a string table which is stored once per
+result. ``StoredResult`` reads the chunks and the string table only when
+paths or the graph are accessed. Results saved in the previous format, with
+the whole result in a single document, are read transparently.
+
+An index is saved with each result, holding sort keys of every path (see
+``PATH_SORT_KEYS``) and the graph chunk of every chemical, so that a range
+of sorted paths or the neighborhood of a chemical in the graph can be read
+without reading the whole result.
+"""
+
+import json
+import os
+import zlib
+
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+RESULT_CHUNK_PATHS = int(os.environ.get('RESULT_CHUNK_PATHS', 50))
+RESULT_CHUNK_NODES = int(os.environ.get('RESULT_CHUNK_NODES', 500))
+RESULT_CHUNK_BYTES = int(os.environ.get('RESULT_CHUNK_BYTES', 4 * 1024 * 1024))
+RESULT_COMPRESSION_LEVEL = 6
+STORAGE_FORMAT = 'chunked'
+STORAGE_VERSION = 2
+PATH_SORT_KEYS = ('index', 'depth', 'num_reactions', 'plausibility', 'price')
+
+# Keys whose string values (or lists of strings) are stored in the string table
+INTERNED_KEYS = ('smiles', 'tforms', 'necessary_reagent')
+INTERNED_PREFIX = '@'
+
+
+def get_chunks_collection(collection):
+    """Returns the chunk collection for a results collection."""
+    return collection.database['result_chunks']
+
+
+def ensure_indexes(collection):
+    """Creates the index used to read the chunks of a result in order."""
+    try:
+        get_chunks_collection(collection).create_index(
+            [('result_id', ASCENDING), ('part', ASCENDING), ('n', ASCENDING), ('piece', ASCENDING)]
+        )
+    except PyMongoError as e:
+        print('Could not create result chunk index: {}'.format(e))
+
+
+class StringTable(object):
+    """Table of unique strings, assigning each string an index."""
+    def __init__(self):
+        self.strings = []
+        self.indices = {}
+
+    def intern(self, value):
+        index = self.indices.get(value)
+        if index is None:
+            index = self.indices[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+
+def encode_strings(obj, table):
+    """Returns a copy of a JSON object with interned values replaced by string table indices.
+
+    Keys of replaced values are prefixed with ``INTERNED_PREFIX``.
+    """
+    if isinstance(obj, dict):
+        encoded = {}
+        for key, value in obj.items():
+            if key in INTERNED_KEYS and isinstance(value, str):
+                encoded[INTERNED_PREFIX + key] = table.intern(value)
+            elif key in INTERNED_KEYS and isinstance(value, list) and all(isinstance(x, str) for x in value):
+                encoded[INTERNED_PREFIX + key] = [table.intern(x) for x in value]
+            else:
+                encoded[key] = encode_strings(value, table)
+        return encoded
+    if isinstance(obj, (list, tuple)):
+        return [encode_strings(x, table) for x in obj]
+    return obj
+
+
+def decode_strings(obj, strings):
+    """Reverses ``encode_strings``."""
+    if isinstance(obj, dict):
+        decoded = {}
+        for key, value in obj.items():
+            if key.startswith(INTERNED_PREFIX) and key[len(INTERNED_PREFIX):] in INTERNED_KEYS:
+                key = key[len(INTERNED_PREFIX):]
+                decoded[key] = [strings[x] for x in value] if isinstance(value, list) else strings[value]
+            else:
+                decoded[key] = decode_strings(value, strings)
+        return decoded
+    if isinstance(obj, list):
+        return [decode_strings(x, strings) for x in obj]
+    return obj
+
+
+def compress(obj):
+    # Values which are not JSON serializable, e.g. ObjectIds, are stored as strings
+    data = json.dumps(obj, separators=(',', ':'), default=str)
+    return zlib.compress(data.encode('utf-8'), RESULT_COMPRESSION_LEVEL)
+
+
+def decompress(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def make_chunk_docs(result_id, part, n, data):
+    """Splits compressed data into chunk documents of at most ``RESULT_CHUNK_BYTES``."""
+    return [
+        {
+            '_id': '{}:{}:{}:{}'.format(result_id, part, n, piece),
+            'result_id': result_id,
+            'part': part,
+            'n': n,
+            'piece': piece,
+            'data': data[start:start + RESULT_CHUNK_BYTES],
+        }
+        for piece, start in enumerate(range(0, max(len(data), 1), RESULT_CHUNK_BYTES))
+    ]
+
+
+def get_path_sort_keys(path):
+    """Returns the sort keys of a path, a tree of alternating chemical and reaction nodes.
+
+    Returns:
+        dict: longest chain of reactions (depth), number of reactions,
+            product of reaction plausibilities and total price of the
+            starting materials
+    """
+    keys = {'depth': 0, 'num_reactions': 0, 'plausibility': 1.0, 'price': 0.0}
+
+    def visit(chemical, depth):
+        reactions = chemical.get('children') or []
+        if not reactions:
+            keys['price'] += chemical.get('ppg') or 0.0
+        for reaction in reactions:
+            keys['num_reactions'] += 1
+            keys['depth'] = max(keys['depth'], depth + 1)
+            plausibility = reaction.get('plausibility')
+            if isinstance(plausibility, (int, float)):
+                keys['plausibility'] *= plausibility
+            for child in reaction.get('children') or []:
+                visit(child, depth + 1)
+
+    if isinstance(path, dict):
+        visit(path, 0)
+    return keys
+
+
+def build_index(paths, graph_nodes=None):
+    """Builds the index saved with a result.
+
+    Args:
+        paths (list): paths of the result
+        graph_nodes (dict, optional): graph chunk of each chemical
+
+    Returns:
+        dict: sort keys of the paths, as one list per key, and graph chunk
+            of each chemical
+    """
+    path_keys = {key: [] for key in PATH_SORT_KEYS if key != 'index'}
+    for path in paths:
+        for key, value in get_path_sort_keys(path).items():
+            path_keys[key].append(value)
+    return {'paths': path_keys, 'graph_nodes': graph_nodes}
+
+
+def save_result(collection, result_id, result, settings):
+    """Saves a tree builder result as a result document, compressed chunks and an index.
+
+    Args:
+        collection (pymongo.collection.Collection): results collection
+        result_id (str): ID of the result, usually the celery task ID
+        result (dict): status, paths and graph of the search
+        settings (dict): settings of the search
+
+    Returns:
+        dict: storage description saved with the result
+    """
+    table = StringTable()
+    paths = result.get('paths') or []
+    graph = result.get('graph')
+    chunks = []
+
+    num_path_chunks = 0
+    for n, start in enumerate(range(0, len(paths), RESULT_CHUNK_PATHS)):
+        data = compress(encode_strings(paths[start:start + RESULT_CHUNK_PATHS], table))
+        chunks.extend(make_chunk_docs(result_id, 'paths', n, data))
+        num_path_chunks += 1
+
+    # Graphs keyed by chemical are split so that the neighborhood of a chemical can be read alone
+    graph_nodes = None
+    if isinstance(graph, dict) and graph:
+        graph_nodes = {}
+        items = list(graph.items())
+        num_graph_chunks = 0
+        for n, start in enumerate(range(0, len(items), RESULT_CHUNK_NODES)):
+            part = dict(items[start:start + RESULT_CHUNK_NODES])
+            graph_nodes.update((smiles, n) for smiles in part)
+            chunks.extend(make_chunk_docs(result_id, 'graph', n, compress(encode_strings(part, table))))
+            num_graph_chunks += 1
+    else:
+        chunks.extend(make_chunk_docs(result_id, 'graph', 0, compress(encode_strings(graph, table))))
+        num_graph_chunks = 1
+
+    chunks.extend(make_chunk_docs(result_id, 'strings', 0, compress(table.strings)))
+    chunks.extend(make_chunk_docs(result_id, 'index', 0, compress(build_index(paths, graph_nodes))))
+
+    storage = {
+        'format': STORAGE_FORMAT,
+        'version': STORAGE_VERSION,
+        'compression': 'zlib',
+        'num_paths': len(paths),
+        'path_chunk_size': RESULT_CHUNK_PATHS,
+        'num_path_chunks': num_path_chunks,
+        'num_graph_chunks': num_graph_chunks,
+        'graph_by_chemical': graph_nodes is not None,
+        'num_strings': len(table.strings),
+        'stored_bytes': sum(len(chunk['data']) for chunk in chunks),
+    }
+    doc = {
+        '_id': result_id,
+        'settings': settings,
+        'status': result.get('status'),
+        'storage': storage,
+    }
+    # Write chunks first, so a result document is never visible without its chunks
+    chunks_collection = get_chunks_collection(collection)
+    chunks_collection.insert_many(chunks, ordered=False)
+    collection.insert_one(doc)
+    return storage
+
+
+def delete_result(collection, result_id):
+    """Deletes a result document and its chunks."""
+    collection.delete_one({'_id': result_id})
+    get_chunks_collection(collection).delete_many({'result_id': result_id})
+
+
+def load_result(collection, result_id):
+    """Returns a ``StoredResult`` for a saved result, or None if it does not exist."""
+    doc = collection.find_one({'_id': result_id})
+    if doc is None:
+        return None
+    return StoredResult(collection, doc)
+
+
+class StoredResult(object):
+    """Saved tree builder result which reads its chunks when they are first accessed.
+
+    Results saved without an index (in a single document, or by an earlier
+    version of ``save_result``) are indexed when the index is first needed,
+    by reading the whole result.
+
+    Attributes:
+        id (str): ID of the result
+        settings (dict): settings of the search
+        status: tree status of the search
+        storage (dict): storage description, or None for results saved in a single document
+    """
+    def __init__(self, collection, doc):
+        self.collection = collection
+        self.doc = doc
+        self.id = doc['_id']
+        self.settings = doc.get('settings')
+        self.storage = doc.get('storage')
+        self.status = doc['status'] if self.storage else (doc.get('result') or {}).get('status')
+        self._strings = None
+        self._index = None
+        self._path_chunks = {}
+        self._graph_chunks = {}
+
+    @property
+    def num_paths(self):
+        if self.storage:
+            return self.storage['num_paths']
+        return len((self.doc.get('result') or {}).get('paths') or [])
+
+    def read_chunk(self, part, n):
+        """Reads, joins and decompresses the pieces of a chunk."""
+        pieces = get_chunks_collection(self.collection).find(
+            {'result_id': self.id, 'part': part, 'n': n}, {'data': 1}
+        ).sort('piece', ASCENDING)
+        return decompress(b''.join(bytes(piece['data']) for piece in pieces))
+
+    @property
+    def strings(self):
+        if self._strings is None:
+            self._strings = self.read_chunk('strings', 0)
+        return self._strings
+
+    @property
+    def index(self):
+        if self._index is None:
+            if self.storage and self.storage.get('version', 1) >= 2:
+                self._index = self.read_chunk('index', 0)
+            else:
+                self._index = build_index(self.paths)
+        return self._index
+
+    def get_path_chunk(self, n):
+        """Returns the paths in chunk ``n``."""
+        if n not in self._path_chunks:
+            if self.storage:
+                self._path_chunks[n] = decode_strings(self.read_chunk('paths', n), self.strings)
+            else:
+                paths = (self.doc.get('result') or {}).get('paths') or []
+                self._path_chunks[n] = paths[n * RESULT_CHUNK_PATHS:(n + 1) * RESULT_CHUNK_PATHS]
+        return self._path_chunks[n]
+
+    def iter_path_chunks(self, start=0, stop=None):
+        """Yields lists of paths, one chunk at a time.
+
+        Args:
+            start (int): index of the first chunk
+            stop (int, optional): index after the last chunk
+        """
+        chunk_size = self.storage['path_chunk_size'] if self.storage else RESULT_CHUNK_PATHS
+        num_chunks = (self.num_paths + chunk_size - 1) // chunk_size
+        for n in range(start, num_chunks if stop is None else min(stop, num_chunks)):
+            yield self.get_path_chunk(n)
+
+    @property
+    def paths(self):
+        return [path for chunk in self.iter_path_chunks() for path in chunk]
+
+    def get_paths(self, indices):
+        """Returns the paths at the given indices, reading only the chunks containing them."""
+        chunk_size = self.storage['path_chunk_size'] if self.storage else RESULT_CHUNK_PATHS
+        return [self.get_path_chunk(i // chunk_size)[i % chunk_size] for i in indices]
+
+    def get_sorted_indices(self, sort='index'):
+        """Returns the indices of all paths in sorted order.
+
+        Args:
+            sort (str): one of ``PATH_SORT_KEYS``, prefixed with '-' for descending order
+        """
+        descending = sort.startswith('-')
+        key = sort.lstrip('-')
+        if key not in PATH_SORT_KEYS:
+            raise ValueError('Invalid sort key: {}'.format(key))
+        indices = list(range(self.num_paths))
+        if key != 'index':
+            values = self.index['paths'][key]
+            # Stable in both directions, so ties keep their original order
+            indices.sort(key=lambda i: -values[i] if descending else values[i])
+        elif descending:
+            indices.reverse()
+        return indices
+
+    def get_graph_chunk(self, n):
+        if n not in self._graph_chunks:
+            self._graph_chunks[n] = decode_strings(self.read_chunk('graph', n), self.strings)
+        return self._graph_chunks[n]
+
+    @property
+    def graph(self):
+        if not self.storage:
+            return (self.doc.get('result') or {}).get('graph')
+        if not self.storage.get('graph_by_chemical'):
+            return self.get_graph_chunk(0)
+        graph = {}
+        for n in range(self.storage['num_graph_chunks']):
+            graph.update(self.get_graph_chunk(n))
+        return graph
+
+    def get_graph_node(self, smiles):
+        """Returns the reactions of a chemical in the graph, or None if it is not in the graph."""
+        if self.storage and self.storage.get('graph_by_chemical'):
+            n = (self.index.get('graph_nodes') or {}).get(smiles)
+            return None if n is None else self.get_graph_chunk(n).get(smiles)
+        graph = self.graph
+        return graph.get(smiles) if isinstance(graph, dict) else None
+
+    def get_subgraph(self, root, depth=1):
+        """Returns the part of the graph within ``depth`` reactions of a chemical.
+
+        The graph maps each chemical to its reactions, and the precursors of
+        a reaction are the chemicals in its ``smiles``.
+
+        Args:
+            root (str): SMILES string of the chemical
+            depth (int): number of reaction steps to follow from ``root``
+
+        Returns:
+            dict: reactions of each chemical in the neighborhood of ``root``
+
+        Raises:
+            KeyError: if the chemical is not in the graph
+        """
+        node = self.get_graph_node(root)
+        if node is None:
+            raise KeyError(root)
+        subgraph = {root: node}
+        frontier = [root]
+        for _ in range(depth):
+            next_frontier = []
+            for smiles in frontier:
+                for reaction in subgraph[smiles] or []:
+                    precursors = reaction.get('smiles') if isinstance(reaction, dict) else None
+                    for precursor in (precursors or '').split('.'):
+                        if precursor and precursor not in subgraph:
+                            subgraph[precursor] = self.get_graph_node(precursor) or []
+                            next_frontier.append(precursor)
+            frontier = next_frontier
+        return subgraph
+
+    def to_doc(self):
+        """Returns the result in the single document format, with status, paths and graph."""
+        if not self.storage:
+            return self.doc
+        return {
+            '_id': self.id,
+            'result': {
+                'status': self.status,
+                'paths': self.paths,
+                'graph': self.graph,
+            },
+            'settings': self.settings,
+        }
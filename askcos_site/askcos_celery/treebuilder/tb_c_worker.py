@@ -8,44 +8,162 @@ class, is used for prioritization. Each worker pre-loads a
 transformer and grabs templates from the database.
 """
 
+import os
+import threading
+import time
+
 import numpy as np
-import requests
 import rdkit.Chem as Chem
 from celery import shared_task
-from celery.signals import celeryd_init
+from celery.signals import celeryd_init, task_prerun, worker_shutdown
+from kombu import Exchange, Queue
 from rdkit import RDLogger
 from rdkit.Chem import AllChem
 from scipy.special import softmax
 
 from askcos.utilities.fingerprinting import create_rxn_Morgan2FP_separately
-from ..tfserving import TFServingAPIModel
+from ..cache import TieredCache
+from ..scheduling import record_queue_wait
+from ..tfserving import TFServingAPIModel, get_session
+from ..worker_leases import (
+    WORKER_LEASE_TTL, WorkerLease, clear_reservation, get_private_queue, grant_lease, is_reserved,
+    lease_expired, release_lease
+)
+from ..worker_registry import start_heartbeat, unregister_worker
 
 lg = RDLogger.logger()
 lg.setLevel(RDLogger.CRITICAL)
 CORRESPONDING_QUEUE = 'tb_c_worker'
 CORRESPONDING_RESERVABLE_QUEUE = 'tb_c_worker_reservable'
+TEMPLATE_RELEVANCE_METADATA_TTL = float(os.environ.get('TEMPLATE_RELEVANCE_METADATA_TTL', 600))
+TEMPLATE_RELEVANCE_CACHE_SIZE = int(os.environ.get('TEMPLATE_RELEVANCE_CACHE_SIZE', 10000))
+TEMPLATE_RELEVANCE_CACHE_TTL = float(os.environ.get('TEMPLATE_RELEVANCE_CACHE_TTL', 86400))
+TEMPLATE_RELEVANCE_CACHE_REDIS = os.environ.get('TEMPLATE_RELEVANCE_CACHE_REDIS', 'False') in ['True', 'true', '1']
+RETRO_RESULT_CACHE_SIZE = int(os.environ.get('RETRO_RESULT_CACHE_SIZE', 256))
+RETRO_RESULT_CACHE_TTL = float(os.environ.get('RETRO_RESULT_CACHE_TTL', 86400))
 retroTransformer = None
+worker_hostname = None
+loaded_template_sets = []
+
+# Process-wide registry of tf serving model clients
+template_relevance_models = {}
+fast_filter_model = None
+model_registry_lock = threading.Lock()
+
+# Template relevance predictions, keyed by (canonical smiles, model url, served version, prediction settings)
+template_relevance_cache = TieredCache(
+    'template_relevance',
+    maxsize=TEMPLATE_RELEVANCE_CACHE_SIZE,
+    ttl=TEMPLATE_RELEVANCE_CACHE_TTL,
+    use_redis=TEMPLATE_RELEVANCE_CACHE_REDIS,
+)
+
+# Postprocessed get_top_precursors results, keyed by a hash of the request (see api2.retro)
+retro_result_cache = TieredCache(
+    'retro_result',
+    maxsize=RETRO_RESULT_CACHE_SIZE,
+    ttl=RETRO_RESULT_CACHE_TTL,
+    use_redis=True,
+)
 
 
 class TemplateRelevanceAPIModel(TFServingAPIModel):
     """Template relevance Tensorflow API Model. Overrides input and output transformation methods with template relevance specific methods.
 
+    Model metadata (input dimension and served version) is fetched once and
+    refreshed only after ``metadata_ttl`` seconds have passed, so instances
+    can be shared between tasks via ``get_template_relevance_model``.
+    Predictions are cached in ``template_relevance_cache``.
+
     Attributes:
         hostname (str): hostname of service serving tf model.
         model_name (str): Name of model provided to tf serving.
         version (int): version of the model to use when serving
+        metadata_ttl (float): seconds before model metadata is refreshed
+        served_version (str): version of the model reported by tf serving
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, metadata_ttl=TEMPLATE_RELEVANCE_METADATA_TTL, **kwargs):
         super().__init__(*args, **kwargs)
-        self.metaurl = self.baseurl+'/metadata'
-        self.fp_length = self.get_input_dim()
-
-    def get_input_dim(self):
-        resp = requests.get(self.metaurl)
-        metadata = resp.json()['metadata']['signature_def']['signature_def']['serving_default']
-        input_dim = int(list(metadata['inputs'].values())[0]['tensor_shape']['dim'][1]['size'])
+        self.metadata_ttl = metadata_ttl
+        self.metadata_time = None
+        self.served_version = None
+        self._fp_length = None
+        self._metadata_lock = threading.Lock()
+        self.refresh_metadata()
+
+    @property
+    def fp_length(self):
+        """Input fingerprint length of the served model, refreshed when the metadata expires."""
+        if time.time() - self.metadata_time > self.metadata_ttl:
+            try:
+                self.refresh_metadata()
+            except Exception as e:
+                # Keep using the previous metadata until the next refresh succeeds
+                print('Could not refresh template relevance metadata from {}: {}'.format(self.metaurl, e))
+                self.metadata_time = time.time()
+        return self._fp_length
+
+    def get_served_version(self):
+        """Returns the version of the model reported by tf serving, refreshed when the metadata expires."""
+        self.fp_length
+        return self.served_version
+
+    def get_input_dim(self, metadata=None):
+        if metadata is None:
+            metadata = self.get_metadata()
+        signature = metadata['metadata']['signature_def']['signature_def']['serving_default']
+        input_dim = int(list(signature['inputs'].values())[0]['tensor_shape']['dim'][1]['size'])
         return input_dim
 
+    def get_input_name(self, metadata=None):
+        if metadata is None:
+            metadata = self.get_metadata()
+        signature = metadata['metadata']['signature_def']['signature_def']['serving_default']
+        return list(signature['inputs'].keys())[0]
+
+    def refresh_metadata(self):
+        """Fetches model metadata and updates the input dimension and served version."""
+        with self._metadata_lock:
+            metadata = self.get_metadata()
+            served_version = metadata.get('model_spec', {}).get('version')
+            if self._fp_length is None or served_version != self.served_version:
+                if self.served_version is not None:
+                    print('Template relevance model at {} changed from version {} to {}'.format(
+                        self.baseurl, self.served_version, served_version))
+                self._fp_length = self.get_input_dim(metadata)
+                self.input_name = self.get_input_name(metadata)
+                self.served_version = served_version
+            self.metadata_time = time.time()
+
+    def predict(self, smiles, max_num_templates=100, max_cum_prob=0.995, fp_radius=2, **kwargs):
+        """Returns the top template scores and indices for a molecule, using cached predictions when available.
+
+        Args:
+            smiles (str): SMILES string of input molecule
+            max_num_templates (int): Maximum number of template scores/indices to return from the prediction
+            max_cum_prob (float): Maximum cumulative probability of templates to be returned
+            fp_radius (int): Radius of desired fingerprint
+
+        Returns:
+            2-tuple of (np.array, np.array): template scores and indices
+        """
+        mol = Chem.MolFromSmiles(smiles)
+        canonical_smiles = Chem.MolToSmiles(mol, isomericSmiles=True) if mol else smiles
+        fp_length = self.fp_length  # refreshes served_version if the metadata expired
+        key = (canonical_smiles, self.baseurl, self.served_version, fp_length,
+               max_num_templates, max_cum_prob, fp_radius)
+
+        cached = template_relevance_cache.get(key)
+        if cached is not None:
+            scores, indices = cached
+            return np.array(scores, dtype=np.float64), np.array(indices, dtype=np.int64)
+
+        scores, indices = super().predict(
+            smiles, max_num_templates=max_num_templates, max_cum_prob=max_cum_prob, fp_radius=fp_radius, **kwargs
+        )
+        template_relevance_cache.set(key, (scores.tolist(), indices.tolist()))
+        return scores, indices
+
     def transform_input(self, smiles, fp_radius=2, **kwargs):
         """Transforms the input for the API model from a SMILES string to a fingerprint bit vector
 
@@ -54,16 +172,17 @@ class TemplateRelevanceAPIModel(TFServingAPIModel):
             fp_radius (int): Radius of desired fingerprint. Should agree with parameter sed when model was trained
 
         Returns:
-            list: Fingerprint bit vector as a list
+            np.array: Fingerprint bit vector with shape (1, fp_length)
         """
+        fp_length = self.fp_length
         mol = Chem.MolFromSmiles(smiles)
         if not mol:
-            return np.zeros((self.fp_length,), dtype=np.float32)
+            return np.zeros((1, fp_length), dtype=np.float32)
         return np.array(
             AllChem.GetMorganFingerprintAsBitVect(
-                mol, fp_radius, nBits=self.fp_length, useChirality=True
+                mol, fp_radius, nBits=fp_length, useChirality=True
             ), dtype=np.float32
-        ).reshape(1, -1).tolist()
+        ).reshape(1, -1)
     
     def transform_output(self, pred, max_num_templates=100, max_cum_prob=0.995, **kwargs):
         """Transforms output of API model to return the top scores and indices for the output classes (templates)
@@ -103,7 +222,7 @@ class FastFilterAPIModel(TFServingAPIModel):
             useFeatures (bool): Flag to use features or not when generating fingerprint. Should agree with how model was trained
 
         Returns:
-            list of dict: Input fingerprints, formatted for a call to the tensorflow API model
+            list of dict: Input fingerprint arrays, formatted for a call to the tensorflow API model
         """
         pfp, rfp = create_rxn_Morgan2FP_separately(
             reactant_smiles, target, rxnfpsize=rxnfpsize, pfpsize=pfpsize, useFeatures=useFeatures
@@ -112,8 +231,8 @@ class FastFilterAPIModel(TFServingAPIModel):
         rfp = np.asarray(rfp, dtype='float32')
         rxnfp = pfp - rfp
         return [{
-            'input_1': pfp.tolist(),
-            'input_2': rxnfp.tolist()
+            'input_1': pfp,
+            'input_2': rxnfp
         }]
     
     def transform_output(self, pred):
@@ -128,6 +247,67 @@ class FastFilterAPIModel(TFServingAPIModel):
         return pred[0]
 
 
+class CachedFastFilter(object):
+    """Fast filter callable which remembers scores of reactant/target pairs.
+
+    ``RetroTransformer`` scores each outcome separately, and different
+    templates frequently produce the same precursors. Wrapping the fast
+    filter avoids repeating API requests for those duplicates.
+
+    Attributes:
+        model (FastFilterAPIModel): API model used to score unknown pairs.
+        scores (dict): cached scores keyed by (reactant_smiles, target)
+    """
+    def __init__(self, model):
+        self.model = model
+        self.scores = {}
+
+    def __call__(self, reactant_smiles, target):
+        key = (reactant_smiles, target)
+        score = self.scores.get(key)
+        if score is None:
+            score = self.scores[key] = self.model.predict(reactant_smiles, target)
+        return score
+
+
+def get_template_relevance_model(template_set='reaxys', version=None):
+    """Returns the shared template relevance API model for a template set and model version.
+
+    Models are created once per process and reused by all tasks, so metadata
+    requests are only made when the cached metadata expires.
+
+    Args:
+        template_set (str): Name of template set, which determines the tf serving host.
+        version (int, optional): Model version to use. None or 0 uses the latest model.
+
+    Returns:
+        TemplateRelevanceAPIModel: shared model instance
+    """
+    key = (template_set, version or None)
+    model = template_relevance_models.get(key)
+    if model is None:
+        with model_registry_lock:
+            model = template_relevance_models.get(key)
+            if model is None:
+                model = TemplateRelevanceAPIModel(
+                    hostname='template-relevance-{}'.format(template_set),
+                    model_name='template_relevance',
+                    version=version,
+                )
+                template_relevance_models[key] = model
+    return model
+
+
+def get_fast_filter_model():
+    """Returns the shared fast filter API model for this process."""
+    global fast_filter_model
+    if fast_filter_model is None:
+        with model_registry_lock:
+            if fast_filter_model is None:
+                fast_filter_model = FastFilterAPIModel('fast-filter', 'fast_filter')
+    return fast_filter_model
+
+
 @celeryd_init.connect
 def configure_worker(options={}, **kwargs):
     """Configures worker and instantiates RetroTransformer.
@@ -148,9 +328,71 @@ def configure_worker(options={}, **kwargs):
     global retroTransformer
     retroTransformer = RetroTransformer(template_prioritizer=None, fast_filter=None)
     retroTransformer.load()
+
+    # Announce readiness to coordinators through the worker registry
+    global worker_hostname, loaded_template_sets
+    worker_hostname = kwargs.get('sender') or CORRESPONDING_QUEUE
+    loaded_template_sets = get_template_sets()
+    if is_reserved(CORRESPONDING_QUEUE, worker_hostname):
+        # Left over from before a restart, the worker starts on the shared queues
+        release_lease(CORRESPONDING_QUEUE, worker_hostname)
+        clear_reservation(CORRESPONDING_QUEUE, worker_hostname)
+    start_heartbeat(CORRESPONDING_QUEUE, worker_hostname, get_worker_info, on_beat=check_lease)
     print('### TREE BUILDER WORKER STARTED UP ###')
 
 
+@worker_shutdown.connect
+def shutdown_worker(**kwargs):
+    """Removes this worker from the worker registry and releases any reservation."""
+    if worker_hostname is not None:
+        unregister_worker(CORRESPONDING_QUEUE, worker_hostname)
+        release_lease(CORRESPONDING_QUEUE, worker_hostname)
+        clear_reservation(CORRESPONDING_QUEUE, worker_hostname)
+
+
+@task_prerun.connect
+def record_task_queue_wait(task=None, **kwargs):
+    """Records how long a task published with lane options waited in the queue."""
+    if task is not None:
+        record_queue_wait(task.request)
+
+
+def get_template_sets():
+    """Returns the names of the template sets in the retro template database loaded by the transformer."""
+    import askcos.global_config as gc
+    from pymongo import MongoClient
+    try:
+        client = MongoClient(gc.MONGO['path'], gc.MONGO['id'], connect=gc.MONGO['connect'])
+        return client[gc.RETRO_TEMPLATES['database']][gc.RETRO_TEMPLATES['collection']].distinct('template_set')
+    except Exception as e:
+        print('Could not determine loaded template sets: {}'.format(e))
+        return []
+
+
+def get_worker_info():
+    """Returns details reported in each worker registry heartbeat.
+
+    Returns:
+        dict: loaded template sets, available template relevance model versions
+            for each set and whether the worker pool is reserved
+    """
+    model_versions = {}
+    for template_set in loaded_template_sets:
+        url = 'http://template-relevance-{}:8501/v1/models/template_relevance'.format(template_set)
+        try:
+            status = get_session().get(url, timeout=(1, 2)).json().get('model_version_status', [])
+        except Exception:
+            status = []
+        model_versions[template_set] = sorted(
+            str(model.get('version')) for model in status if model.get('state') == 'AVAILABLE'
+        )
+    return {
+        'template_sets': loaded_template_sets,
+        'model_versions': model_versions,
+        'reserved': is_reserved(CORRESPONDING_QUEUE, worker_hostname),
+    }
+
+
 @shared_task
 def get_top_precursors(
         smiles, precursor_prioritizer=None,
@@ -158,7 +400,7 @@ def get_top_precursors(
         max_cum_prob=1, fast_filter_threshold=0.75,
         cluster=True, cluster_method='kmeans', cluster_feature='original',
         cluster_fp_type='morgan', cluster_fp_length=512, cluster_fp_radius=1,
-        postprocess=False, selec_check=False,
+        postprocess=False, selec_check=False, cache_key=None,
     ):
     """Get the precursors for a chemical defined by its SMILES.
 
@@ -186,19 +428,16 @@ def get_top_precursors(
         cluster_fp_radius (int, optional): Radius to use for fingerprint generation. (default: {1})
         postprocess (bool): Flag for performing post processing.
         selec_check (bool, optional): apply selectivity checking for precursors to find other outcomes. (default: False)
+        cache_key (str, optional): If provided, the postprocessed result is stored in
+            ``retro_result_cache`` under this key. (default: None)
 
     Returns:
         2-tuple of (str, list of dict): SMILES string of input and top
             precursors found.
     """
 
-    template_relevance_hostname = 'template-relevance-{}'.format(template_set)
-    template_prioritizer = TemplateRelevanceAPIModel(
-        hostname=template_relevance_hostname, model_name='template_relevance', version=template_prioritizer_version
-    )
-
-    fast_filter_hostname = 'fast-filter'
-    fast_filter = FastFilterAPIModel(fast_filter_hostname, 'fast_filter').predict
+    template_prioritizer = get_template_relevance_model(template_set, template_prioritizer_version)
+    fast_filter = CachedFastFilter(get_fast_filter_model())
 
     cluster_settings = {
         'cluster_method': cluster_method,
@@ -220,6 +459,8 @@ def get_top_precursors(
     if postprocess:
         for r in result:
             r['templates'] = r.pop('tforms')
+        if cache_key:
+            retro_result_cache.set((cache_key,), result)
         return result
     else:
         return smiles, result
@@ -229,11 +470,7 @@ def template_relevance(
     smiles, max_num_templates, max_cum_prob, 
     template_set='reaxys', template_prioritizer_version=None,
     ):
-    global retroTransformer
-    hostname = 'template-relevance-{}'.format(template_set)
-    template_prioritizer = TemplateRelevanceAPIModel(
-        hostname=hostname, model_name='template_relevance', version=template_prioritizer_version
-    )
+    template_prioritizer = get_template_relevance_model(template_set, template_prioritizer_version)
 
     scores, indices = template_prioritizer.predict(
         smiles, max_num_templates=max_num_templates, max_cum_prob=max_cum_prob
@@ -257,13 +494,8 @@ def apply_one_template_by_idx(*args, **kwargs):
     template_set = kwargs.get('template_set', 'reaxys')
     template_prioritizer_version = kwargs.pop('template_prioritizer_version', None)
 
-    hostname = 'template-relevance-{}'.format(template_set)
-    template_prioritizer = TemplateRelevanceAPIModel(
-        hostname=hostname, model_name='template_relevance', version=template_prioritizer_version
-    )
-
-    fast_filter_hostname = 'fast-filter'
-    fast_filter = FastFilterAPIModel(fast_filter_hostname, 'fast_filter').predict
+    template_prioritizer = get_template_relevance_model(template_set, template_prioritizer_version)
+    fast_filter = get_fast_filter_model().predict
 
     kwargs.update({
         'template_prioritizer': template_prioritizer,
@@ -272,6 +504,38 @@ def apply_one_template_by_idx(*args, **kwargs):
 
     return retroTransformer.apply_one_template_by_idx(*args, **kwargs)
 
+@shared_task
+def apply_templates_by_idx(expansions, **kwargs):
+    """Applies several templates in a single task.
+
+    Equivalent to calling ``apply_one_template_by_idx`` for each expansion,
+    but the broker and result backend overhead is only paid once.
+
+    Args:
+        expansions (list of 3-tuples of (int, str, int)): Pathway ID, SMILES
+            and template index for each template application.
+        **kwargs: Passed to ``RetroTransformer.apply_one_template_by_idx``.
+
+    Returns:
+        list of lists of 5-tuples of (int, str, int, list, float): Result of
+            each template application, in the same order as ``expansions``.
+    """
+    global retroTransformer
+
+    template_set = kwargs.get('template_set', 'reaxys')
+    template_prioritizer_version = kwargs.pop('template_prioritizer_version', None)
+
+    kwargs.update({
+        'template_prioritizer': get_template_relevance_model(template_set, template_prioritizer_version),
+        # Templates applied to the same molecule often give the same precursors
+        'fast_filter': CachedFastFilter(get_fast_filter_model()),
+    })
+
+    return [
+        retroTransformer.apply_one_template_by_idx(_id, smiles, template_idx, **kwargs)
+        for _id, smiles, template_idx in expansions
+    ]
+
 @shared_task
 def fast_filter_check(*args, **kwargs):
     """Wrapper for fast filter check.
@@ -283,26 +547,35 @@ def fast_filter_check(*args, **kwargs):
         list: Reaction outcomes.
     """
     print('got request for fast filter')
-    fast_filter_hostname = 'fast-filter'
-    fast_filter = FastFilterAPIModel(fast_filter_hostname, 'fast_filter')
-    return fast_filter.predict(*args, **kwargs)
+    return get_fast_filter_model().predict(*args, **kwargs)
 
 
 @shared_task(bind=True)
-def reserve_worker_pool(self):
+def reserve_worker_pool(self, lease_id=None, owner=None, ttl=WORKER_LEASE_TTL):
     """Reserves pool of workers.
 
     Called by a tb_coordinator to reserve this pool of workers to do a tree
     expansion. This is accomplished by changing what queue(s) this pool
-    listens to.
+    listens to. The reservation lasts as long as the coordinator renews the
+    lease, see ``askcos_celery.worker_leases``.
+
+    Args:
+        lease_id (str, optional): ID of the lease, generated if not provided
+        owner (str, optional): description of the job reserving the pool
+        ttl (float): seconds before the lease expires unless renewed
 
     Returns:
-        str: Name of the new queue the worker pool listens to.
+        dict or None: hostname, private queue and lease ID of the reserved
+            pool, or None if the pool could not be reserved
     """
     hostname = self.request.hostname
-    private_queue = CORRESPONDING_QUEUE + '_' + hostname
-    print('Tried to reserve this worker!')
-    print('I am {}'.format(hostname))
+    lease_id = lease_id or WorkerLease.new_id()
+    if not grant_lease(CORRESPONDING_QUEUE, hostname, lease_id, owner=owner, ttl=ttl):
+        print('Refused reservation of this worker by {}'.format(owner))
+        return None
+
+    private_queue = get_private_queue(CORRESPONDING_QUEUE, hostname)
+    print('Reserved this worker ({}) for {}'.format(hostname, owner))
     print('Telling myself to ignore the {} and {} queues'.format(
         CORRESPONDING_QUEUE, CORRESPONDING_RESERVABLE_QUEUE))
     from askcos_site.celery import app
@@ -311,25 +584,34 @@ def reserve_worker_pool(self):
         CORRESPONDING_RESERVABLE_QUEUE, destination=[hostname])
 
     # *** purge the queue in case old jobs remain
-    import celery.bin.amqp
-    amqp = celery.bin.amqp.amqp(app=app)
-    amqp.run('queue.purge', private_queue)
+    purge_queue(app, private_queue)
     print('Telling myself to only listen to the new {} queue'.format(private_queue))
     app.control.add_consumer(private_queue, destination=[hostname])
-    return private_queue
+    return {'hostname': hostname, 'queue': private_queue, 'lease_id': lease_id}
 
 
 @shared_task(bind=True)
-def unreserve_worker_pool(self):
+def unreserve_worker_pool(self, lease_id=None):
     """Releases this worker pool so it can listen to the original queues.
 
+    Args:
+        lease_id (str, optional): ID of the lease to release, any lease is
+            released if not provided
+
     Returns:
         True
     """
     hostname = self.request.hostname
-    private_queue = CORRESPONDING_QUEUE + '_' + hostname
+    release_lease(CORRESPONDING_QUEUE, hostname, lease_id)
     print('Tried to unreserve this worker!')
     print('I am {}'.format(hostname))
+    return_to_shared_queues(hostname)
+    return True
+
+
+def return_to_shared_queues(hostname):
+    """Switches a reserved worker pool from its private queue back to the shared queues."""
+    private_queue = get_private_queue(CORRESPONDING_QUEUE, hostname)
     print('Telling myself to ignore the {} queue'.format(private_queue))
     from askcos_site.celery import app
     app.control.cancel_consumer(private_queue, destination=[hostname])
@@ -338,4 +620,21 @@ def unreserve_worker_pool(self):
     app.control.add_consumer(CORRESPONDING_QUEUE, destination=[hostname])
     app.control.add_consumer(
         CORRESPONDING_RESERVABLE_QUEUE, destination=[hostname])
-    return True
+    clear_reservation(CORRESPONDING_QUEUE, hostname)
+
+
+def purge_queue(app, name):
+    """Removes all messages from a queue, declaring it first with the arguments used by ``add_consumer``."""
+    queue = Queue(name, Exchange(name), routing_key=name,
+                  queue_arguments={'x-max-priority': app.conf.task_queue_max_priority})
+    with app.connection_for_write() as conn:
+        bound = queue(conn.default_channel)
+        bound.declare()
+        bound.purge()
+
+
+def check_lease():
+    """Returns this worker pool to the shared queues if its lease expired, e.g. if the coordinator crashed."""
+    if lease_expired(CORRESPONDING_QUEUE, worker_hostname):
+        print('Reservation lease of this worker expired')
+        return_to_shared_queues(worker_hostname)
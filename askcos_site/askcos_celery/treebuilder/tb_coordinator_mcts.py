@@ -7,13 +7,24 @@ to keeping track of the chemical prices using the Pricer module.
 
 The coordinator, finally, returns a set of buyable trees obtained
 from an IDDFS.
+
+Each search runs on its own tree builder spawned from a prototype which
+holds the shared pricer, chemical historian and expansion store. Because
+the search loop mostly waits on workers, a coordinator can serve many
+searches from one process by running with a gevent pool, as done by
+``deploy/start_worker.sh tb_coordinator_mcts``. Searches by the same user
+share worker capacity through fair share task priorities.
 """
 
+import os
+
 from celery import shared_task
 from celery.signals import celeryd_init
 from rdkit import RDLogger
 
-from askcos_site.globals import db_client
+from askcos_site.askcos_celery.scheduling import finish_search, start_search
+from askcos_site.askcos_celery.treebuilder.result_store import ensure_indexes, save_result
+from askcos_site.globals import db_client, pricer, results_collection
 from askcos_site.main.models import SavedResults
 
 lg = RDLogger.logger()
@@ -21,7 +32,7 @@ lg.setLevel(RDLogger.CRITICAL)
 
 CORRESPONDING_QUEUE = 'tb_coordinator_mcts'
 
-results_collection = db_client['results']['results']
+USE_EXPANSION_STORE = os.environ.get('MCTS_EXPANSION_STORE', 'True') in ['True', 'true', '1']
 
 
 def update_result_state(id_, state):
@@ -32,12 +43,8 @@ def update_result_state(id_, state):
 
 
 def save_results(result, settings, task_id):
-    doc = {
-        '_id': task_id,
-        'result': result,
-        'settings': settings
-    }
-    results_collection.insert_one(doc)
+    storage = save_result(results_collection, task_id, result, settings)
+    print('Saved {} paths of result {} in {} bytes'.format(storage['num_paths'], task_id, storage['stored_bytes']))
 
 
 @celeryd_init.connect
@@ -55,11 +62,15 @@ def configure_coordinator(options={}, **kwargs):
         return
     print('### STARTING UP A TREE BUILDER MCTS COORDINATOR ###')
 
+    from .expansion_store import ExpansionStore
     from .tree_builder_celery import MCTSCelery
 
     global treeBuilder
 
-    treeBuilder = MCTSCelery(celery=True, nproc=8)  # 8 active pathways
+    # Prototype tree builder, see get_buyable_paths
+    expansion_store = ExpansionStore(db_client['results']['expansions']) if USE_EXPANSION_STORE else None
+    treeBuilder = MCTSCelery(celery=True, nproc=8, pricer=pricer.load_global(), expansion_store=expansion_store)  # 8 active pathways
+    ensure_indexes(results_collection.load_global())
     print('Finished initializing treebuilder MCTS coordinator')
 
 
@@ -67,6 +78,10 @@ def configure_coordinator(options={}, **kwargs):
 def get_buyable_paths(*args, **kwargs):
     """Wrapper for ``MCTSTreeBuilder.get_buyable_paths`` function.
 
+    The optional ``user`` keyword argument identifies who requested the
+    search, for fair share scheduling of concurrent searches, and
+    ``reserve_workers`` is the number of worker pools to reserve for it.
+
     Returns:
         tree_status ((int, int, dict)): Result of tree_status().
         trees (list of dict): List of dictionaries, where each dictionary
@@ -76,15 +91,24 @@ def get_buyable_paths(*args, **kwargs):
     paths_only = kwargs.pop('paths_only', False)
 
     template_prioritizer_version = kwargs.pop('template_prioritizer_version', None)
-    if template_prioritizer_version:
-        treeBuilder.template_prioritizer_version = template_prioritizer_version
+    user = kwargs.pop('user', None)
+    reserve_workers = kwargs.pop('reserve_workers', 0)
 
+    # Use a separate tree builder for each search so concurrent searches do not share state
+    tree_builder = treeBuilder.spawn()
+    if template_prioritizer_version:
+        tree_builder.template_prioritizer_version = template_prioritizer_version
+    tree_builder.user = user
+    tree_builder.reserve_pools = reserve_workers
 
     print('Treebuilder MCTS coordinator was asked to expand {}'.format(args[0]))
     _id = get_buyable_paths.request.id
+    start_search(user)
     try:
-        status, paths = treeBuilder.get_buyable_paths(*args, **kwargs)
-        graph = treeBuilder.return_chemical_results()
+        status, paths = tree_builder.get_buyable_paths(*args, **kwargs)
+        graph = tree_builder.return_chemical_results()
+        # Later searches start batching from the latency observed in this one
+        treeBuilder.template_latency = tree_builder.template_latency
         result_doc = {
             'status': status,
             'paths': paths,
@@ -94,6 +118,9 @@ def get_buyable_paths(*args, **kwargs):
         if run_async:
             update_result_state(_id, 'failed')
         raise
+    finally:
+        tree_builder.release_workers()
+        finish_search(user)
     if run_async:
         update_result_state(_id, 'completed')
         settings = {'smiles': args[0]}
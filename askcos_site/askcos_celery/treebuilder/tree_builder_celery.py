@@ -2,9 +2,33 @@
 Tree builder subclass using celery for multiprocessing.
 """
 
+import copy
+import os
+import threading
+import time
+from collections import deque
+
 import askcos_site.askcos_celery.treebuilder.tb_c_worker as tb_c_worker
+from askcos_site.askcos_celery.scheduling import (
+    FAIR_SHARE_REFRESH_INTERVAL, get_active_searches, get_lane_options, get_search_priority
+)
+from askcos_site.askcos_celery.worker_leases import WORKER_LEASE_TTL, WorkerLease
+from askcos_site.askcos_celery.worker_registry import get_ready_workers
 from askcos.retrosynthetic.mcts.tree_builder import MCTS, WAITING
 
+# Maximum time to block waiting for a result message when no results are ready
+RESULT_DRAIN_TIMEOUT = float(os.environ.get('MCTS_RESULT_DRAIN_TIMEOUT', 0.01))
+# Template applications are grouped into batches which should take about this many seconds
+BATCH_TARGET_LATENCY = float(os.environ.get('MCTS_BATCH_TARGET_LATENCY', 1.0))
+MAX_BATCH_SIZE = int(os.environ.get('MCTS_MAX_BATCH_SIZE', 32))
+# Maximum time to wait for worker pools to accept a reservation
+RESERVATION_TIMEOUT = float(os.environ.get('MCTS_RESERVATION_TIMEOUT', 10))
+# Weight of the most recent batch in the moving average of latency per template
+BATCH_LATENCY_SMOOTHING = 0.2
+
+# The result consumer is shared by all searches in a process and is not thread safe
+backend_lock = threading.RLock()
+
 
 class MCTSCelery(MCTS):
     """
@@ -19,11 +43,64 @@ class MCTSCelery(MCTS):
     template prioritizer type should be provided to ``get_buyable_paths`` to
     indicate which model to use.
 
-    Attributes:
+    Finished expansions are collected as result messages arrive from the
+    result backend (Redis pub/sub) rather than by polling every pending task.
+    Each result registers a callback which appends it to ``ready_results``,
+    so ``get_ready_result`` does constant work per finished expansion.
+    Under gevent or eventlet, celery reads result messages in a greenlet of
+    its own, which runs the callbacks, so searches only wait for them.
+    Otherwise searches read the messages themselves, one at a time.
+
+    Template applications requested by ``expand`` are buffered and sent as
+    ``apply_templates_by_idx`` batches. The batch size starts at one and is
+    adjusted from the observed latency per template application, so that each
+    batch takes roughly ``BATCH_TARGET_LATENCY`` seconds.
+
+    If an ``expansion_store`` is provided, template applications are looked
+    up there before being sent, and new outcomes are saved to it, so repeated
+    searches can reuse expansions from earlier searches. Stored outcomes are
+    keyed by the template relevance model version served when the search
+    starts, so outcomes of an older model are not reused after a rollout.
+    The store is not used if the served version cannot be determined.
+
+    To run several searches concurrently in one process, keep one instance
+    as a prototype and call ``spawn`` to get an isolated tree builder for
+    each search. Spawned instances share the pricer, chemical historian and
+    expansion store of the prototype.
 
+    Tasks are sent in the batch lane (see ``askcos_celery.scheduling``) with a
+    priority which is lowered while ``user`` runs several searches at once.
+
+    If ``reserve_pools`` is set, ``prepare`` reserves up to that many worker
+    pools for the search and template applications are sent to their private
+    queues. The leases on the pools are renewed while results are collected
+    and released by ``stop``, see ``askcos_celery.worker_leases``. Pools whose
+    lease cannot be renewed are no longer used, and batches still pending in
+    their private queues are revoked and sent again to the remaining pools or
+    the shared queue. If no pool accepts the reservation, the search uses the
+    shared queue.
+
+    Attributes:
+        pending_results (dict): outstanding celery results, keyed by task id
+        ready_results (deque): finished celery results which have not been yielded
+        result_event (threading.Event): set when a result is appended to ``ready_results``
+        expansions_sent (int): number of expansion tasks sent in the current search
+        expansions_done (int): number of expansion results received in the current search
+        expansion_buffer (list): template applications which have not been sent yet
+        batch_info (dict): send time, template applications and queue of each pending batch, keyed by task id
+        template_latency (float): moving average of seconds per template application
+        expansion_store (ExpansionStore): persistent store of template application outcomes
+        stored_outcomes (deque): outcomes found in the expansion store which have not been yielded
+        expansions_stored (int): number of expansions found in the expansion store in the current search
+        served_version (str): template relevance model version served for the current search
+        user (str): user running the search, used for fair share scheduling
+        priority (int): priority of tasks sent for the current search
+        reserve_pools (int): number of worker pools to reserve for each search
+        leases (list of WorkerLease): leases on the worker pools reserved for the current search
     """
 
-    def __init__(self, template_prioritizer=None, precursor_prioritizer=None, fast_filter=None, use_db=True, **kwargs):
+    def __init__(self, template_prioritizer=None, precursor_prioritizer=None, fast_filter=None, use_db=True,
+                 expansion_store=None, **kwargs):
         super().__init__(
             template_prioritizer=template_prioritizer,
             precursor_prioritizer=precursor_prioritizer,
@@ -35,15 +112,64 @@ class MCTSCelery(MCTS):
         from celery.result import allow_join_result
         self.allow_join_result = allow_join_result
         self.template_prioritizer_version = None
+        self.result_consumer = getattr(tb_c_worker.apply_one_template_by_idx.backend, 'result_consumer', None)
+        self.pending_results = {}
+        self.ready_results = deque()
+        self.result_event = threading.Event()
+        self.expansions_sent = 0
+        self.expansions_done = 0
+        self.expansion_buffer = []
+        self.batch_info = {}
+        self.template_latency = None
+        self.expansion_store = expansion_store
+        self.stored_outcomes = deque()
+        self.expansions_stored = 0
+        self.served_version = None
+        self.search_start_time = None
+        self.user = None
+        self.priority = None
+        self.priority_time = 0
+        self.reserve_pools = 0
+        self.leases = []
+        self.lease_index = 0
+
+    def spawn(self):
+        """Returns a new tree builder for a single search.
+
+        Search state is copied from this instance, which should not be used
+        for searches itself, while read-only data is shared.
+
+        Returns:
+            MCTSCelery: isolated tree builder
+        """
+        shared = [
+            getattr(self, 'pricer', None),
+            getattr(self, 'chemhistorian', None),
+            self.expansion_store,
+            self.result_consumer,
+        ]
+        memo = {id(obj): obj for obj in shared if obj is not None}
+        # Events cannot be copied
+        memo[id(self.result_event)] = threading.Event()
+        return copy.deepcopy(self, memo)
 
     def reset_workers(self, soft_reset=False):
         # general parameters in celery format
-        # TODO: anything goes here?
-        self.pending_results = []
+        self.pending_results = {}
+        self.ready_results = deque()
+        self.expansions_sent = 0
+        self.expansions_done = 0
+        self.expansion_buffer = []
+        self.batch_info = {}
+        self.stored_outcomes = deque()
+        self.expansions_stored = 0
 
     def expand(self, _id, smiles, template_idx):  # TODO: make Celery workers
         """Adds pathway to be worked on with Celery.
 
+        The template application is buffered and sent with the next batch
+        by ``send_expansions``.
+
         Args:
             _id (int): ID of pending pathway.
             smiles (str): SMILES string of molecule to be exanded.
@@ -51,33 +177,270 @@ class MCTSCelery(MCTS):
         """
         # Chiral transformation or heuristic prioritization requires
         # same database. _id is _id of active pathway
-        self.pending_results.append(tb_c_worker.apply_one_template_by_idx.apply_async(
-            args=(_id, smiles, template_idx),
-            kwargs={'max_num_templates': self.template_count,
-                    'max_cum_prob': self.max_cum_template_prob,
-                    'fast_filter_threshold': self.filter_threshold,
-                    'template_prioritizer_version': self.template_prioritizer_version,
-                    'template_set': self.template_set},
-            # queue=self.private_worker_queue, ## CWC TEST: don't reserve
-        ))
+        self.expansion_buffer.append((_id, smiles, template_idx))
         self.status[(smiles, template_idx)] = WAITING
         self.active_pathways_pending[_id] += 1
 
-    def prepare(self):
-        """Starts parallelization with Celery."""
+    def get_priority(self):
+        """Returns the task priority for this search, updated from the number of active searches by the user."""
+        now = time.time()
+        if self.priority is None or now - self.priority_time > FAIR_SHARE_REFRESH_INTERVAL:
+            self.priority = get_search_priority(get_active_searches(self.user))
+            self.priority_time = now
+        return self.priority
+
+    def reserve_workers(self):
+        """Reserves up to ``reserve_pools`` worker pools for this search."""
+        results = []
+        with backend_lock:
+            for _ in range(self.reserve_pools):
+                results.append(tb_c_worker.reserve_worker_pool.apply_async(
+                    kwargs={'lease_id': WorkerLease.new_id(), 'owner': str(self.user), 'ttl': WORKER_LEASE_TTL},
+                    **get_lane_options('interactive')
+                ))
+        deadline = time.time() + RESERVATION_TIMEOUT
+        while not all(res.ready() for res in results) and time.time() < deadline:
+            time.sleep(0.05)
+        for res in results:
+            if not res.ready():
+                # A pool which accepts too late is released when its lease expires
+                res.revoke()
+                continue
+            try:
+                reservation = res.get(1)
+            except Exception as e:
+                print('Could not reserve worker pool: {}'.format(e))
+                continue
+            if reservation:
+                self.leases.append(WorkerLease(
+                    tb_c_worker.CORRESPONDING_QUEUE, reservation['hostname'], reservation['lease_id']
+                ))
+        print('Reserved {} of {} requested worker pools'.format(len(self.leases), self.reserve_pools))
+
+    def renew_leases(self):
+        """Renews leases on reserved worker pools, and stops using pools whose lease was lost.
+
+        Batches pending in the private queue of a lost pool may never be
+        consumed, so they are revoked and buffered to be sent again.
+        """
+        for lease in list(self.leases):
+            if not lease.maybe_renew():
+                print('Lost lease on worker pool {}'.format(lease.hostname))
+                self.leases.remove(lease)
+                self.resend_pending(lease.private_queue)
+
+    def resend_pending(self, queue):
+        """Revokes batches pending in a queue and buffers their template applications to be sent again.
+
+        Args:
+            queue (str): queue the batches were sent to
+        """
+        task_ids = [task_id for task_id, (_, _, batch_queue) in self.batch_info.items() if batch_queue == queue]
+        with backend_lock:
+            for task_id in task_ids:
+                res = self.pending_results.pop(task_id, None)
+                if res is not None:
+                    res.revoke()
+        for task_id in task_ids:
+            _, batch, _ = self.batch_info.pop(task_id)
+            self.expansion_buffer.extend(batch)
+            self.expansions_sent -= len(batch)
+        if task_ids:
+            print('Sending {} batches from {} again'.format(len(task_ids), queue))
+
+    def release_workers(self):
+        """Releases the worker pools reserved for this search."""
+        for lease in self.leases:
+            lease.release()
+            with backend_lock:
+                tb_c_worker.unreserve_worker_pool.apply_async(
+                    kwargs={'lease_id': lease.lease_id}, queue=lease.private_queue,
+                    **get_lane_options('interactive')
+                )
+        self.leases = []
+
+    def get_queue_options(self):
+        """Returns ``apply_async`` options which send the next task to a reserved pool, if any."""
+        if not self.leases:
+            return {}
+        self.lease_index = (self.lease_index + 1) % len(self.leases)
+        return {'queue': self.leases[self.lease_index].private_queue}
+
+    def get_batch_size(self):
+        """Returns the number of template applications to send per task."""
+        if not self.template_latency:
+            return 1
+        return max(1, min(MAX_BATCH_SIZE, int(BATCH_TARGET_LATENCY / self.template_latency)))
+
+    def update_served_version(self):
+        """Resolves the template relevance model version which is served for this search."""
         try:
-            ## CWC TEST: don't reserve
-            res = tb_c_worker.apply_one_template_by_idx.delay(
-                1,
-                'CCOC(=O)[C@H]1C[C@@H](C(=O)N2[C@@H](c3ccccc3)CC[C@@H]2c2ccccc2)[C@@H](c2ccccc2)N1',
-                1,
-                template_set=self.template_set,
-                template_prioritizer_version=self.template_prioritizer_version
-            )
-            res.get(20)
+            model = tb_c_worker.get_template_relevance_model(self.template_set, self.template_prioritizer_version)
+            self.served_version = model.get_served_version()
         except Exception as e:
-            res.revoke()
-            raise IOError('Did not find any workers? Try again later ({})'.format(e))
+            print('Could not determine served template relevance model version: {}'.format(e))
+            self.served_version = None
+        if self.served_version is None:
+            print('Not using the expansion store for this search')
+
+    def use_expansion_store(self):
+        """Whether outcomes are read from and saved to the expansion store in this search."""
+        return self.expansion_store is not None and self.served_version is not None
+
+    def get_store_key(self, smiles, template_idx):
+        """Returns the expansion store key for a template application with the current settings."""
+        settings = {
+            'template_set': self.template_set,
+            'template_prioritizer_version': self.served_version,
+            'fast_filter_threshold': self.filter_threshold,
+            'max_num_templates': self.template_count,
+            'max_cum_prob': self.max_cum_template_prob,
+        }
+        return self.expansion_store.get_key(smiles, template_idx, settings)
+
+    def load_stored_expansions(self, buffer):
+        """Moves template applications with stored outcomes from the buffer to ``stored_outcomes``.
+
+        Returns:
+            list: template applications which were not found in the store
+        """
+        keys = [self.get_store_key(smiles, template_idx) for _id, smiles, template_idx in buffer]
+        found = self.expansion_store.get_many(keys)
+        if not found:
+            return buffer
+        remaining = []
+        for (_id, smiles, template_idx), key in zip(buffer, keys):
+            outcomes = found.get(key)
+            if outcomes is None:
+                remaining.append((_id, smiles, template_idx))
+            else:
+                self.stored_outcomes.append([[_id] + list(outcome) for outcome in outcomes])
+                self.expansions_stored += 1
+        return remaining
+
+    def save_expansions(self, batch, batch_outcomes):
+        """Saves outcomes received from workers to the expansion store."""
+        expansions = {}
+        for (_id, smiles, template_idx), all_outcomes in zip(batch, batch_outcomes):
+            # Pathway IDs are specific to this search, so they are not stored
+            expansions[self.get_store_key(smiles, template_idx)] = [list(outcome[1:]) for outcome in all_outcomes]
+        self.expansion_store.set_many(expansions)
+
+    def send_expansions(self):
+        """Sends buffered template applications to workers in batches."""
+        batch_size = self.get_batch_size()
+        buffer, self.expansion_buffer = self.expansion_buffer, []
+        if self.use_expansion_store():
+            buffer = self.load_stored_expansions(buffer)
+        priority = self.get_priority()
+        for start in range(0, len(buffer), batch_size):
+            batch = buffer[start:start + batch_size]
+            queue_options = self.get_queue_options()
+            with backend_lock:
+                res = tb_c_worker.apply_templates_by_idx.apply_async(
+                    args=(batch,),
+                    kwargs={'max_num_templates': self.template_count,
+                            'max_cum_prob': self.max_cum_template_prob,
+                            'fast_filter_threshold': self.filter_threshold,
+                            'template_prioritizer_version': self.template_prioritizer_version,
+                            'template_set': self.template_set},
+                    **get_lane_options('batch', priority=priority),
+                    **queue_options
+                )
+                if self.result_consumer is not None:
+                    res.then(self.on_result_ready)
+            self.pending_results[res.id] = res
+            self.batch_info[res.id] = (time.time(), batch, queue_options.get('queue'))
+            self.expansions_sent += len(batch)
+
+    def on_result_ready(self, res):
+        """Callback for finished celery results, see ``send_expansions``."""
+        self.ready_results.append(res)
+        self.result_event.set()
+
+    def update_template_latency(self, task_id):
+        """Updates the moving average latency per template using a finished batch."""
+        sent, batch, _ = self.batch_info.get(task_id, (None, None, None))
+        if sent is None:
+            return
+        latency = (time.time() - sent) / len(batch)
+        if self.template_latency is None:
+            self.template_latency = latency
+        else:
+            self.template_latency += BATCH_LATENCY_SMOOTHING * (latency - self.template_latency)
+
+    def prepare(self):
+        """Starts parallelization with Celery.
+
+        Checks the worker registry for ``tb_c_worker`` pools which have loaded
+        the requested template set and model version. Workers which could not
+        determine these details are assumed to be able to serve the request.
+        Then reserves worker pools if ``reserve_pools`` is set. Pools are
+        reserved through the ``tb_c_worker_reservable`` queue, so workers
+        should consume both queues, e.g. ``-Q tb_c_worker,tb_c_worker_reservable``.
+        """
+        self.search_start_time = time.time()
+        if self.expansion_store is not None:
+            self.update_served_version()
+        workers = get_ready_workers(tb_c_worker.CORRESPONDING_QUEUE)
+        if not workers:
+            raise IOError('Did not find any workers? Try again later')
+
+        version = str(self.template_prioritizer_version) if self.template_prioritizer_version else None
+        for worker in workers:
+            template_sets = worker.get('template_sets')
+            if template_sets and self.template_set not in template_sets:
+                continue
+            versions = worker.get('model_versions', {}).get(self.template_set)
+            if version is None or not versions or version in versions:
+                if self.reserve_pools:
+                    self.reserve_workers()
+                return
+        raise IOError('Did not find any workers for template set {} (version {}). Try again later'.format(
+            self.template_set, version or 'latest'))
+
+    def uses_greenlet_drainer(self):
+        """Returns whether result messages are read by a greenlet of celery, e.g. under gevent."""
+        from celery.backends.asynchronous import greenletDrainer
+        return isinstance(getattr(self.result_consumer, 'drainer', None), greenletDrainer)
+
+    def drain_result_events(self):
+        """Processes result messages received from the result backend.
+
+        Ready results are appended to ``ready_results`` by the callbacks
+        registered in ``send_expansions``. Under gevent or eventlet, the
+        callbacks are run by the drainer greenlet of celery, which is the only
+        reader of the result connection, so this only waits for a callback.
+        Otherwise messages are read here. Backends without a result consumer
+        fall back to checking the state of each pending result.
+        """
+        if self.result_consumer is None:
+            self.ready_results.extend(res for res in self.pending_results.values() if res.ready())
+            return
+
+        if self.uses_greenlet_drainer():
+            self.result_event.clear()
+            if not self.ready_results:
+                self.result_event.wait(RESULT_DRAIN_TIMEOUT)
+            return
+
+        # Another search in this process is already draining messages, and
+        # its callbacks deliver our results as well
+        if not backend_lock.acquire(blocking=False):
+            time.sleep(RESULT_DRAIN_TIMEOUT)
+            return
+        try:
+            # Each call handles at most one message, so continue until a call
+            # produces no new result. Only block if nothing is ready yet.
+            timeout = 0 if self.ready_results else RESULT_DRAIN_TIMEOUT
+            for _ in range(len(self.pending_results)):
+                num_ready = len(self.ready_results)
+                self.result_consumer.drain_events(timeout=timeout)
+                if len(self.ready_results) == num_ready:
+                    break
+                timeout = 0
+        finally:
+            backend_lock.release()
 
     def get_ready_result(self):
         """Yields processed results from Celery.
@@ -86,12 +449,29 @@ class MCTSCelery(MCTS):
             list of 5-tuples of (int, string, int, list, float): Results
                 from workers after applying a template to a molecule.
         """
-        # Update which processes are ready
-        self.is_ready = [i for (i, res) in enumerate(self.pending_results) if res.ready()]
-        for i in self.is_ready:
-            yield self.pending_results[i].get(timeout=0.1)
-            self.pending_results[i].forget()
-        self.pending_results = [res for (i, res) in enumerate(self.pending_results) if i not in self.is_ready]
+        if self.leases:
+            self.renew_leases()
+        if self.expansion_buffer:
+            self.send_expansions()
+        if self.pending_results:
+            self.drain_result_events()
+        while self.stored_outcomes:
+            self.expansions_done += 1
+            yield self.stored_outcomes.popleft()
+        while self.ready_results:
+            res = self.ready_results.popleft()
+            if self.pending_results.pop(res.id, None) is None:
+                # Already yielded, e.g. if it was found by both polling and callback
+                continue
+            self.update_template_latency(res.id)
+            batch_outcomes = res.get(timeout=0.1)
+            res.forget()
+            _, batch, _ = self.batch_info.pop(res.id, (None, None, None))
+            if self.use_expansion_store() and batch is not None:
+                self.save_expansions(batch, batch_outcomes)
+            for all_outcomes in batch_outcomes:
+                self.expansions_done += 1
+                yield all_outcomes
 
     def stop(self, soft_stop=False):
         """Stops work with Celery.
@@ -100,19 +480,46 @@ class MCTSCelery(MCTS):
             soft_stop (bool, optional): Unused. (default: {false})
         """
         self.running = False
-        if self.pending_results != []:  # clear anything left over - might not be necessary
-            for i in range(len(self.pending_results)):
-                self.pending_results[i].revoke()
+        if self.pending_results:  # clear anything left over - might not be necessary
+            with backend_lock:
+                for res in self.pending_results.values():
+                    res.revoke()
+            self.pending_results = {}
+        self.ready_results.clear()
+        self.expansion_buffer = []
+        self.batch_info = {}
+        self.stored_outcomes.clear()
+        self.release_workers()
+        if self.search_start_time is not None:
+            elapsed = time.time() - self.search_start_time
+            print('Received {} expansions ({} of {} sent, {} stored) in {:.1f} s ({:.1f} expansions/s, batch size {})'.format(
+                self.expansions_done, self.expansions_done - self.expansions_stored, self.expansions_sent,
+                self.expansions_stored, elapsed, self.expansions_done / max(elapsed, 1e-6), self.get_batch_size()))
+            self.search_start_time = None
+        self.user = None
+        self.priority = None
+        self.priority_time = 0
+        self.served_version = None
 
     def get_initial_prioritization(self):
         """
         Get template prioritizer predictions to initialize the tree search.
         """
-        res = tb_c_worker.template_relevance.delay(
-            self.smiles, self.template_count, self.max_cum_template_prob, 
-            template_set=self.template_set, template_prioritizer_version=self.template_prioritizer_version
-        )
-        return res.get(10)
+        with backend_lock:
+            res = tb_c_worker.template_relevance.apply_async(
+                args=(self.smiles, self.template_count, self.max_cum_template_prob),
+                kwargs={'template_set': self.template_set,
+                        'template_prioritizer_version': self.template_prioritizer_version},
+                **get_lane_options('batch', priority=self.get_priority())
+            )
+        # Poll instead of waiting on the shared result consumer, which other searches may be using
+        deadline = time.time() + 10
+        while not res.ready():
+            if time.time() > deadline:
+                res.revoke()
+                raise TimeoutError('Template relevance prediction timed out.')
+            time.sleep(0.05)
+        return res.get(1)
 
     def work(self, i):
         """
@@ -0,0 +1,207 @@
+"""
+Tests for the celery tree builder.
+
+These tests need askcos-core and do not connect to celery workers or databases.
+"""
+
+import unittest
+import uuid
+from collections import deque
+from unittest import mock
+
+try:
+    import gevent
+    import gevent.event
+except ImportError:
+    gevent = None
+
+import askcos_site.askcos_celery.treebuilder.tree_builder_celery as tree_builder_celery
+from askcos_site.askcos_celery.treebuilder.expansion_store import ExpansionStore
+from askcos_site.askcos_celery.treebuilder.tree_builder_celery import MCTSCelery
+
+
+class SharedData(object):
+    """Stand-in for data which should be shared between searches, e.g. the pricer."""
+    def __init__(self):
+        self.data = {'CCO': 1.0}
+
+
+class TestSpawn(unittest.TestCase):
+    """Test that spawned tree builders share read-only data and nothing else."""
+
+    def setUp(self):
+        self.pricer = SharedData()
+        self.chemhistorian = SharedData()
+        self.expansion_store = ExpansionStore(collection=None)
+        self.prototype = MCTSCelery(
+            celery=True, nproc=8, use_db=False, pricer=self.pricer, chemhistorian=self.chemhistorian,
+            expansion_store=self.expansion_store,
+        )
+
+    def test_shared_objects(self):
+        """Spawned tree builders use the pricer, historian, expansion store and result consumer of the prototype"""
+        for tree_builder in [self.prototype.spawn(), self.prototype.spawn()]:
+            self.assertIs(tree_builder.pricer, self.pricer)
+            self.assertIs(tree_builder.chemhistorian, self.chemhistorian)
+            self.assertIs(tree_builder.expansion_store, self.expansion_store)
+            self.assertIs(tree_builder.result_consumer, self.prototype.result_consumer)
+
+    def test_search_state_not_shared(self):
+        """Containers holding search state are copied for each spawned tree builder"""
+        shared = {id(self.pricer), id(self.chemhistorian), id(self.expansion_store), id(self.prototype.result_consumer)}
+        first = self.prototype.spawn()
+        second = self.prototype.spawn()
+        for name, value in vars(self.prototype).items():
+            if id(value) in shared or not isinstance(value, (dict, list, set, deque)):
+                continue
+            self.assertIsNot(getattr(first, name), value, name)
+            self.assertIsNot(getattr(first, name), getattr(second, name), name)
+
+    def test_search_state_changes(self):
+        """Changing the state of one search does not affect the prototype or other searches"""
+        first = self.prototype.spawn()
+        second = self.prototype.spawn()
+        first.user = 'first'
+        first.expansion_buffer.append((0, 'CCO', 1))
+        first.pending_results['task'] = None
+        first.leases.append(None)
+        for tree_builder in [self.prototype, second]:
+            self.assertIsNone(tree_builder.user)
+            self.assertEqual(tree_builder.expansion_buffer, [])
+            self.assertEqual(tree_builder.pending_results, {})
+            self.assertEqual(tree_builder.leases, [])
+
+
+class TestLostLease(unittest.TestCase):
+    """Test that batches pending in the queue of a lost worker pool are sent again."""
+
+    def test_resend_pending(self):
+        """Only batches sent to the lost pool are revoked and buffered again"""
+        tree_builder = MCTSCelery(celery=True, nproc=8, use_db=False)
+        lost = mock.Mock(private_queue='tb_c_worker_lost', hostname='lost')
+        lost.maybe_renew.return_value = False
+        kept = mock.Mock(private_queue='tb_c_worker_kept', hostname='kept')
+        kept.maybe_renew.return_value = True
+        tree_builder.leases = [lost, kept]
+        batches = {
+            'a': [(0, 'CCO', 1), (0, 'CCO', 2)],
+            'b': [(1, 'CCN', 1)],
+            'c': [(2, 'CCC', 1)],
+        }
+        queues = {'a': lost.private_queue, 'b': kept.private_queue, 'c': lost.private_queue}
+        for task_id, batch in batches.items():
+            tree_builder.pending_results[task_id] = mock.Mock()
+            tree_builder.batch_info[task_id] = (0, batch, queues[task_id])
+        tree_builder.expansions_sent = 4
+        revoked = [tree_builder.pending_results['a'], tree_builder.pending_results['c']]
+
+        tree_builder.renew_leases()
+
+        self.assertEqual(tree_builder.leases, [kept])
+        self.assertEqual(list(tree_builder.pending_results), ['b'])
+        self.assertEqual(list(tree_builder.batch_info), ['b'])
+        self.assertEqual(tree_builder.expansion_buffer, batches['a'] + batches['c'])
+        self.assertEqual(tree_builder.expansions_sent, 1)
+        for res in revoked:
+            res.revoke.assert_called_once_with()
+        tree_builder.pending_results['b'].revoke.assert_not_called()
+
+
+class FakeResult(object):
+    """Stand-in for a celery result which is fulfilled by the result consumer."""
+    def __init__(self, consumer, batch):
+        self.id = str(uuid.uuid4())
+        self.consumer = consumer
+        self.batch = batch
+        self.callback = None
+
+    def then(self, callback):
+        self.callback = callback
+        self.consumer.drainer.start()
+        self.consumer.pending.append(self)
+
+    def get(self, timeout=None):
+        return [(smiles, template_idx) for _, smiles, template_idx in self.batch]
+
+    def forget(self):
+        pass
+
+    def revoke(self):
+        pass
+
+
+class FakeResultConsumer(object):
+    """Stand-in for the Redis result consumer, which fails if two greenlets read from it at once."""
+    def __init__(self):
+        from celery.backends.asynchronous import geventDrainer
+        self.drainer = geventDrainer(self)
+        self.pending = deque()
+        self.reading = False
+
+    def drain_events(self, timeout=None):
+        if self.reading:
+            raise AssertionError('Result connection read by two greenlets at once')
+        self.reading = True
+        try:
+            gevent.sleep(0.001)
+            while self.pending:
+                res = self.pending.popleft()
+                res.callback(res)
+        finally:
+            self.reading = False
+
+    def apply_async(self, args, **kwargs):
+        return FakeResult(self, args[0])
+
+
+@unittest.skipIf(gevent is None, 'gevent is not installed')
+class TestGeventSearches(unittest.TestCase):
+    """Test that concurrent searches leave reading result messages to the drainer greenlet of celery."""
+
+    def setUp(self):
+        self.consumer = FakeResultConsumer()
+        self.prototype = MCTSCelery(celery=True, nproc=8, use_db=False)
+        self.prototype.result_consumer = self.consumer
+        self.consumer.drainer.start()
+
+    def tearDown(self):
+        self.consumer.drainer.stop()
+
+    def run_search(self, tree_builder, smiles, num_expansions):
+        # Settings which are normally set by get_buyable_paths
+        tree_builder.template_count = 100
+        tree_builder.max_cum_template_prob = 0.995
+        tree_builder.filter_threshold = 0.75
+        tree_builder.template_set = 'reaxys'
+        tree_builder.expansion_buffer = [(i, smiles, i) for i in range(num_expansions)]
+        outcomes = []
+        while len(outcomes) < num_expansions:
+            outcomes.extend(tree_builder.get_ready_result())
+        return outcomes
+
+    @mock.patch.object(tree_builder_celery, 'get_active_searches', return_value=1)
+    def test_two_searches(self, _):
+        """Two spawned searches receive all of their results without draining the result connection"""
+        tree_builders = [self.prototype.spawn(), self.prototype.spawn()]
+        for tree_builder in tree_builders:
+            self.assertIs(tree_builder.result_consumer, self.consumer)
+            self.assertTrue(tree_builder.uses_greenlet_drainer())
+            # Celery workers started with -P gevent patch threading events
+            tree_builder.result_event = gevent.event.Event()
+
+        with mock.patch.object(tree_builder_celery.tb_c_worker, 'apply_templates_by_idx', self.consumer):
+            greenlets = [
+                gevent.spawn(self.run_search, tree_builders[0], 'CCO', 20),
+                gevent.spawn(self.run_search, tree_builders[1], 'CCN', 30),
+            ]
+            gevent.joinall(greenlets, timeout=10, raise_error=True)
+
+        self.assertEqual(sorted(greenlets[0].value), [('CCO', i) for i in range(20)])
+        self.assertEqual(sorted(greenlets[1].value), [('CCN', i) for i in range(30)])
+        for tree_builder in tree_builders:
+            self.assertEqual(tree_builder.pending_results, {})
+            self.assertEqual(tree_builder.expansions_done, tree_builder.expansions_sent)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+"""
+Leases for reserving celery worker pools.
+
+A coordinator can reserve a worker pool for a single job. The pool then stops
+consuming the shared queue and only consumes a private queue. Each
+reservation is backed by a lease in Redis which expires unless the
+coordinator renews it, and reserved pools check their lease with every
+worker registry heartbeat. Pools whose lease expired, e.g. because the
+coordinator crashed, return to the shared queue on their own.
+
+At most ``WORKER_RESERVATION_MAX_FRACTION`` of the registered pools of a
+queue can be reserved at the same time, so reservations can never take all
+capacity away from other users.
+"""
+
+import json
+import os
+import time
+import uuid
+
+import redis
+
+from .cache import get_redis_client
+from .worker_registry import get_ready_workers
+
+WORKER_LEASE_PREFIX = 'askcos:worker_leases:'
+WORKER_RESERVED_PREFIX = 'askcos:worker_reserved:'
+WORKER_LEASE_TTL = float(os.environ.get('WORKER_LEASE_TTL', 60))
+WORKER_RESERVATION_MAX_FRACTION = float(os.environ.get('WORKER_RESERVATION_MAX_FRACTION', 0.5))
+
+
+def get_private_queue(queue, hostname):
+    """Returns the name of the queue consumed by a worker pool while it is reserved."""
+    return queue + '_' + hostname
+
+
+def _lease_key(queue, hostname):
+    return WORKER_LEASE_PREFIX + queue + ':' + hostname
+
+
+def _reserved_key(queue, hostname):
+    return WORKER_RESERVED_PREFIX + queue + ':' + hostname
+
+
+def get_leases(queue):
+    """Returns the active leases for a queue.
+
+    Returns:
+        list of dict: lease id, owner, hostname and grant time of each lease
+    """
+    client = get_redis_client()
+    keys = list(client.scan_iter(match=WORKER_LEASE_PREFIX + queue + ':*', count=1000))
+    values = client.mget(keys) if keys else []
+    return [json.loads(value) for value in values if value is not None]
+
+
+def grant_lease(queue, hostname, lease_id, owner=None, ttl=WORKER_LEASE_TTL,
+                max_fraction=WORKER_RESERVATION_MAX_FRACTION):
+    """Creates a lease for a worker pool, called by the worker pool being reserved.
+
+    The lease is refused if the pool is already reserved or if granting it
+    would reserve more than ``max_fraction`` of the registered pools.
+
+    Args:
+        queue (str): name of the shared queue of the worker pool
+        hostname (str): celery hostname of the worker pool
+        lease_id (str): ID of the new lease
+        owner (str, optional): description of the job holding the lease
+        ttl (float): seconds before the lease expires unless renewed
+        max_fraction (float): maximum fraction of pools which can be reserved
+
+    Returns:
+        bool: whether the lease was granted
+    """
+    client = get_redis_client()
+    key = _lease_key(queue, hostname)
+    lease = {'lease_id': lease_id, 'owner': owner, 'hostname': hostname, 'granted': time.time()}
+    try:
+        if not client.set(key, json.dumps(lease), nx=True, ex=int(ttl)):
+            return False
+        # Check the cap after creating the lease, so concurrent grants can
+        # only refuse too many leases and never grant too many
+        max_leases = int(max_fraction * len(get_ready_workers(queue, max_age=0)))
+        if len(get_leases(queue)) > max_leases:
+            release_lease(queue, hostname, lease_id)
+            return False
+        client.set(_reserved_key(queue, hostname), lease_id)
+    except redis.RedisError as e:
+        print('Could not grant worker lease: {}'.format(e))
+        return False
+    return True
+
+
+def renew_lease(queue, hostname, lease_id, ttl=WORKER_LEASE_TTL):
+    """Extends a lease by ``ttl`` seconds.
+
+    Returns:
+        bool: whether the lease was still held and has been renewed
+    """
+    client = get_redis_client()
+    key = _lease_key(queue, hostname)
+    try:
+        value = client.get(key)
+        if value is None or json.loads(value)['lease_id'] != lease_id:
+            return False
+        return bool(client.expire(key, int(ttl)))
+    except redis.RedisError as e:
+        print('Could not renew worker lease: {}'.format(e))
+        # Assume the lease is held, it is renewed again at the next interval
+        return True
+
+
+def release_lease(queue, hostname, lease_id=None):
+    """Deletes a lease, or any lease of the worker pool if ``lease_id`` is None."""
+    client = get_redis_client()
+    key = _lease_key(queue, hostname)
+    try:
+        if lease_id is not None:
+            value = client.get(key)
+            if value is None or json.loads(value)['lease_id'] != lease_id:
+                return
+        client.delete(key)
+    except redis.RedisError as e:
+        print('Could not release worker lease: {}'.format(e))
+
+
+def is_reserved(queue, hostname):
+    """Returns whether a worker pool has been reserved and not yet returned to the shared queue."""
+    try:
+        return get_redis_client().exists(_reserved_key(queue, hostname)) > 0
+    except redis.RedisError:
+        return False
+
+
+def lease_expired(queue, hostname):
+    """Returns whether a worker pool is reserved but its lease has expired or been released."""
+    client = get_redis_client()
+    try:
+        return bool(client.exists(_reserved_key(queue, hostname))) and not client.exists(_lease_key(queue, hostname))
+    except redis.RedisError:
+        return False
+
+
+def clear_reservation(queue, hostname):
+    """Records that a worker pool has returned to the shared queue."""
+    try:
+        get_redis_client().delete(_reserved_key(queue, hostname))
+    except redis.RedisError as e:
+        print('Could not clear worker reservation: {}'.format(e))
+
+
+class WorkerLease(object):
+    """Lease on a reserved worker pool, held by a coordinator.
+
+    Attributes:
+        queue (str): name of the shared queue of the worker pool
+        hostname (str): celery hostname of the worker pool
+        lease_id (str): ID of the lease
+        private_queue (str): queue consumed by the worker pool while reserved
+        ttl (float): seconds before the lease expires unless renewed
+        renewed (float): time of the last renewal
+    """
+    def __init__(self, queue, hostname, lease_id, ttl=WORKER_LEASE_TTL):
+        self.queue = queue
+        self.hostname = hostname
+        self.lease_id = lease_id
+        self.private_queue = get_private_queue(queue, hostname)
+        self.ttl = ttl
+        self.renewed = time.time()
+
+    @staticmethod
+    def new_id():
+        return str(uuid.uuid4())
+
+    def maybe_renew(self):
+        """Renews the lease if a third of its time to live has passed.
+
+        Returns:
+            bool: whether the lease is still held
+        """
+        now = time.time()
+        if now - self.renewed < self.ttl / 3:
+            return True
+        self.renewed = now
+        return renew_lease(self.queue, self.hostname, self.lease_id, ttl=self.ttl)
+
+    def release(self):
+        """Releases the lease. The worker pool returns to the shared queue at its next heartbeat."""
+        release_lease(self.queue, self.hostname, self.lease_id)
@@ -0,0 +1,105 @@
+"""
+Registry of ready celery worker pools.
+
+Workers register themselves in Redis once their models are loaded and keep
+the entry alive with a heartbeat thread in the main worker process. Entries
+expire if a worker stops sending heartbeats, so coordinators can check for
+ready workers without sending them a task.
+"""
+
+import json
+import os
+import threading
+import time
+
+import redis
+
+from .cache import get_redis_client
+
+WORKER_REGISTRY_PREFIX = 'askcos:workers:'
+WORKER_HEARTBEAT_INTERVAL = float(os.environ.get('WORKER_HEARTBEAT_INTERVAL', 15))
+WORKER_HEARTBEAT_TTL = 3 * WORKER_HEARTBEAT_INTERVAL
+WORKER_REGISTRY_MAX_AGE = 5  # seconds that a registry snapshot is reused by get_ready_workers
+
+_snapshots = {}
+
+
+def register_worker(queue, hostname, info):
+    """Records that a worker pool is ready, expiring after ``WORKER_HEARTBEAT_TTL`` seconds.
+
+    Args:
+        queue (str): name of the queue the worker consumes
+        hostname (str): celery hostname of the worker
+        info (dict): JSON serializable details, e.g. loaded template sets
+    """
+    info = dict(info, hostname=hostname, queue=queue, heartbeat=time.time())
+    get_redis_client().set(
+        WORKER_REGISTRY_PREFIX + queue + ':' + hostname, json.dumps(info), ex=int(WORKER_HEARTBEAT_TTL)
+    )
+
+
+def unregister_worker(queue, hostname):
+    """Removes a worker pool from the registry."""
+    try:
+        get_redis_client().delete(WORKER_REGISTRY_PREFIX + queue + ':' + hostname)
+    except redis.RedisError:
+        pass
+
+
+def start_heartbeat(queue, hostname, get_info, interval=WORKER_HEARTBEAT_INTERVAL, on_beat=None):
+    """Registers a worker and keeps its entry current from a daemon thread.
+
+    Args:
+        queue (str): name of the queue the worker consumes
+        hostname (str): celery hostname of the worker
+        get_info (callable): returns the current worker details for each heartbeat
+        interval (float): seconds between heartbeats
+        on_beat (callable, optional): called before each heartbeat, e.g. for periodic checks
+
+    Returns:
+        threading.Thread: the heartbeat thread
+    """
+    def beat():
+        while True:
+            try:
+                if on_beat is not None:
+                    on_beat()
+                register_worker(queue, hostname, get_info())
+            except Exception as e:
+                print('Could not send worker heartbeat: {}'.format(e))
+            time.sleep(interval)
+
+    thread = threading.Thread(target=beat, name='{}-heartbeat'.format(queue), daemon=True)
+    thread.start()
+    return thread
+
+
+def get_ready_workers(queue, max_age=WORKER_REGISTRY_MAX_AGE):
+    """Returns registered workers for a queue.
+
+    Non-empty results are reused for ``max_age`` seconds, so frequent checks
+    do not contact Redis.
+
+    Args:
+        queue (str): name of the queue
+        max_age (float): maximum age in seconds of a reused result
+
+    Returns:
+        list of dict: details of each ready worker pool
+    """
+    now = time.time()
+    snapshot = _snapshots.get(queue)
+    if snapshot is not None and now - snapshot[0] < max_age:
+        return snapshot[1]
+
+    client = get_redis_client()
+    try:
+        keys = list(client.scan_iter(match=WORKER_REGISTRY_PREFIX + queue + ':*', count=1000))
+        values = client.mget(keys) if keys else []
+    except redis.RedisError as e:
+        print('Could not read worker registry: {}'.format(e))
+        values = []
+    workers = [json.loads(value) for value in values if value is not None]
+    if workers:
+        _snapshots[queue] = (now, workers)
+    return workers
@@ -0,0 +1,263 @@
+"""
+Snapshot of celery worker status for the status API.
+
+``WorkerStatusMonitor`` consumes celery worker events in a background
+process and keeps the number of busy and total processes of each worker in a
+Redis snapshot, which is rewritten every ``WORKER_STATUS_INTERVAL`` seconds:
+
+- ``worker-heartbeat`` events, which workers send every few seconds, give
+  the number of active tasks of each worker
+- ``task-started``, ``task-succeeded``, ``task-failed`` and ``task-revoked``
+  events update the number of active tasks between heartbeats, if workers
+  send task events (``CELERY_WORKER_SEND_TASK_EVENTS``)
+- the pool size of each worker is requested once, when it comes online
+
+Status endpoints read the snapshot with ``get_worker_status`` instead of
+broadcasting ``inspect`` requests to all workers. If the monitor is not
+running, the snapshot is rebuilt with ``inspect`` when it is older than
+``WORKER_STATUS_MAX_AGE``, by one web process at a time.
+
+The monitor is started with ``python -m askcos_site.askcos_celery.worker_status``.
+"""
+
+import json
+import os
+import threading
+import time
+
+import redis
+
+from .cache import get_redis_client
+
+WORKER_STATUS_KEY = 'askcos:worker_status'
+WORKER_STATUS_LOCK_KEY = 'askcos:worker_status:lock'
+WORKER_STATUS_INTERVAL = float(os.environ.get('WORKER_STATUS_INTERVAL', 2))
+WORKER_STATUS_MAX_AGE = float(os.environ.get('WORKER_STATUS_MAX_AGE', 30))
+WORKER_STATUS_INSPECT_TIMEOUT = 1.0  # seconds to wait for replies to inspect requests
+WORKER_EXPIRY_HEARTBEATS = 3  # missed heartbeats after which a worker is considered offline
+
+TASK_STARTED_EVENTS = ('task-started',)
+TASK_FINISHED_EVENTS = ('task-succeeded', 'task-failed', 'task-revoked')
+
+
+def inspect_workers(app, destination=None):
+    """Returns the status of workers using broadcast ``inspect`` requests.
+
+    Args:
+        app (celery.Celery): celery app
+        destination (list, optional): hostnames of workers to inspect, all workers by default
+
+    Returns:
+        dict: queue, pool size and number of active tasks of each worker by hostname
+    """
+    inspect = app.control.inspect(destination=destination, timeout=WORKER_STATUS_INSPECT_TIMEOUT)
+    stats = inspect.stats() or {}
+    active = inspect.active() or {}
+    now = time.time()
+    return {
+        hostname: {
+            'queue': hostname.split('@')[0],
+            'concurrency': worker_stats['pool']['max-concurrency'],
+            'active': len(active.get(hostname) or []),
+            'heartbeat': now,
+        }
+        for hostname, worker_stats in stats.items()
+    }
+
+
+def save_snapshot(workers, source):
+    """Saves a snapshot of worker status to Redis.
+
+    Returns:
+        dict: the snapshot
+    """
+    snapshot = {'updated': time.time(), 'source': source, 'workers': workers}
+    try:
+        get_redis_client().set(WORKER_STATUS_KEY, json.dumps(snapshot))
+    except redis.RedisError as e:
+        print('Could not save worker status: {}'.format(e))
+    return snapshot
+
+
+def load_snapshot():
+    """Returns the saved snapshot of worker status, or None if there is none."""
+    try:
+        value = get_redis_client().get(WORKER_STATUS_KEY)
+    except redis.RedisError as e:
+        print('Could not read worker status: {}'.format(e))
+        return None
+    return json.loads(value) if value is not None else None
+
+
+def get_worker_status(app, max_age=WORKER_STATUS_MAX_AGE):
+    """Returns a snapshot of worker status, rebuilding it with ``inspect`` if it is too old.
+
+    Only one process at a time rebuilds the snapshot, others return the old
+    snapshot while it is being rebuilt.
+
+    Args:
+        app (celery.Celery): celery app
+        max_age (float): maximum age in seconds of a returned snapshot
+
+    Returns:
+        dict: ``updated`` time, ``source`` ('events' or 'inspect') and
+            ``workers`` status by hostname
+    """
+    snapshot = load_snapshot()
+    if snapshot is not None and time.time() - snapshot['updated'] < max_age:
+        return snapshot
+
+    try:
+        acquired = get_redis_client().set(WORKER_STATUS_LOCK_KEY, 1, nx=True, ex=10)
+    except redis.RedisError:
+        acquired = True
+    if not acquired and snapshot is not None:
+        return snapshot
+
+    try:
+        return save_snapshot(inspect_workers(app), 'inspect')
+    finally:
+        if acquired:
+            try:
+                get_redis_client().delete(WORKER_STATUS_LOCK_KEY)
+            except redis.RedisError:
+                pass
+
+
+def summarize_queues(snapshot, readable_names):
+    """Returns the number of busy and available processes for each queue.
+
+    Args:
+        snapshot (dict): snapshot from ``get_worker_status``
+        readable_names (dict): readable name of each queue, which are listed even without workers
+
+    Returns:
+        list of dict: name, queue, busy and available processes, sorted by name
+    """
+    status = {}
+    for worker in snapshot['workers'].values():
+        queue = status.setdefault(worker['queue'], {'total': 0, 'busy': 0})
+        queue['busy'] += worker['active']
+        queue['total'] += worker['concurrency'] or 0
+
+    for key in readable_names:
+        status.setdefault(key, {'total': 0, 'busy': 0})
+
+    status_list = [{
+        'name': readable_names.get(key, key),
+        'queue': key,
+        'busy': value['busy'],
+        'available': max(value['total'] - value['busy'], 0),
+    } for key, value in status.items()]
+    return sorted(status_list, key=lambda x: x['name'])
+
+
+class WorkerStatusMonitor(object):
+    """Keeps a snapshot of worker status up to date from celery events.
+
+    Attributes:
+        app (celery.Celery): celery app
+        interval (float): seconds between snapshots
+        workers (dict): queue, pool size, number of active tasks and last
+            heartbeat time of each worker by hostname
+    """
+    def __init__(self, app, interval=WORKER_STATUS_INTERVAL):
+        self.app = app
+        self.interval = interval
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def get_worker(self, hostname, timestamp):
+        worker = self.workers.get(hostname)
+        if worker is None:
+            worker = self.workers[hostname] = {
+                'queue': hostname.split('@')[0],
+                'concurrency': None,
+                'active': 0,
+                'heartbeat': timestamp,
+                'freq': 2.0,
+            }
+        return worker
+
+    def on_event(self, event):
+        """Updates worker status from a celery event."""
+        event_type = event.get('type', '')
+        hostname = event.get('hostname')
+        if not hostname:
+            return
+        now = time.time()
+        with self.lock:
+            if event_type == 'worker-offline':
+                self.workers.pop(hostname, None)
+                return
+            worker = self.get_worker(hostname, now)
+            if event_type.startswith('worker-'):
+                worker['heartbeat'] = now
+                worker['freq'] = event.get('freq') or worker['freq']
+                if 'active' in event:
+                    worker['active'] = event['active']
+            elif event_type in TASK_STARTED_EVENTS:
+                worker['active'] += 1
+            elif event_type in TASK_FINISHED_EVENTS:
+                worker['active'] = max(worker['active'] - 1, 0)
+
+    def refresh(self):
+        """Removes workers which stopped sending heartbeats, requests missing pool sizes and saves a snapshot."""
+        now = time.time()
+        with self.lock:
+            for hostname, worker in list(self.workers.items()):
+                if now - worker['heartbeat'] > WORKER_EXPIRY_HEARTBEATS * worker['freq']:
+                    del self.workers[hostname]
+            missing = [hostname for hostname, worker in self.workers.items() if worker['concurrency'] is None]
+
+        if missing:
+            try:
+                inspected = inspect_workers(self.app, destination=missing)
+            except Exception as e:
+                print('Could not inspect workers: {}'.format(e))
+                inspected = {}
+            with self.lock:
+                for hostname, status in inspected.items():
+                    if hostname in self.workers:
+                        self.workers[hostname]['concurrency'] = status['concurrency']
+
+        with self.lock:
+            workers = {
+                hostname: {key: worker[key] for key in ('queue', 'concurrency', 'active', 'heartbeat')}
+                for hostname, worker in self.workers.items()
+            }
+        save_snapshot(workers, 'events')
+
+    def capture(self):
+        """Consumes celery events, reconnecting to the broker after errors."""
+        while True:
+            try:
+                with self.app.connection() as connection:
+                    receiver = self.app.events.Receiver(connection, handlers={'*': self.on_event})
+                    receiver.capture(limit=None, timeout=None, wakeup=True)
+            except Exception as e:
+                print('Lost connection to celery events: {}'.format(e))
+                time.sleep(self.interval)
+
+    def run(self):
+        """Starts consuming events and saves a snapshot every ``interval`` seconds. Does not return."""
+        try:
+            initial = inspect_workers(self.app)
+        except Exception as e:
+            print('Could not inspect workers: {}'.format(e))
+            initial = {}
+        with self.lock:
+            for hostname, status in initial.items():
+                self.get_worker(hostname, status['heartbeat']).update(status)
+
+        threading.Thread(target=self.capture, name='worker-status-events', daemon=True).start()
+        while True:
+            self.refresh()
+            time.sleep(self.interval)
+
+
+if __name__ == '__main__':
+    from askcos_site.celery import app
+
+    print('Monitoring celery worker status every {} seconds'.format(WORKER_STATUS_INTERVAL))
+    WorkerStatusMonitor(app).run()
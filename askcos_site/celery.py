@@ -16,6 +16,7 @@ READABLE_NAMES = {
     'atom_mapping_worker': 'Atom Mapping Worker',
     'tffp_worker': 'Template-free Forward Predictor',
     'selec_worker': 'General Selectivity Worker',
+    'buyables_worker': 'Buyables Import Worker',
 }
 
 # Note: cannot use guest for authenticating with broker unless on localhost
@@ -35,6 +36,7 @@ app = Celery('askcos_site', broker='amqp://{}:{}'.format(RABBIT_HOST, RABBIT_POR
         'askcos_site.askcos_celery.impurity.impurity_predictor_worker',
         'askcos_site.askcos_celery.atom_mapper.atom_mapping_worker',
         'askcos_site.askcos_celery.generalselectivity.selec_worker',
+        'askcos_site.askcos_celery.buyables.buyables_worker',
     ]
 )
 
@@ -1,54 +1,262 @@
 """
 Data and model instances for global use in ``askcos_site``.
+
+Each global is created on first use rather than when this module is
+imported, so a process only pays for the models and data its endpoints
+actually touch. Globals are ``LazyGlobal`` proxies which forward attribute
+access to the underlying object, so they can be imported and used like the
+object itself. Creation is thread safe and each global is created at most
+once per process.
+
+The time and memory taken to create each global are recorded, see
+``get_load_profile``. Globals listed in the comma separated
+``PRELOAD_GLOBALS`` environment variable (or all of them, with ``all``) are
+created by ``preload``, which processes can call at startup to avoid paying
+the cost on their first request.
 """
 
-from pymongo import MongoClient
+import os
+import resource
+import threading
+import time
+
 # Setting logging low
 from rdkit import RDLogger
 lg = RDLogger.logger()
 lg.setLevel(RDLogger.CRITICAL)
 
 import askcos.global_config as gc
-from askcos.prioritization.precursors.scscore import SCScorePrecursorPrioritizer
-from askcos.interfaces.template_transformer import TemplateTransformer
-from askcos.utilities.buyable.pricer import Pricer
 from askcos_site.celery import app
 
+USE_PRICE_INDEX = os.environ.get('USE_PRICE_INDEX', 'True') in ['True', 'true', '1']
+PRELOAD_GLOBALS = [name.strip() for name in os.environ.get('PRELOAD_GLOBALS', '').split(',') if name.strip()]
+
+_load_profile = {}
+
+
+def get_process_start_time():
+    """Returns the time this process started, or the current time if it cannot be determined."""
+    try:
+        with open('/proc/self/stat') as f:
+            # Start time in clock ticks since boot is the 22nd field, after the parenthesized command name
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/stat') as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith('btime'))
+        return boot_time + start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+PROCESS_START_TIME = get_process_start_time()
+
+
+def get_max_rss():
+    """Returns the peak resident memory of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LazyGlobal(object):
+    """Proxy for a global which is created by ``factory`` on first use.
+
+    Attribute access, item access, iteration, ``len``, ``in``, calls and
+    truth testing are forwarded to the global. The proxy's own attributes
+    are private, so they never shadow attributes of the global. Use
+    ``load_global`` where the object itself is needed, e.g. to pass it to
+    code which checks its type.
+
+    Attributes:
+        _name (str): name of the global, used in the load profile
+        _factory (callable): creates the global
+        _instance: the global, or None if it has not been created yet
+        _lock (threading.Lock): lock held while creating the global
+    """
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def load_global(self):
+        """Returns the global, creating it if necessary."""
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                if self._instance is None:
+                    start = time.time()
+                    rss = get_max_rss()
+                    self._instance = self._factory()
+                    _load_profile[self._name] = {
+                        'seconds': time.time() - start,
+                        'rss_mb': get_max_rss() - rss,
+                        'loaded_after': start - PROCESS_START_TIME,
+                    }
+                    print('Loaded global {} in {:.2f} s (+{:.0f} MB peak RSS)'.format(
+                        self._name, _load_profile[self._name]['seconds'], _load_profile[self._name]['rss_mb']))
+                instance = self._instance
+        return instance
+
+    def is_loaded(self):
+        return self._instance is not None
+
+    def __getattr__(self, attr):
+        # Only called for attributes not defined on the proxy itself
+        if attr in ('_name', '_factory', '_instance', '_lock'):
+            raise AttributeError(attr)
+        return getattr(self.load_global(), attr)
+
+    def __getitem__(self, key):
+        return self.load_global()[key]
+
+    def __iter__(self):
+        return iter(self.load_global())
+
+    def __len__(self):
+        return len(self.load_global())
+
+    def __contains__(self, item):
+        return item in self.load_global()
+
+    def __call__(self, *args, **kwargs):
+        return self.load_global()(*args, **kwargs)
+
+    def __bool__(self):
+        return bool(self.load_global())
+
+    def __repr__(self):
+        return '<LazyGlobal {}{}>'.format(self._name, '' if self.is_loaded() else ' (not loaded)')
+
+
+_globals = {}
+
+
+def lazy_global(name):
+    """Decorator registering a factory function as the lazy global ``name``."""
+    def decorator(factory):
+        _globals[name] = LazyGlobal(name, factory)
+        return _globals[name]
+    return decorator
+
+
+def preload(names=None):
+    """Creates globals now instead of on first use.
+
+    Args:
+        names (list of str, optional): names of the globals to create, or
+            ['all']. Defaults to ``PRELOAD_GLOBALS``.
+    """
+    names = PRELOAD_GLOBALS if names is None else names
+    if 'all' in names:
+        names = list(_globals)
+    for name in names:
+        if name in _globals:
+            _globals[name].load_global()
+        else:
+            print('Unknown global in PRELOAD_GLOBALS: {}'.format(name))
+    if names:
+        profile = get_load_profile()
+        print('Preloaded globals {} s after process start, peak RSS {:.0f} MB'.format(
+            round(profile['uptime'], 2), profile['max_rss_mb']))
+
+
+def get_load_profile():
+    """Returns the startup profile of this process.
+
+    Returns:
+        dict: seconds since the process started, peak RSS in MB, and the
+            load time and memory of each global which has been created
+    """
+    return {
+        'uptime': time.time() - PROCESS_START_TIME,
+        'max_rss_mb': get_max_rss(),
+        'globals': {
+            name: _load_profile.get(name) for name in _globals
+        },
+    }
+
+
 ################################################################################
 # Database client
-db_client = MongoClient(gc.MONGO['path'], gc.MONGO['id'], connect=gc.MONGO['connect'])
+@lazy_global('db_client')
+def db_client():
+    from pymongo import MongoClient
+    return MongoClient(gc.MONGO['path'], gc.MONGO['id'], connect=gc.MONGO['connect'])
+
 
 ################################################################################
 # Database collections
-reaction_db = db_client[gc.REACTIONS['database']][gc.REACTIONS['collection']]
+@lazy_global('reaction_db')
+def reaction_db():
+    return db_client[gc.REACTIONS['database']][gc.REACTIONS['collection']]
+
+
+@lazy_global('chemical_db')
+def chemical_db():
+    return db_client[gc.CHEMICALS['database']][gc.CHEMICALS['collection']]
 
-chemical_db = db_client[gc.CHEMICALS['database']][gc.CHEMICALS['collection']]
 
-buyables_db = db_client[gc.BUYABLES['database']][gc.BUYABLES['collection']]
+@lazy_global('buyables_db')
+def buyables_db():
+    return db_client[gc.BUYABLES['database']][gc.BUYABLES['collection']]
 
-solvent_db = db_client[gc.SOLVENTS['database']][gc.SOLVENTS['collection']]
 
-retro_templates = db_client[gc.RETRO_TEMPLATES['database']][gc.RETRO_TEMPLATES['collection']]
+@lazy_global('solvent_db')
+def solvent_db():
+    return db_client[gc.SOLVENTS['database']][gc.SOLVENTS['collection']]
+
+
+@lazy_global('retro_templates')
+def retro_templates():
+    return db_client[gc.RETRO_TEMPLATES['database']][gc.RETRO_TEMPLATES['collection']]
+
+
+@lazy_global('forward_templates')
+def forward_templates():
+    return db_client[gc.FORWARD_TEMPLATES['database']][gc.FORWARD_TEMPLATES['collection']]
+
+
+@lazy_global('results_collection')
+def results_collection():
+    return db_client['results']['results']
 
-forward_templates = db_client[gc.FORWARD_TEMPLATES['database']][gc.FORWARD_TEMPLATES['collection']]
 
 ################################################################################
 # Retro Transformer
-retro_transformer = TemplateTransformer(load_all=False, use_db=True, TEMPLATE_DB=retro_templates)
+@lazy_global('retro_transformer')
+def retro_transformer():
+    from askcos.interfaces.template_transformer import TemplateTransformer
+    return TemplateTransformer(load_all=False, use_db=True, TEMPLATE_DB=retro_templates.load_global())
+
+
 RETRO_CHIRAL_FOOTNOTE = 'Using {} chiral retrosynthesis templates from {}/{}'.format(
     gc.RELEVANCE_TEMPLATE_PRIORITIZATION['reaxys']['output_size'],
     gc.RETRO_TEMPLATES['database'],
     gc.RETRO_TEMPLATES['collection']
 )
 
+
 ################################################################################
 # Pricer
-pricer = Pricer()
-pricer.load()
-print('Loaded global pricer.')
+@lazy_global('pricer')
+def pricer():
+    if USE_PRICE_INDEX:
+        # The memory-mapped price index is shared by all processes on the host, see askcos_celery.buyables.price_index
+        from askcos_site.askcos_celery.buyables.price_index import MmapPricer
+        instance = MmapPricer(buyables_db.load_global())
+    else:
+        from askcos.utilities.buyable.pricer import Pricer
+        instance = Pricer()
+    instance.load()
+    return instance
+
 
 ################################################################################
 # SCScorer
-scscorer = SCScorePrecursorPrioritizer()
-scscorer.load_model(model_tag='1024bool')
-print('Loaded global SCScorer.')
+@lazy_global('scscorer')
+def scscorer():
+    from askcos.prioritization.precursors.scscore import SCScorePrecursorPrioritizer
+    instance = SCScorePrecursorPrioritizer()
+    instance.load_model(model_tag='1024bool')
+    return instance
+
+
+preload()
@@ -0,0 +1,97 @@
+"""
+Content-addressed cache of rendered molecule, reaction and template images.
+
+Drawings are keyed by a hash of the drawing parameters and
+``DRAW_CACHE_VERSION``, which should be changed whenever rendering changes.
+The same hash is used as a strong ETag, so conditional requests are answered
+with 304 Not Modified without looking up or rendering the image, and
+responses can be cached by browsers and nginx for ``DRAW_CACHE_MAX_AGE``.
+
+Drawings are stored as one file each under ``DRAW_CACHE_PATH``. The
+directory is swept every ``CACHE_SWEEP_INTERVAL`` seconds, deleting
+drawings older than ``DRAW_CACHE_TTL`` and then the oldest drawings until it
+is no larger than ``DRAW_CACHE_MAX_BYTES``, see ``askcos_celery.cache.FileCache``.
+"""
+
+import functools
+import os
+import tempfile
+
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+
+from askcos_site.askcos_celery.cache import FileCache, make_key
+
+DRAW_CACHE_VERSION = '2'
+DRAW_CACHE_PATH = os.environ.get('DRAW_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'askcos_draw_cache'))
+DRAW_CACHE_SIZE = int(os.environ.get('DRAW_CACHE_SIZE', 2000))
+DRAW_CACHE_TTL = float(os.environ.get('DRAW_CACHE_TTL', 30 * 86400))
+DRAW_CACHE_MAX_BYTES = int(os.environ.get('DRAW_CACHE_MAX_BYTES', 2 ** 30))
+DRAW_CACHE_MAX_AGE = int(os.environ.get('DRAW_CACHE_MAX_AGE', 30 * 86400))
+
+# Content type and image data of rendered drawings, separated by a newline
+drawing_cache = FileCache('drawings', DRAW_CACHE_PATH, maxsize=DRAW_CACHE_SIZE, ttl=DRAW_CACHE_TTL,
+                          max_bytes=DRAW_CACHE_MAX_BYTES)
+
+
+def get_drawing_key(*args):
+    """Returns the cache key of a drawing from its JSON serializable parameters."""
+    return (DRAW_CACHE_VERSION,) + args
+
+
+def get_cached_drawing(key):
+    """Returns the content type and image data of a cached drawing, or None if it is not cached."""
+    value = drawing_cache.get(key)
+    if value is None:
+        return None
+    content_type, content = value.split(b'\n', 1)
+    return content_type.decode('utf-8'), content
+
+
+def set_cached_drawing(key, content_type, content):
+    drawing_cache.set(key, content_type.encode('utf-8') + b'\n' + content)
+
+
+def set_cache_headers(response, etag):
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=DRAW_CACHE_MAX_AGE, immutable=True)
+    return response
+
+
+def cached_drawing(request, key, render):
+    """Returns a response with a drawing, rendering it only if it is not cached.
+
+    Args:
+        request: Django or DRF request, used for conditional requests
+        key (tuple): cache key from ``get_drawing_key``
+        render (callable): returns a response with the rendered image.
+            Responses with a status other than 200 are returned unchanged
+            and are not cached.
+
+    Returns:
+        HttpResponse: image with ETag and Cache-Control headers, or 304 Not Modified
+    """
+    etag = '"{}"'.format(make_key(*key))
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+        return set_cache_headers(HttpResponseNotModified(), etag)
+
+    cached = get_cached_drawing(key)
+    if cached is None:
+        response = render()
+        if response.status_code != 200:
+            return response
+        set_cached_drawing(key, response['Content-Type'], response.content)
+    else:
+        content_type, content = cached
+        response = HttpResponse(content, content_type=content_type)
+    return set_cache_headers(response, etag)
+
+
+def cache_drawing_view(view):
+    """Decorator caching the responses of a drawing view by its URL arguments and query parameters."""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = get_drawing_key(view.__name__, args, kwargs, sorted(request.GET.items()))
+        return cached_drawing(request, key, lambda: view(request, *args, **kwargs))
+    return wrapper
@@ -3,8 +3,8 @@ import re
 from django.http import JsonResponse
 from django.shortcuts import render, HttpResponse
 from django.urls import reverse
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 
+from askcos_site.main.draw_cache import cache_drawing_view
 from askcos_site.main.utils import ajax_error_wrapper, resolve_smiles
 
 
@@ -58,6 +58,7 @@ def ajax_rxn_to_image(request):
 
 
 # @login_required
+@cache_drawing_view
 def draw_smiles(request, smiles):
     '''
     Returns a png response for a target smiles
@@ -73,6 +74,7 @@ def draw_smiles(request, smiles):
 
 
 #@login_required
+@cache_drawing_view
 def draw_template(request, template):
     '''
     Returns a png response for a reaction SMARTS template
@@ -84,6 +86,7 @@ def draw_template(request, template):
 
 
 # @login_required
+@cache_drawing_view
 def draw_reaction(request, smiles):
     '''
     Returns a png response for a SMILES reaction string
@@ -93,6 +96,7 @@ def draw_reaction(request, smiles):
     ReactionStringToImage(str(smiles)).save(response, 'png', quality=70)
     return response
 
+@cache_drawing_view
 def draw_mapped_reaction(request, smiles):
     '''
     Returns a png response for a SMILES reaction string
@@ -103,6 +107,7 @@ def draw_mapped_reaction(request, smiles):
     ReactionStringToImage(str(smiles), strip=False).save(response, 'png', quality=70)
     return response
 
+@cache_drawing_view
 def draw_highlighted_reaction(request, smiles):
     '''
         Returns a png response for a SMILES reaction string
@@ -113,6 +118,7 @@ def draw_highlighted_reaction(request, smiles):
     MappedReactionToHightlightImage(str(smiles), highlightByReactant=True).save(response, 'png', quality=70)
     return response
 
+@cache_drawing_view
 def draw_smiles_highlight(request, smiles, reacting_atoms, bonds='False'):
     '''
     Returns a svg xml with atoms highlighted
@@ -142,6 +148,7 @@ def draw_fig(request, fig):
     '''
     Returns a png response for figure object
     '''
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
     response = HttpResponse(content_type='img/png')
     canvas = FigureCanvas(fig)
     canvas.print_png(response)
@@ -1,11 +1,10 @@
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render
 
-from askcos_site.globals import db_client
+from askcos_site.askcos_celery.treebuilder.result_store import load_result
+from askcos_site.globals import results_collection
 from askcos_site.main.models import SavedResults
 
-results_collection = db_client['results']['results']
-
 
 @login_required
 def my_results(request):
@@ -27,7 +26,7 @@ def view_result(request):
             {'trees': []}
         )
     if result and result.result_state == 'completed':
-        result_doc = results_collection.find_one({'_id': id_})
+        result_doc = load_result(results_collection, id_).to_doc()
         (tree_status, trees) = result_doc['result']
         (num_chemicals, num_reactions, _) = tree_status
         return render(
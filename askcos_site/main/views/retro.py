@@ -10,6 +10,7 @@ from django.shortcuts import render
 from django.template.loader import render_to_string
 from django.urls import reverse
 
+from askcos_site.askcos_celery.scheduling import get_fair_share_user, get_lane_options
 from askcos_site.askcos_celery.treebuilder.tb_c_worker import get_top_precursors
 from askcos_site.askcos_celery.treebuilder.tb_coordinator_mcts import get_buyable_paths as get_buyable_paths_mcts
 from askcos_site.globals import retro_transformer, RETRO_CHIRAL_FOOTNOTE, pricer
@@ -119,9 +120,11 @@ def retro(request, smiles=None, chiral=True, mincount=0, max_n=200):
         print(filter_threshold)
 
         startTime = time.time()
-        res = get_top_precursors.delay(
-            smiles, max_num_templates=template_count, max_cum_prob=max_cum_prob, 
-            fast_filter_threshold=filter_threshold
+        res = get_top_precursors.apply_async(
+            args=(smiles,),
+            kwargs={'max_num_templates': template_count, 'max_cum_prob': max_cum_prob,
+                    'fast_filter_threshold': filter_threshold},
+            **get_lane_options('interactive')
         )
             
         (smiles, precursors) = res.get(300)
@@ -301,7 +304,7 @@ def ajax_start_retro_mcts_celery(request):
                                   apply_fast_filter=apply_fast_filter, filter_threshold=filter_threshold,
                                   template_prioritizer=template_prioritizer, template_set=template_set,
                                   return_first=return_first, hashed=historian_hashed,
-                                  run_async=run_async)
+                                  run_async=run_async, user=get_fair_share_user(request))
 
     if run_async:
         now = datetime.now()
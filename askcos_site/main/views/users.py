@@ -6,10 +6,9 @@ from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
 from django.shortcuts import render
 
-from askcos_site.globals import db_client
+from askcos_site.globals import results_collection
 from askcos_site.main.models import SavedResults
 
-results_collection = db_client['results']['results']
 
 AUTH_MODIFY_BUYABLES = os.environ.get('AUTH_MODIFY_BUYABLES') == 'True'
 
@@ -0,0 +1,73 @@
+"""
+Process pools for CPU bound work in web server processes.
+
+Web server processes run several request threads, so pool processes are
+started with ``spawn`` instead of ``fork``: forking while another thread
+holds a lock, e.g. in logging or a database client, can deadlock the child.
+Spawned processes set up Django and import the module of each task function
+themselves, so starting a pool takes a few seconds. Every web server process
+has its own pools, so they should be small, e.g. 2 processes each, to avoid
+oversubscribing the host. Pools are started on first use and shut down when
+the process exits.
+"""
+
+import atexit
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+
+def get_python_executable():
+    """Returns the python interpreter used to start pool processes.
+
+    Under uWSGI, ``sys.executable`` is the uwsgi binary, so the interpreter
+    of the python environment is used instead.
+    """
+    if os.path.basename(sys.executable).startswith('uwsgi'):
+        return os.path.join(sys.exec_prefix, 'bin', 'python')
+    return sys.executable
+
+
+def setup_django():
+    """Sets up Django in a pool process, so task functions can be imported from views."""
+    if os.environ.get('DJANGO_SETTINGS_MODULE'):
+        import django
+        django.setup()
+
+
+class LazyProcessPool(object):
+    """Process pool which is started on first use and shut down at exit.
+
+    Attributes:
+        processes (int): number of processes, pools with 1 or fewer are not started
+        name (str): name of the pool, used in log messages
+    """
+    def __init__(self, processes, name):
+        self.processes = processes
+        self.name = name
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns the process pool, starting it if necessary, or None if it should not be used."""
+        if self.processes <= 1:
+            return None
+        with self._lock:
+            if self._pool is None:
+                context = multiprocessing.get_context('spawn')
+                context.set_executable(get_python_executable())
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=context, initializer=setup_django,
+                )
+                atexit.register(self.shutdown)
+                print('Started {} process pool with {} processes'.format(self.name, self.processes))
+            return self._pool
+
+    def shutdown(self):
+        """Shuts the process pool down, if it was started."""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
@@ -3,6 +3,22 @@ container.classList.remove('container')
 container.classList.add('container-fluid')
 container.style.width=null;
 
+// Seconds the server waits for a task to change before answering a poll, and maximum
+// delay in ms between polls. Each waiting request holds a web server worker.
+const TASK_POLL_WAIT = 5
+const TASK_POLL_MAX_DELAY = 8000
+
+function nextPollDelay(delay, sent, json, previous) {
+    // poll again immediately if the task changed or the server waited for a change,
+    // since the server paces the polls. Otherwise, e.g. if the server does not wait,
+    // double the delay between polls, up to TASK_POLL_MAX_DELAY
+    const changed = !previous || json.state !== previous.state || json.percent !== previous.percent
+    if (changed || Date.now() - sent >= TASK_POLL_WAIT * 500) {
+        return 0
+    }
+    return Math.min(Math.max(delay * 2, 1000), TASK_POLL_MAX_DELAY)
+}
+
 function updateObj(dest, src) {
     // take properties of src and overwrite matching properties of dest
     // ignores properties in src if they do not exist in dest
@@ -776,8 +792,9 @@ var app = new Vue({
                 });
             }
         },
-        pollForTbResult() {
-            fetch('/api/v2/celery/task/'+this.tb.taskID)
+        pollForTbResult(delay = 0, previous = null) {
+            const sent = Date.now()
+            fetch('/api/v2/celery/task/'+this.tb.taskID+'/?wait='+TASK_POLL_WAIT)
                 .then(resp => resp.json())
                 .then(json => {
                     notificationOptions = {
@@ -806,7 +823,8 @@ var app = new Vue({
                         this.makeNotification("Tree builder results", notificationOptions, (event) => {this.close()})
                     }
                     else {
-                        setTimeout(() => this.pollForTbResult(), 1000)
+                        const next = nextPollDelay(delay, sent, json, previous)
+                        setTimeout(() => this.pollForTbResult(next, json), next)
                     }
                 })
                 .catch(error => {
@@ -859,8 +877,9 @@ var app = new Vue({
                     alert('There was an error predicting precursors for this target: '+error)
                 })
         },
-        pollCeleryResult: function(taskId, callback) {
-            fetch(`/api/v2/celery/task/${taskId}/`)
+        pollCeleryResult: function(taskId, callback, delay = 0, previous = null) {
+            const sent = Date.now()
+            fetch(`/api/v2/celery/task/${taskId}/?wait=${TASK_POLL_WAIT}`)
             .then(resp => resp.json())
             .then(json => {
                 if (json.complete) {
@@ -872,7 +891,8 @@ var app = new Vue({
                     throw Error('Celery task failed.');
                 }
                 else {
-                    setTimeout(() => {this.pollCeleryResult(taskId, callback)}, 1000)
+                    const next = nextPollDelay(delay, sent, json, previous)
+                    setTimeout(() => {this.pollCeleryResult(taskId, callback, next, json)}, next)
                 }
             })
             .catch(error => {
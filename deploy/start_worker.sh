@@ -0,0 +1,57 @@
+#!/usr/bin/env bash
+#
+# Starts a celery worker for one of the askcos queues with the pool and
+# concurrency that queue needs, e.g. as the command of a worker container:
+#
+#   deploy/start_worker.sh tb_coordinator_mcts
+#
+# Additional arguments are passed on to celery.
+#
+# The tree builder coordinator mostly waits on tb_c_worker results, so it
+# runs many searches in one process with a gevent pool. Each search is a
+# greenlet with its own tree builder, see tb_coordinator_mcts.py.
+#
+# Environment variables:
+#   TB_COORDINATOR_CONCURRENCY  concurrent searches per coordinator (default 20)
+#   TB_C_WORKER_CONCURRENCY     processes per tree builder worker pool (default 2)
+#   WORKER_CONCURRENCY          processes for other queues (default 1)
+#   BUYABLES_INDEX_PATH         directory of the buyables price and fingerprint
+#                               indexes, required by the web server, the
+#                               buyables worker and workers using the pricer
+#
+# The buyables worker builds the indexes and the other containers only read
+# them, so BUYABLES_INDEX_PATH must be on a volume mounted into all of them,
+# e.g. with docker compose:
+#
+#   volumes:
+#     - buyables_index:/var/lib/askcos/buyables_index
+#   environment:
+#     BUYABLES_INDEX_PATH: /var/lib/askcos/buyables_index
+
+set -e
+
+QUEUE=$1
+if [ -z "$QUEUE" ]; then
+    echo "Usage: $0 <queue> [celery worker arguments]" >&2
+    exit 1
+fi
+shift
+
+case "$QUEUE" in
+    tb_coordinator_mcts)
+        OPTIONS="-Q tb_coordinator_mcts -P gevent -c ${TB_COORDINATOR_CONCURRENCY:-20}"
+        ;;
+    tb_c_worker)
+        # Pools are reserved through tb_c_worker_reservable, see worker_leases.py
+        OPTIONS="-Q tb_c_worker,tb_c_worker_reservable -c ${TB_C_WORKER_CONCURRENCY:-2}"
+        ;;
+    buyables_worker)
+        # Imports use a process pool of their own, see buyables_worker.py
+        OPTIONS="-Q buyables_worker -P solo"
+        ;;
+    *)
+        OPTIONS="-Q $QUEUE -c ${WORKER_CONCURRENCY:-1}"
+        ;;
+esac
+
+exec celery -A askcos_site worker -l info -n "$QUEUE@%h" $OPTIONS "$@"